@@ -0,0 +1,38 @@
+import contextlib
+import os
+
+import pytest
+
+# the tests run offline: litellm uses its bundled model cost map, crewai sends no telemetry
+os.environ.setdefault('LITELLM_LOCAL_MODEL_COST_MAP', 'True')
+os.environ.setdefault('OTEL_SDK_DISABLED', 'true')
+os.environ.setdefault('CREWAI_TELEMETRY_OPT_OUT', 'true')
+
+# latencies of the fake backends, short enough for a whole book in about a second
+FAST_BACKENDS = {
+    'llm_latency': 0.01,
+    'image_queue_latency': 0.01,
+    'image_latency': 0.05,
+    'hf_latency': 0.05,
+    'tts_latency': 0.01,
+    'tts_chunk_latency': 0.0,
+    'throttle_retry_after': 0.01,
+}
+
+
+@pytest.fixture
+def fake_backends(tmp_path, monkeypatch):
+    """
+    Start the fake LLM, fal, Hugging Face and ElevenLabs backends of `v0.bench.fakes` with
+    `fake_backends(pages, **config)`, in the temporary directory of the test (the task output,
+    audio, image and template caches are relative to the working directory).
+    """
+    from v0.bench import fakes
+
+    monkeypatch.chdir(tmp_path)
+    with contextlib.ExitStack() as stack:
+        def start(pages: int = 3, **config) -> dict:
+            config = fakes.FakeBackendConfig(**{**FAST_BACKENDS, **config})
+            return stack.enter_context(fakes.fake_backends(pages, config, str(tmp_path / 'images')))
+
+        yield start
@@ -0,0 +1,108 @@
+import asyncio
+import os
+import time
+
+import pytest
+
+from v0.async_api import generate_story_book_in_thread
+
+
+def run_book(output_dir, events, **kwargs):
+    return asyncio.run(generate_story_book_in_thread('firefighters', '3-6', 'Chinese', output_dir=str(output_dir), on_event=events.append, use_cache=False, image_format=None, **kwargs))
+
+
+def test_events_are_delivered_in_order(fake_backends, tmp_path):
+    fake_backends(pages=3)
+    events = []
+    result = run_book(tmp_path / 'book', events)
+
+    assert len(result['tasks_output']) == 8
+    types = [event['type'] for event in events]
+    assert types[-1] == 'book_completed'
+    assert types.count('book_completed') == 1
+    assert sorted(event['page'] for event in events if event['type'] == 'page_image') == [1, 2, 3]
+    assert sorted(event['page'] for event in events if event['type'] == 'page_rendered') == [1, 2, 3]
+    assert types.count('audio_ready') == 1
+
+    position = {(event['type'], event.get('task') or event.get('page')): i for i, event in enumerate(events)}
+    for task in ('research_story_theme_task', 'generate_illustrations_task', 'generate_html_pages_task'):
+        assert position['task_started', task] < position['task_completed', task]
+    assert position['task_completed', 'research_story_theme_task'] < position['task_started', 'develop_story_outline_task']
+    for page in (1, 2, 3):
+        assert position['task_completed', 'generate_illustrations_task'] < position['page_image', page] < position['page_rendered', page]
+
+
+def test_async_listener_is_awaited(fake_backends, tmp_path):
+    fake_backends(pages=2)
+    delivered = []
+
+    async def on_event(event):
+        await asyncio.sleep(0)
+        delivered.append(event['type'])
+
+    asyncio.run(generate_story_book_in_thread('firefighters', '3-6', 'Chinese', output_dir=str(tmp_path / 'book'), on_event=on_event, use_cache=False, image_format=None))
+    assert delivered[-1] == 'book_completed'
+
+
+def test_failed_book_emits_book_failed(fake_backends, tmp_path):
+    fake_backends(pages=2, llm_failure_rate=1.0)
+    events = []
+    with pytest.raises(Exception):
+        run_book(tmp_path / 'book', events)
+    assert events[-1]['type'] == 'book_failed'
+    assert 'Injected LLM failure' in events[-1]['error']
+
+
+def test_cancel_mid_book(fake_backends, tmp_path, monkeypatch):
+    import fal_client
+
+    # the images never finish on their own, and are neither hedged nor abandoned
+    fakes = fake_backends(pages=3, image_latency=30.0, image_hedge_after=60.0, image_timeout=120.0)
+    fal = fakes['fal']
+
+    def slow_cancel(application, request_id):
+        time.sleep(0.2)
+        fal.cancel(application, request_id)
+
+    monkeypatch.setattr(fal_client, 'cancel', slow_cancel)
+    output_dir = tmp_path / 'book'
+    events = []
+    gaps = []
+
+    async def tick():
+        while True:
+            before = time.monotonic()
+            await asyncio.sleep(0.01)
+            gaps.append(time.monotonic() - before)
+
+    async def main():
+        ticker = asyncio.create_task(tick())
+        book = asyncio.create_task(generate_story_book_in_thread('firefighters', '3-6', 'Chinese', output_dir=str(output_dir), on_event=events.append, use_cache=False, image_format=None))
+        deadline = time.monotonic() + 30
+        while len(fal._jobs) < 3 and time.monotonic() < deadline:
+            await asyncio.sleep(0.01)
+        assert len(fal._jobs) == 3
+        book.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await book
+        while not events or events[-1]['type'] != 'book_cancelled':
+            await asyncio.sleep(0.01)
+        ticker.cancel()
+
+    started = time.monotonic()
+    asyncio.run(main())
+    assert time.monotonic() - started < 30
+    assert [event['type'] for event in events].count('book_cancelled') == 1
+    assert 'book_completed' not in [event['type'] for event in events]
+    # every fal job tracked by the book was cancelled on fal's side
+    assert fal.cancelled == 3
+    assert 'page_image' not in [event['type'] for event in events]
+    # the cancel requests did not hold up the event loop
+    assert max(gaps) < 0.2
+
+    # the book thread stops at its next check of the cancellation
+    deadline = time.monotonic() + 10
+    while not os.path.exists(output_dir / 'metrics.json') and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert os.path.exists(output_dir / 'metrics.json')
+    assert not os.path.exists(output_dir / 'result.json')
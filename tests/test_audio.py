@@ -0,0 +1,87 @@
+import json
+import os
+
+import pytest
+
+from v0 import clients
+from v0.audio import generate_book_audio, mp3_duration, segment_key
+from v0.bench.fakes import FakeElevenLabs
+from v0.metrics import MetricsRecorder
+from v0.rate_limit import RateLimit, RateLimiter
+from v0.run_control import BookCancelled, RunControl
+
+
+# the fake narrates about one second of 192 kbps audio (24000 bytes) per 15 characters
+PAGE_TEXTS = ['a' * 15, 'b' * 45, 'c' * 30]
+
+
+@pytest.fixture
+def eleven_labs():
+    with clients.override(**{'rate_limiter:elevenlabs': RateLimiter('elevenlabs', RateLimit())}):
+        yield FakeElevenLabs(latency=0.0, chunk_latency=0.0)
+
+
+def narrate(client, tmp_path, page_texts=PAGE_TEXTS, **kwargs) -> dict:
+    os.makedirs(tmp_path / 'book', exist_ok=True)
+    return generate_book_audio(client, page_texts, str(tmp_path / 'book'), cache_dir=str(tmp_path / 'cache'), **kwargs)
+
+
+def test_mp3_duration():
+    assert mp3_duration(24000) == 1.0
+    assert mp3_duration(16000, 'mp3_44100_128') == 1.0
+
+
+def test_segment_key_changes_with_the_voice():
+    assert segment_key('hello') == segment_key('hello')
+    assert len({segment_key('hello'), segment_key('hello!'), segment_key('hello', voice_id='other'), segment_key('hello', model_id='other'), segment_key('hello', output_format='mp3_44100_128')}) == 5
+
+
+def test_manifest_offsets(eleven_labs, tmp_path):
+    manifest = narrate(eleven_labs, tmp_path)
+    assert manifest['duration'] == 6.0
+    assert [(page['page'], page['start'], page['end'], page['byte_start'], page['byte_end']) for page in manifest['pages']] == [
+        (1, 0.0, 1.0, 0, 24000),
+        (2, 1.0, 4.0, 24000, 96000),
+        (3, 4.0, 6.0, 96000, 144000),
+    ]
+    assert os.path.getsize(tmp_path / 'book' / 'audio.mp3') == 144000
+    with open(tmp_path / 'book' / 'audio_manifest.json', 'r', encoding='utf-8') as f:
+        assert json.load(f) == manifest
+    assert manifest['pages'][1]['segment'] == f'{segment_key(PAGE_TEXTS[1])}.mp3'
+
+
+def test_only_edited_pages_are_narrated_again(eleven_labs, tmp_path):
+    narrate(eleven_labs, tmp_path)
+    assert eleven_labs.characters == 90
+
+    metrics = MetricsRecorder()
+    manifest = narrate(eleven_labs, tmp_path, [PAGE_TEXTS[0], 'd' * 15, PAGE_TEXTS[2]], metrics=metrics)
+    assert eleven_labs.characters == 90 + 15
+    assert [span.attributes['cached'] for span in sorted(metrics.spans, key=lambda span: span.name)] == [True, False, True]
+    assert [(page['start'], page['end']) for page in manifest['pages']] == [(0.0, 1.0), (1.0, 2.0), (2.0, 4.0)]
+
+
+def test_cancelled_book_caches_nothing(eleven_labs, tmp_path):
+    run_control = RunControl()
+    run_control.cancel()
+    with pytest.raises(BookCancelled):
+        narrate(eleven_labs, tmp_path, run_control=run_control)
+    assert eleven_labs.characters == 0
+    assert not os.path.exists(tmp_path / 'cache') or not [files for _, _, files in os.walk(tmp_path / 'cache') if files]
+
+
+def test_stream_is_dropped_when_the_book_is_cancelled(eleven_labs, tmp_path):
+    run_control = RunControl()
+    convert = eleven_labs.text_to_speech.convert
+
+    def cancel_after_the_first_chunk(**kwargs):
+        for i, chunk in enumerate(convert(**kwargs)):
+            if i == 1:
+                run_control.cancel()
+            yield chunk
+
+    eleven_labs.text_to_speech.convert = cancel_after_the_first_chunk
+    with pytest.raises(BookCancelled):
+        narrate(eleven_labs, tmp_path, page_texts=['a' * 150], run_control=run_control)
+    # neither the partial segment nor its temporary file are left
+    assert not [files for _, _, files in os.walk(tmp_path / 'cache') if files]
@@ -0,0 +1,109 @@
+import json
+import threading
+import time
+
+import pytest
+
+from v0 import batch
+from v0.batch import BatchRunner, completed_job_ids, read_jobs
+
+
+def result_dict(title: str) -> dict:
+    return {
+        'tasks_output': [
+            {'name': 'develop_story_outline_task', 'json_dict': {'title': title}},
+            {'name': 'write_story_content_task', 'json_dict': {'pages': [{}, {}]}},
+        ],
+        'token_usage': {'total_tokens': 100},
+    }
+
+
+class FakeBooks:
+    """Stand-in for `generate_story_book`: fails the books of `failing` themes, can hold every book until released"""
+
+    def __init__(self, failing=(), hold=False):
+        self.failing = set(failing)
+        self.started: list[dict] = []
+        self.release = threading.Event()
+        if not hold:
+            self.release.set()
+        self._lock = threading.Lock()
+
+    def __call__(self, **kwargs) -> dict:
+        with self._lock:
+            self.started.append(kwargs)
+        self.release.wait(5)
+        if kwargs['story_theme'] in self.failing:
+            raise RuntimeError(f'no book about {kwargs["story_theme"]}')
+        return result_dict(kwargs['story_theme'])
+
+
+def jobs(count: int, consumed: list | None = None):
+    for i in range(count):
+        if consumed is not None:
+            consumed.append(i)
+        yield {'id': str(i), 'story_theme': f'theme {i}', 'age_range': '3-6', 'target_language': 'French'}
+
+
+def log_entries(log_file) -> list[dict]:
+    with open(log_file, 'r', encoding='utf-8') as f:
+        return [json.loads(line) for line in f]
+
+
+def test_read_jobs(tmp_path):
+    jobs_file = tmp_path / 'jobs.jsonl'
+    jobs_file.write_text('{"story_theme": "a"}\n\n{"id": "b", "story_theme": "b"}\n', encoding='utf-8')
+    assert list(read_jobs(str(jobs_file))) == [{'story_theme': 'a', 'id': '1'}, {'id': 'b', 'story_theme': 'b'}]
+
+
+def test_jobs_are_logged(tmp_path, monkeypatch):
+    books = FakeBooks(failing={'theme 1'})
+    monkeypatch.setattr(batch, 'generate_story_book', books)
+    log_file = tmp_path / 'log.jsonl'
+    counts = BatchRunner(str(log_file), workers=2, output_root=str(tmp_path / 'books')).run(jobs(3))
+
+    assert counts == {'done': 2, 'failed': 1, 'skipped': 0}
+    final = {entry['id']: entry for entry in log_entries(log_file) if entry['status'] != 'started'}
+    assert final['0']['status'] == 'done'
+    assert (final['0']['title'], final['0']['pages'], final['0']['total_tokens']) == ('theme 0', 2, 100)
+    assert final['0']['output_dir'] == str(tmp_path / 'books' / '0')
+    assert final['1']['status'] == 'failed'
+    assert final['1']['error'] == 'RuntimeError: no book about theme 1'
+    assert 'Traceback' in final['1']['traceback']
+
+
+def test_done_jobs_are_skipped(tmp_path, monkeypatch):
+    books = FakeBooks(failing={'theme 1'})
+    monkeypatch.setattr(batch, 'generate_story_book', books)
+    log_file = str(tmp_path / 'log.jsonl')
+    BatchRunner(log_file, output_root=str(tmp_path / 'books')).run(jobs(3))
+    assert completed_job_ids(log_file) == {'0', '2'}
+
+    books.failing.clear()
+    books.started.clear()
+    counts = BatchRunner(log_file, output_root=str(tmp_path / 'books')).run(jobs(3))
+    assert counts == {'done': 1, 'failed': 0, 'skipped': 2}
+    assert [kwargs['story_theme'] for kwargs in books.started] == ['theme 1']
+    assert completed_job_ids(log_file) == {'0', '1', '2'}
+
+    counts = BatchRunner(log_file, output_root=str(tmp_path / 'books'), skip_done=False).run(jobs(3))
+    assert counts == {'done': 3, 'failed': 0, 'skipped': 0}
+
+
+@pytest.mark.parametrize('workers', [1, 3])
+def test_only_a_few_jobs_are_read_ahead(tmp_path, monkeypatch, workers):
+    books = FakeBooks(hold=True)
+    monkeypatch.setattr(batch, 'generate_story_book', books)
+    consumed = []
+    runner = BatchRunner(str(tmp_path / 'log.jsonl'), workers=workers, output_root=str(tmp_path / 'books'))
+    thread = threading.Thread(target=runner.run, args=(jobs(100, consumed),))
+    thread.start()
+    try:
+        time.sleep(0.3)
+        # the running books, the ones queued behind them and the job waiting for a free slot
+        assert len(books.started) == workers
+        assert len(consumed) == 2 * workers + 1
+    finally:
+        books.release.set()
+        thread.join()
+    assert len(books.started) == 100
@@ -0,0 +1,153 @@
+import hashlib
+import json
+import os
+
+import pytest
+
+from v0.bundle import CURRENT_FILE, IMMUTABLE_CACHE_CONTROL, MANIFEST_FILE, _BookBundle, export_book
+from v0.crew import generate_story_book
+from v0.regenerate import regenerate_page
+
+
+@pytest.fixture
+def books(fake_backends, tmp_path):
+    """`books(*names)` makes a 2-page book in `tmp_path/<name>` for every name, and returns their directories"""
+    fake_backends(pages=2)
+
+    def make(*names) -> list[str]:
+        output_dirs = []
+        for name in names:
+            output_dir = str(tmp_path / name)
+            generate_story_book('firefighters', '3-6', 'French', output_dir=output_dir, use_cache=False, image_format=None)
+            output_dirs.append(output_dir)
+        return output_dirs
+
+    return make
+
+
+def read_json(path) -> dict:
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def test_bundle_files(books, tmp_path):
+    output_dir, = books('firefighter')
+    bundle_root = tmp_path / 'cdn'
+    manifest = export_book(output_dir, str(bundle_root))
+
+    version = manifest['version']
+    assert manifest['book_id'] == 'firefighter'
+    assert read_json(bundle_root / 'books' / 'firefighter' / CURRENT_FILE) == {'version': version, 'manifest': f'{version}/{MANIFEST_FILE}'}
+    assert read_json(bundle_root / 'books' / 'firefighter' / version / MANIFEST_FILE) == manifest
+    assert manifest['translations'] == [{
+        'task': 'translate_content_task',
+        'book': f'books/firefighter/{version}/merged_book.html',
+        'pages': [f'books/firefighter/{version}/page_1.html', f'books/firefighter/{version}/page_2.html'],
+    }]
+    # every file is named after its content, or is in the directory of the version
+    for path, entry in manifest['files'].items():
+        with open(bundle_root / path, 'rb') as f:
+            data = f.read()
+        assert (entry['size'], entry['sha256'], entry['cache_control']) == (len(data), hashlib.sha256(data).hexdigest(), IMMUTABLE_CACHE_CONTROL)
+        assert path.startswith(('assets/', 'books/firefighter/media/', f'books/firefighter/{version}/'))
+    assert {manifest['files'][path]['content_type'] for path in manifest['files'] if path.endswith('.js')} == {'text/javascript; charset=utf-8'}
+
+    # the CSS and JS left the pages, which point at the shared assets and the media
+    page = (bundle_root / 'books' / 'firefighter' / version / 'page_1.html').read_text(encoding='utf-8')
+    assert '<style' not in page and 'addEventListener' not in page
+    assert '<link rel="stylesheet" href="../../../assets/' in page
+    assert '<script src="../../../assets/' in page
+    styles = [(bundle_root / path).read_text(encoding='utf-8') for path in manifest['files'] if path.endswith('.css')]
+    assert [css for css in styles if "url('../books/firefighter/media/" in css]
+
+
+def test_audio_byte_ranges(books, tmp_path):
+    output_dir, = books('firefighter')
+    manifest = export_book(output_dir, str(tmp_path / 'cdn'))
+    audio_manifest = read_json(os.path.join(output_dir, 'audio_manifest.json'))
+
+    audio = manifest['audio']
+    assert audio['path'].startswith('books/firefighter/media/') and audio['path'].endswith('.mp3')
+    assert audio['size'] == os.path.getsize(os.path.join(output_dir, 'audio.mp3'))
+    assert [page['range'] for page in audio['pages']] == [f"bytes={page['byte_start']}-{page['byte_end'] - 1}" for page in audio_manifest['pages']]
+    assert manifest['files'][audio['path']]['content_type'] == 'audio/mpeg'
+
+
+def test_unchanged_book_keeps_its_version(books, tmp_path):
+    output_dir, = books('firefighter')
+    bundle_root = tmp_path / 'cdn'
+    manifest = export_book(output_dir, str(bundle_root))
+    mtimes = {path: os.stat(bundle_root / path).st_mtime_ns for path in manifest['files']}
+
+    assert export_book(output_dir, str(bundle_root)) == manifest
+    assert {path: os.stat(bundle_root / path).st_mtime_ns for path in manifest['files']} == mtimes
+    assert sorted(os.listdir(bundle_root / 'books' / 'firefighter')) == sorted([CURRENT_FILE, manifest['version'], 'media'])
+
+
+def test_edited_book_gets_a_new_version(books, tmp_path):
+    output_dir, = books('firefighter')
+    bundle_root = tmp_path / 'cdn'
+    first = export_book(output_dir, str(bundle_root))
+
+    regenerate_page(output_dir, 1, translations={'French': {'content': 'Jacques monte.', 'core_vocabulary_word': 'monter'}})
+    second = export_book(output_dir, str(bundle_root))
+
+    assert second['version'] != first['version']
+    assert read_json(bundle_root / 'books' / 'firefighter' / CURRENT_FILE)['version'] == second['version']
+    # the previous version is still there for the pages being read, the media are shared
+    assert (bundle_root / 'books' / 'firefighter' / first['version'] / 'page_2.html').exists()
+    assert 'Jacques monte.' in (bundle_root / 'books' / 'firefighter' / second['version'] / 'page_2.html').read_text(encoding='utf-8')
+    media = lambda manifest: {path for path in manifest['files'] if '/media/' in path}
+    assert media(first) == media(second)
+    assert len(os.listdir(bundle_root / 'books' / 'firefighter' / 'media')) == len(media(second))
+
+
+def test_books_share_the_template_assets(books, tmp_path):
+    bundle_root = tmp_path / 'cdn'
+    manifests = [export_book(output_dir, str(bundle_root)) for output_dir in books('firefighter', 'astronaut')]
+
+    assets = [{path for path in manifest['files'] if path.startswith('assets/')} for manifest in manifests]
+    # the CSS of the pages points at the media of their book, the rest of the CSS and the JS are shared
+    page_styles = [
+        {path for path in book_assets if '/media/' in (bundle_root / path).read_text(encoding='utf-8')}
+        for book_assets in assets
+    ]
+    assert page_styles[0] and page_styles[1] and not page_styles[0] & page_styles[1]
+    assert assets[0] - page_styles[0] == assets[1] - page_styles[1]
+    assert [path for path in assets[0] if path.endswith('.js')]
+    assert sorted(os.listdir(bundle_root / 'assets')) == sorted(os.path.basename(path) for path in assets[0] | assets[1])
+
+
+def test_references_are_rewritten(tmp_path):
+    book = tmp_path / 'book'
+    (book / 'images').mkdir(parents=True)
+    (book / 'images' / 'page_1.png').write_bytes(b'png')
+    (book / 'images' / 'page_1.small.webp').write_bytes(b'webp')
+    (book / 'page_1.html').write_text(
+        '<style media="print">.a { background: url(images/page_1.png); }</style>'
+        '<script src="https://cdn.example.com/lib.js"></script>'
+        '<script type="application/ld+json">{"name": "book"}</script>'
+        '<img src="images/page_1.png" srcset="images/page_1.small.webp 360w, images/page_1.png 720w">'
+        '<a href="page_2.html">next</a><img src="images/missing.png"><img src="https://example.com/a.png">',
+        encoding='utf-8',
+    )
+    bundle = _BookBundle(str(book), 'book')
+    bundle.add_document('page_1.html')
+
+    html = bundle.documents['page_1.html']
+    png, webp = bundle.media['images/page_1.png'], bundle.media['images/page_1.small.webp']
+    assert png == f"books/book/media/{hashlib.sha256(b'png').hexdigest()[:16]}.png"
+    assert '<link rel="stylesheet" href="../../../assets/' in html and 'media="print"' in html
+    assert '<script src="https://cdn.example.com/lib.js"></script>' in html
+    assert '<script type="application/ld+json">{"name": "book"}</script>' in html
+    assert f'<img src="../media/{os.path.basename(png)}" srcset="../media/{os.path.basename(webp)} 360w, ../media/{os.path.basename(png)} 720w">' in html
+    assert '<a href="page_2.html">' in html
+    assert '<img src="images/missing.png">' in html and '<img src="https://example.com/a.png">' in html
+    css, = bundle.assets.values()
+    assert css == f'.a {{ background: url(../{png}); }}'.encode('utf-8')
+
+
+def test_unfinished_book_is_not_exported(tmp_path):
+    (tmp_path / 'book').mkdir()
+    with pytest.raises(ValueError, match='generate'):
+        export_book(str(tmp_path / 'book'), str(tmp_path / 'cdn'))
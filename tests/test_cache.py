@@ -0,0 +1,126 @@
+import json
+import os
+
+import pytest
+from crewai import LLM, Agent, Task
+from crewai.tasks.output_format import OutputFormat
+from crewai.tasks.task_output import TaskOutput
+
+from v0.cache import TaskOutputCache
+from v0.pydantic_models import PageContent
+
+
+INPUTS = {'topic': 'firefighters', 'target_language': 'French'}
+PAGE = {'core_vocabulary_word': 'fire', 'content': 'The fire is hot.'}
+
+
+def make_task(description='Write a page about {topic}', model='openai/gpt-4o-mini', temperature=0.7, top_p=None, max_tokens=None, **task_fields) -> Task:
+    agent = Agent(
+        role='Writer', goal='Write pages', backstory='A children book author',
+        llm=LLM(model=model, temperature=temperature, top_p=top_p, max_tokens=max_tokens),
+    )
+    return Task(name='write_page', description=description, expected_output='A page', agent=agent, **{'output_pydantic': PageContent, **task_fields})
+
+
+def page_output(page: dict = PAGE) -> TaskOutput:
+    return TaskOutput(
+        name='write_page', description='', expected_output='', agent='Writer',
+        raw=json.dumps(page), json_dict=page, output_format=OutputFormat.PYDANTIC,
+    )
+
+
+def test_key_is_stable():
+    cache = TaskOutputCache(enabled=False)
+    context = [page_output()]
+    assert cache.key(make_task(), dict(INPUTS), context) == cache.key(make_task(), dict(reversed(INPUTS.items())), [page_output()])
+
+
+@pytest.mark.parametrize('change', [
+    {'task': {'description': 'Write a poem about {topic}'}},
+    {'task': {'model': 'openai/gpt-4o'}},
+    {'task': {'temperature': 0.2}},
+    {'task': {'top_p': 0.5}},
+    {'task': {'max_tokens': 256}},
+    {'task': {'output_pydantic': None}},
+    {'inputs': {'target_language': 'Spanish'}},
+    {'context': [page_output({**PAGE, 'content': 'The fire is out.'})]},
+])
+def test_key_changes_with_what_produces_the_output(change):
+    cache = TaskOutputCache(enabled=False)
+    key = cache.key(make_task(), INPUTS, [page_output()])
+    changed_key = cache.key(make_task(**change.get('task', {})), {**INPUTS, **change.get('inputs', {})}, change.get('context', [page_output()]))
+    assert changed_key != key
+
+
+def test_get_returns_what_was_put(tmp_path):
+    cache = TaskOutputCache(str(tmp_path))
+    task = make_task()
+    key = cache.key(task, INPUTS, [])
+    assert cache.get(key, task) is None
+    cache.put(key, page_output())
+
+    output = cache.get(key, task)
+    assert output.pydantic == PageContent(**PAGE)
+    assert output.json_dict == PAGE
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_get_revalidates_the_entry(tmp_path):
+    cache = TaskOutputCache(str(tmp_path))
+    task = make_task()
+    key = cache.key(task, INPUTS, [])
+    cache.put(key, page_output({'content': 'no vocabulary word'}))
+
+    # the entry does not fit the output model of the task (e.g. written before a schema change)
+    assert cache.get(key, task) is None
+    assert (cache.hits, cache.misses) == (0, 1)
+
+
+def test_disabled_cache_does_not_touch_the_disk(tmp_path):
+    cache = TaskOutputCache(str(tmp_path / 'cache'), enabled=False)
+    cache.put('ab' * 32, page_output())
+    assert cache.get('ab' * 32, make_task()) is None
+    assert not os.path.exists(tmp_path / 'cache')
+
+
+def entry_size() -> int:
+    return len(json.dumps({'name': 'write_page', 'raw': json.dumps(PAGE), 'json_dict': PAGE, 'agent': 'Writer', 'output_format': 'pydantic'}).encode('utf-8'))
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    cache = TaskOutputCache(str(tmp_path), max_size_bytes=3 * entry_size())
+    task = make_task()
+    keys = [f'{i:02d}' * 32 for i in range(4)]
+    for i, key in enumerate(keys[:3]):
+        cache.put(key, page_output())
+        os.utime(cache._path(key), (i, i))
+    cache.get(keys[0], task)  # now the most recently used
+
+    cache.put(keys[3], page_output())
+    assert [os.path.exists(cache._path(key)) for key in keys] == [True, False, False, True]
+
+
+def test_eviction_does_not_scan_on_every_put(tmp_path, monkeypatch):
+    cache = TaskOutputCache(str(tmp_path), max_size_bytes=100 * entry_size())
+    scans = []
+    entries = cache._entries
+    monkeypatch.setattr(cache, '_entries', lambda: scans.append(1) or entries())
+    for i in range(20):
+        cache.put(f'{i:02d}' * 32, page_output())
+    assert len(scans) == 1
+
+
+def test_eviction_ignores_entries_removed_by_another_process(tmp_path, monkeypatch):
+    cache = TaskOutputCache(str(tmp_path), max_size_bytes=int(1.5 * entry_size()))
+    cache.put('00' * 32, page_output())
+    os.utime(cache._path('00' * 32), (0, 0))
+    remove = os.remove
+
+    def remove_twice(path):
+        remove(path)
+        remove(path)
+
+    monkeypatch.setattr(os, 'remove', remove_twice)
+    cache.put('01' * 32, page_output())
+    assert not os.path.exists(cache._path('00' * 32))
+    assert os.path.exists(cache._path('01' * 32))
@@ -0,0 +1,68 @@
+import json
+import os
+
+import pytest
+
+from v0.checkpoint import CheckpointStore, InputsMismatchError
+from v0.crew import generate_story_book
+from v0.run_control import RunControl
+
+
+INPUTS = {'story_theme': 'firefighters', 'age_range': '3-6', 'target_language': ['French', 'Spanish']}
+
+
+def test_same_inputs_can_resume(tmp_path):
+    checkpoint = CheckpointStore(str(tmp_path))
+    checkpoint.save_inputs(INPUTS)
+    checkpoint.check_inputs({**INPUTS, 'target_language': ('French', 'Spanish')})
+
+
+@pytest.mark.parametrize('change', [
+    {'target_language': ['French']},
+    {'target_language': 'French'},
+    {'age_range': '1-3'},
+    {'story_theme': 'astronauts'},
+])
+def test_other_inputs_are_refused(tmp_path, change):
+    checkpoint = CheckpointStore(str(tmp_path))
+    checkpoint.save_inputs(INPUTS)
+    with pytest.raises(InputsMismatchError) as error:
+        checkpoint.check_inputs({**INPUTS, **change})
+    assert list(error.value.changed) == list(change)
+
+
+def run_book(output_dir, **kwargs):
+    events = []
+    generate_story_book(output_dir=output_dir, use_cache=False, image_format=None, run_control=RunControl(on_event=events.append), **kwargs)
+    return events
+
+
+def test_resume_runs_only_the_missing_tasks(fake_backends, tmp_path):
+    fake_backends(pages=2)
+    output_dir = str(tmp_path / 'book')
+    run_book(output_dir, story_theme='firefighters', age_range='3-6', target_language='French')
+    # as if the run had failed on the translation
+    checkpoint_dir = os.path.join(output_dir, 'checkpoints')
+    os.remove(os.path.join(checkpoint_dir, 'translate_content_task.json'))
+    os.remove(os.path.join(output_dir, 'result.json'))
+
+    events = run_book(output_dir, resume=output_dir)
+    completed = {event['task']: event['cached'] for event in events if event['type'] == 'task_completed'}
+    assert [task for task, cached in completed.items() if not cached] == ['translate_content_task']
+    with open(os.path.join(output_dir, 'result.json'), 'r', encoding='utf-8') as f:
+        assert len(json.load(f)['tasks_output']) == len(completed)
+
+
+def test_resume_with_another_language_is_refused(fake_backends, tmp_path):
+    fake_backends(pages=2)
+    output_dir = str(tmp_path / 'book')
+    run_book(output_dir, story_theme='firefighters', age_range='3-6', target_language='French')
+    with open(os.path.join(output_dir, 'checkpoints', 'translate_content_task.json'), 'r', encoding='utf-8') as f:
+        translation = f.read()
+
+    with pytest.raises(InputsMismatchError, match='target_language'):
+        run_book(output_dir, resume=output_dir, target_language='Spanish')
+    # the French translation is not reused as the Spanish one, nor overwritten
+    with open(os.path.join(output_dir, 'checkpoints', 'translate_content_task.json'), 'r', encoding='utf-8') as f:
+        assert f.read() == translation
+    assert CheckpointStore(output_dir).load_inputs()['target_language'] == 'French'
@@ -0,0 +1,104 @@
+import json
+
+import pytest
+from crewai.tasks.output_format import OutputFormat
+from crewai.tasks.task_output import TaskOutput
+
+from v0.context_projection import field_tree, project, project_context
+
+
+OUTLINE = {
+    'title': 'James the firefighter',
+    'character_descriptions': ['James, a little firefighter'],
+    'pages': [
+        {'core_vocabulary': 'fire', 'plot_point': 'A fire starts', 'educational_elements': 'safety'},
+        {'core_vocabulary': 'truck', 'plot_point': 'James drives', 'educational_elements': 'vehicles'},
+    ],
+}
+ART_DIRECTION = {
+    'character_designs': [{'name': 'James', 'design': 'red helmet'}],
+    'color_palette': 'warm reds',
+    'art_style': 'watercolor',
+}
+NESTED = {'chapters': [{'name': 'one', 'pages': [{'text': 'a', 'notes': 'x'}, {'text': 'b', 'notes': 'y'}]}, {'name': 'two', 'pages': []}]}
+
+
+def task_output(name: str, json_dict: dict | None, raw: str | None = None) -> TaskOutput:
+    return TaskOutput(
+        name=name, description='', expected_output='', agent='',
+        raw=raw if raw is not None else json.dumps(json_dict), json_dict=json_dict,
+        output_format=OutputFormat.JSON if json_dict is not None else OutputFormat.RAW,
+    )
+
+
+def test_field_tree():
+    assert field_tree(['pages.content', 'title', 'pages.core_vocabulary_word']) == {'pages': {'content': {}, 'core_vocabulary_word': {}}, 'title': {}}
+    assert field_tree([]) == {}
+
+
+@pytest.mark.parametrize('value, fields, expected', [
+    (ART_DIRECTION, ['character_designs', 'art_style'], {'character_designs': ART_DIRECTION['character_designs'], 'art_style': 'watercolor'}),
+    (ART_DIRECTION, ['character_designs.name'], {'character_designs': [{'name': 'James'}]}),
+    (OUTLINE, ['pages.plot_point'], {'pages': [{'plot_point': 'A fire starts'}, {'plot_point': 'James drives'}]}),
+    (OUTLINE, ['title', 'pages.core_vocabulary', 'pages.plot_point'], {
+        'title': 'James the firefighter',
+        'pages': [{'core_vocabulary': 'fire', 'plot_point': 'A fire starts'}, {'core_vocabulary': 'truck', 'plot_point': 'James drives'}],
+    }),
+    # lists inside lists
+    (NESTED, ['chapters.pages.text'], {'chapters': [{'pages': [{'text': 'a'}, {'text': 'b'}]}, {'pages': []}]}),
+    (NESTED, ['chapters.name', 'chapters.pages.notes'], {'chapters': [{'name': 'one', 'pages': [{'notes': 'x'}, {'notes': 'y'}]}, {'name': 'two', 'pages': []}]}),
+    # a bare list
+    (OUTLINE['pages'], ['plot_point'], [{'plot_point': 'A fire starts'}, {'plot_point': 'James drives'}]),
+    # missing fields are skipped, a path into a string keeps the string
+    (ART_DIRECTION, ['art_style', 'mood'], {'art_style': 'watercolor'}),
+    (ART_DIRECTION, ['art_style.name'], {'art_style': 'watercolor'}),
+])
+def test_project_keeps_exactly_the_declared_paths(value, fields, expected):
+    assert project(value, field_tree(fields)) == expected
+
+
+def test_project_does_not_change_the_output():
+    before = json.dumps(OUTLINE)
+    project(OUTLINE, field_tree(['pages.plot_point']))
+    assert json.dumps(OUTLINE) == before
+
+
+def test_project_context():
+    outputs = [
+        task_output('develop_story_outline_task', OUTLINE),
+        task_output('write_story_content_task', {'pages': [{'core_vocabulary_word': 'fire', 'content': 'Hot!'}]}),
+        task_output('design_art_direction_task', ART_DIRECTION),
+        task_output('generate_html_pages_task', None, raw='<html></html>'),
+    ]
+    projected = project_context(outputs, {
+        'develop_story_outline_task': ['pages.plot_point'],
+        'write_story_content_task': [],
+        'design_art_direction_task': ['character_designs', 'art_style'],
+        'generate_html_pages_task': ['anything'],
+    })
+    # the upstream output with no field is dropped, the others keep their order
+    assert [output.name for output in projected] == ['develop_story_outline_task', 'design_art_direction_task', 'generate_html_pages_task']
+    assert projected[0].json_dict == {'pages': [{'plot_point': 'A fire starts'}, {'plot_point': 'James drives'}]}
+    assert json.loads(projected[0].raw) == projected[0].json_dict
+    assert projected[1].json_dict == {'character_designs': ART_DIRECTION['character_designs'], 'art_style': 'watercolor'}
+    assert json.loads(projected[1].raw) == projected[1].json_dict
+    # not JSON: passed whole
+    assert projected[2] is outputs[3]
+    # the outputs themselves are not changed
+    assert outputs[0].json_dict == OUTLINE
+    assert json.loads(outputs[0].raw) == OUTLINE
+
+
+def test_project_context_without_fields_keeps_everything():
+    outputs = [task_output('develop_story_outline_task', OUTLINE), task_output('design_art_direction_task', ART_DIRECTION)]
+    assert project_context(outputs, None) is outputs
+    assert project_context(outputs, {}) is outputs
+    # upstream tasks that are not listed are passed whole
+    projected = project_context(outputs, {'design_art_direction_task': ['art_style']})
+    assert projected[0] is outputs[0]
+    assert projected[1].json_dict == {'art_style': 'watercolor'}
+
+
+def test_empty_fields_drop_the_upstream_output():
+    outputs = [task_output('write_story_content_task', {'pages': []}), task_output('translate_content_task', {'pages': []})]
+    assert project_context(outputs, {'write_story_content_task': [], 'translate_content_task': []}) == []
@@ -0,0 +1,74 @@
+import json
+import os
+
+from crewai.tasks.output_format import OutputFormat
+from crewai.tasks.task_output import TaskOutput
+
+from v0 import clients
+from v0.bench.fakes import TASK_MARKERS, canned_outputs, patched
+from v0.crew import StoryBookCrew, generate_story_book
+from v0.image_batch import CACHED_BACKEND, build_prompt
+from v0.image_providers import FAL_DEV
+from v0.image_store import ImageStore
+
+
+OUTPUTS = canned_outputs(3)
+ART_DIRECTION = OUTPUTS['design_art_direction_task']
+
+
+def task_output(name: str) -> TaskOutput:
+    return TaskOutput(name=name, description='', expected_output='', agent='', raw=json.dumps(OUTPUTS[name]), json_dict=OUTPUTS[name], output_format=OutputFormat.JSON)
+
+
+def test_prompt_has_the_art_direction_and_only_the_characters_of_the_page():
+    prompt = build_prompt(
+        {'prompt': 'James climbs the ladder', 'character_names': ['James']},
+        ART_DIRECTION['character_designs'], ART_DIRECTION['color_palette'], ART_DIRECTION['art_style'],
+    )
+    assert prompt == (
+        'James climbs the ladder\n'
+        'color palette: warm red, sunny yellow, sky blue, soft cream, art style: soft watercolor, rounded shapes\n'
+        'James: small boy, red helmet, yellow coat'
+    )
+
+
+def test_direct_stage_generates_the_images_in_page_order(fake_backends):
+    fake_backends(pages=3)
+    story_book_crew = StoryBookCrew()
+    task = story_book_crew.generate_illustrations_task()
+    output = story_book_crew.generate_illustrations(task, [task_output('design_art_direction_task'), task_output('create_illustrations_task')])
+
+    assert output.name == 'generate_illustrations_task'
+    assert output.json_dict['image_size'] == '720x1280'
+    store = clients.image_store()
+    expected_paths = [
+        store.get(ImageStore.key(build_prompt(prompt, ART_DIRECTION['character_designs'], ART_DIRECTION['color_palette'], ART_DIRECTION['art_style']), FAL_DEV, {'width': 720, 'height': 1280}))
+        for prompt in OUTPUTS['create_illustrations_task']['illustration_prompts']
+    ]
+    assert output.json_dict['illustration_paths'] == expected_paths
+    assert all(os.path.exists(path) for path in expected_paths)
+    assert output.json_dict['backends'] == [FAL_DEV] * 3
+
+
+def test_the_llm_does_not_copy_the_prompts_into_a_tool_call(fake_backends, tmp_path):
+    fakes = fake_backends(pages=3)
+    llm = fakes['llm']
+    prompts = []
+    answer = llm._answer
+
+    def recording_answer(messages):
+        prompts.append('\n'.join(message['content'] for message in messages))
+        return answer(messages)
+
+    with patched(llm, '_answer', recording_answer):
+        result = generate_story_book('firefighters', '3-6', 'French', output_dir=str(tmp_path / 'book'), use_cache=False, image_format=None)
+        illustrations = next(output for output in result['tasks_output'] if output['name'] == 'generate_illustrations_task')
+        assert illustrations['json_dict']['backends'] == [FAL_DEV] * 3
+        assert not [prompt for prompt in prompts if TASK_MARKERS['generate_illustrations_task'] in prompt]
+        calls = fakes['fal'].calls
+
+        # the next book with the same prompts reuses the stored images
+        result = generate_story_book('firefighters', '3-6', 'French', output_dir=str(tmp_path / 'book_2'), use_cache=False, image_format=None)
+        illustrations = next(output for output in result['tasks_output'] if output['name'] == 'generate_illustrations_task')
+        assert illustrations['json_dict']['backends'] == [CACHED_BACKEND] * 3
+        assert fakes['fal'].calls == calls
@@ -0,0 +1,105 @@
+import threading
+
+import pytest
+
+from v0 import clients, image_providers
+from v0.bench.fakes import FakeBackendConfig, FakeBackendError, FakeThrottlingError, fake_fal, patched
+from v0.image_batch import BatchImageGenerationError, BatchImageGenerator
+from v0.image_providers import FAL_SCHNELL
+from v0.rate_limit import RateLimit, RateLimiter
+
+
+PROMPTS = [f'page {i}: a fire truck' for i in range(8)]
+
+
+class RecordingFal:
+    """Wraps the fake fal: records the prompt of every image and the jobs in flight, and fails or throttles the chosen prompts"""
+
+    def __init__(self, fal, failing: set[str] = frozenset(), throttled_once: set[str] = frozenset()):
+        self.fal = fal
+        self.failing = set(failing)
+        self.throttled_once = set(throttled_once)
+        self.prompts: dict[str, str] = {}  # url -> prompt
+        self.calls: list[str] = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+
+    def subscribe(self, application, arguments, **kwargs):
+        prompt = arguments['prompt']
+        with self._lock:
+            self.calls.append(prompt)
+            if prompt in self.throttled_once:
+                self.throttled_once.remove(prompt)
+                raise FakeThrottlingError(0.01)
+            if prompt in self.failing:
+                raise FakeBackendError('Injected image generation failure')
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            result = self.fal.subscribe(application, arguments, **kwargs)
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+        with self._lock:
+            self.prompts[result['images'][0]['url']] = prompt
+        return result
+
+
+@pytest.fixture
+def recording_fal():
+    """Start the fake fal with `recording_fal(**wrapper_options)`, yields the `RecordingFal` around it"""
+    config = FakeBackendConfig(image_queue_latency=0.0, image_latency=0.05)
+    # without the pacing of the shared fal limiter
+    with fake_fal(config) as fal, clients.override(**{'rate_limiter:fal': RateLimiter('fal', RateLimit())}):
+        wrappers = []
+
+        def start(**options):
+            wrappers.append(RecordingFal(fal, **options))
+            return wrappers[-1]
+
+        with patched(image_providers.fal_client, 'subscribe', lambda *args, **kwargs: wrappers[-1].subscribe(*args, **kwargs)):
+            yield start
+
+
+def generator(**options) -> BatchImageGenerator:
+    return BatchImageGenerator(model_name=FAL_SCHNELL, **{'retry_delay': 0.0, **options})
+
+
+def test_results_follow_the_order_of_the_prompts(recording_fal):
+    fal = recording_fal()
+    urls = generator(max_concurrency=4).generate_batch(PROMPTS)
+    assert [fal.prompts[url] for url in urls] == PROMPTS
+
+
+@pytest.mark.parametrize('max_concurrency', [1, 3])
+def test_jobs_in_flight_stay_under_the_concurrency_cap(recording_fal, max_concurrency):
+    fal = recording_fal()
+    generator(max_concurrency=max_concurrency).generate_batch(PROMPTS)
+    assert fal.max_in_flight == max_concurrency
+
+
+def test_throttled_jobs_are_retried(recording_fal):
+    fal = recording_fal(throttled_once={PROMPTS[1], PROMPTS[5]})
+    batch = generator(max_retries=0)
+    urls = batch.generate_batch(PROMPTS)
+    assert [fal.prompts[url] for url in urls] == PROMPTS
+    assert sorted(fal.calls) == sorted(PROMPTS + [PROMPTS[1], PROMPTS[5]])
+
+
+def test_failed_pages_are_reported_and_only_they_are_retried(recording_fal):
+    fal = recording_fal(failing={PROMPTS[2], PROMPTS[6]})
+    batch = generator(max_retries=1)
+    with pytest.raises(BatchImageGenerationError) as error:
+        batch.generate_batch(PROMPTS)
+    assert error.value.failed_indexes == [2, 6]
+    assert [fal.prompts.get(url) for url in error.value.results] == [None if i in (2, 6) else prompt for i, prompt in enumerate(PROMPTS)]
+    # max_retries extra attempts of the failed pages
+    assert fal.calls.count(PROMPTS[2]) == fal.calls.count(PROMPTS[6]) == 2
+
+    fal.failing.clear()
+    calls = len(fal.calls)
+    urls = batch.generate_batch(PROMPTS)
+    assert sorted(fal.calls[calls:]) == [PROMPTS[2], PROMPTS[6]]
+    assert urls[:2] == error.value.results[:2]
+    assert fal.prompts[urls[2]] == PROMPTS[2]
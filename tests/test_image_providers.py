@@ -0,0 +1,134 @@
+import threading
+import time
+
+import pytest
+
+from v0 import clients
+from v0.bench.fakes import FakeBackendConfig, fake_fal
+from v0.image_providers import FAL_DEV, FAL_SCHNELL
+from v0.image_store import ImageStore
+from v0.rate_limit import RateLimit, RateLimiter
+from v0.run_control import BookCancelled, RunControl
+
+
+HF = 'hf-inference'
+IMAGE_SIZE = {'width': 72, 'height': 128}
+
+
+@pytest.fixture
+def backends(tmp_path):
+    """Start the fake fal and Hugging Face backends with `backends(**config)`, yields the fake fal"""
+    stack = []
+
+    def start(**config):
+        config = FakeBackendConfig(**{'image_queue_latency': 0.0, 'image_latency': 0.05, 'hf_latency': 0.05, 'image_hedge_after': 0.3, 'image_timeout': 1.0, **config})
+        context = fake_fal(config)
+        fal = context.__enter__()
+        stack.append(context)
+        return fal
+
+    # without the pacing of the shared limiters, e.g. one Hugging Face request per second
+    unlimited = {f'rate_limiter:{provider}': RateLimiter(provider, RateLimit()) for provider in ('fal', 'hf')}
+    with clients.override(image_store=ImageStore(str(tmp_path / 'images')), **unlimited):
+        yield start
+    for context in reversed(stack):
+        context.__exit__(None, None, None)
+
+
+def wait_until(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert condition()
+
+
+def counts(fal, provider):
+    stats = fal.router.health()[provider]
+    return {key: stats[key] for key in ('requests', 'successes', 'failures', 'timeouts', 'wins')}
+
+
+def test_primary_answers_before_the_hedge(backends):
+    fal = backends()
+    url, provider = fal.router.generate('a fire truck', IMAGE_SIZE)
+    assert provider.name == FAL_DEV
+    assert url.startswith('http://127.0.0.1')
+    assert fal.hf.calls == 0
+    assert counts(fal, FAL_DEV) == {'requests': 1, 'successes': 1, 'failures': 0, 'timeouts': 0, 'wins': 1}
+
+
+def test_hedge_wins_and_the_primary_is_cancelled(backends):
+    # every fal dev job is stuck in the queue
+    fal = backends(image_slow_rate=1.0, image_slow_latency=10.0, image_hedge_after=0.1)
+    start = time.monotonic()
+    url, provider = fal.router.generate('a fire truck', IMAGE_SIZE)
+    assert time.monotonic() - start < 1.0
+    assert provider.name == HF
+    assert url.endswith('.png')
+    # the losing fal job is cancelled on fal's side, and counts neither as a success nor as a failure
+    assert fal.cancelled == 1
+    wait_until(lambda: not fal._jobs)
+    assert counts(fal, FAL_DEV) == {'requests': 1, 'successes': 0, 'failures': 0, 'timeouts': 0, 'wins': 0}
+    assert counts(fal, HF) == {'requests': 1, 'successes': 1, 'failures': 0, 'timeouts': 0, 'wins': 1}
+
+
+def test_failed_primary_is_hedged_right_away(backends):
+    fal = backends(image_hedge_after=10.0)
+    fal._failures.rate = 1.0
+    start = time.monotonic()
+    _, provider = fal.router.generate('a fire truck', IMAGE_SIZE)
+    assert time.monotonic() - start < 1.0
+    assert provider.name == HF
+    assert counts(fal, FAL_DEV)['failures'] == 1
+
+
+def test_fallback_after_timeout_ignores_late_answers(backends):
+    # fal dev is stuck and Hugging Face answers after the timeout: fal schnell produces the image
+    fal = backends(image_slow_rate=1.0, image_slow_latency=10.0, hf_latency=0.6, image_hedge_after=0.05, image_timeout=0.3)
+    url, provider = fal.router.generate('a fire truck', IMAGE_SIZE)
+    assert provider.name == FAL_SCHNELL
+    assert url.startswith('http://127.0.0.1')
+    assert fal.cancelled == 1
+    assert counts(fal, FAL_DEV)['timeouts'] == 1
+    assert counts(fal, FAL_SCHNELL)['wins'] == 1
+
+    # the Hugging Face answer arriving after the timeout is not counted a second time
+    wait_until(lambda: fal.hf.calls == 1)
+    time.sleep(0.6)
+    assert counts(fal, HF) == {'requests': 1, 'successes': 0, 'failures': 0, 'timeouts': 1, 'wins': 0}
+    assert counts(fal, FAL_DEV) == {'requests': 1, 'successes': 0, 'failures': 0, 'timeouts': 1, 'wins': 0}
+
+
+def test_every_backend_times_out(backends):
+    fal = backends(image_latency=10.0, hf_latency=10.0, image_hedge_after=0.05, image_timeout=0.2)
+    with pytest.raises(TimeoutError, match=FAL_SCHNELL):
+        fal.router.generate('a fire truck', IMAGE_SIZE)
+    # both fal jobs were cancelled instead of running to their end
+    assert fal.cancelled == 2
+    assert counts(fal, FAL_SCHNELL) == {'requests': 1, 'successes': 0, 'failures': 0, 'timeouts': 1, 'wins': 0}
+
+
+def test_unhealthy_primary_goes_behind_the_hedge(backends):
+    fal = backends(image_hedge_after=10.0)
+    fal._failures.rate = 1.0
+    for _ in range(3):
+        fal.router.generate('a fire truck', IMAGE_SIZE)
+    assert not fal.router.health()[FAL_DEV]['healthy']
+
+    fal._failures.rate = 0.0
+    calls = fal.calls
+    _, provider = fal.router.generate('a fire truck', IMAGE_SIZE)
+    assert provider.name == HF
+    assert fal.calls == calls
+
+
+def test_cancelling_the_book_stops_the_fallback(backends):
+    fal = backends(image_latency=10.0, hf_latency=10.0, image_hedge_after=0.05, image_timeout=0.2)
+    run_control = RunControl()
+    threading.Timer(0.4, run_control.cancel).start()
+    start = time.monotonic()
+    with pytest.raises(BookCancelled):
+        fal.router.generate('a fire truck', IMAGE_SIZE, run_control=run_control)
+    assert time.monotonic() - start < 1.5
+    # fal dev (given up on) and fal schnell (cancelled with the book)
+    wait_until(lambda: fal.cancelled == 2)
+    assert counts(fal, FAL_SCHNELL)['failures'] == 0
@@ -0,0 +1,102 @@
+import os
+
+import pytest
+
+from v0 import clients
+from v0.bench.fakes import FakeBackendConfig, PlaceholderImageServer, fake_fal, placeholder_png
+from v0.image_batch import CACHED_BACKEND, BatchImageGenerationError, BatchImageGenerator
+from v0.image_providers import FAL_SCHNELL
+from v0.image_store import ImageStore
+from v0.rate_limit import RateLimit, RateLimiter
+
+
+SIZE = {'width': 720, 'height': 1280}
+KEY = ImageStore.key('a fire truck', FAL_SCHNELL, SIZE)
+
+
+@pytest.fixture
+def server():
+    with PlaceholderImageServer() as server:
+        yield server
+
+
+def test_key_is_stable():
+    assert ImageStore.key('a fire truck', FAL_SCHNELL, {'height': 1280, 'width': 720}) == KEY
+
+
+@pytest.mark.parametrize('prompt, model_name, image_size', [
+    ('a red fire truck', FAL_SCHNELL, SIZE),
+    ('a fire truck', 'fal-ai/flux/dev', SIZE),
+    ('a fire truck', FAL_SCHNELL, {'width': 1280, 'height': 720}),
+])
+def test_key_changes_with_what_makes_the_image(prompt, model_name, image_size):
+    assert ImageStore.key(prompt, model_name, image_size) != KEY
+
+
+def test_put_and_get(tmp_path):
+    store = ImageStore(str(tmp_path))
+    assert store.get(KEY) is None
+    path = store.put_bytes(KEY, b'png', '.png')
+    assert path == os.path.join(str(tmp_path), KEY[:2], f'{KEY}.png')
+    assert store.get(KEY) == path
+    # no temporary files left to be matched later
+    assert os.listdir(os.path.dirname(path)) == [f'{KEY}.png']
+
+
+def test_download_once(tmp_path, server, monkeypatch):
+    store = ImageStore(str(tmp_path))
+    path = store.download(KEY, server.url('image_1'))
+    with open(path, 'rb') as f:
+        assert f.read() == placeholder_png()
+    assert path.endswith('.png')
+
+    monkeypatch.setattr(store.session, 'get', lambda *args, **kwargs: pytest.fail('downloaded again'))
+    assert store.download(KEY, server.url('image_2')) == path
+    assert store.download_async(KEY, server.url('image_3')).result() == path
+
+
+def test_local_files_are_copied_into_the_store(tmp_path):
+    source = tmp_path / 'hf.png'
+    source.write_bytes(b'png')
+    store = ImageStore(str(tmp_path / 'store'))
+    path = store.download(KEY, str(source))
+    assert path.startswith(str(tmp_path / 'store')) and open(path, 'rb').read() == b'png'
+
+
+def test_localize_puts_the_image_next_to_the_pages(tmp_path, server):
+    store = ImageStore(str(tmp_path / 'store'))
+    output_dir = tmp_path / 'book'
+    assert store.localize(server.url('image_1'), str(output_dir), 'page_1') == 'images/page_1.png'
+    assert (output_dir / 'images' / 'page_1.png').read_bytes() == placeholder_png()
+    # the remote image is kept in the store by its URL
+    assert store.get(ImageStore.url_key(server.url('image_1'))) is not None
+
+    # a new image of the page replaces the previous one
+    other = tmp_path / 'other.png'
+    other.write_bytes(b'other')
+    assert store.localize(str(other), str(output_dir), 'page_1') == 'images/page_1.png'
+    assert (output_dir / 'images' / 'page_1.png').read_bytes() == b'other'
+
+
+def test_identical_prompts_are_generated_once(tmp_path):
+    store = ImageStore(str(tmp_path))
+    prompts = ['a fire truck', 'a ladder', 'a fire truck']
+    with fake_fal(FakeBackendConfig(image_queue_latency=0.0, image_latency=0.01)) as fal, clients.override(**{'rate_limiter:fal': RateLimiter('fal', RateLimit())}):
+        paths = BatchImageGenerator(model_name=FAL_SCHNELL, image_store=store).generate_batch(prompts)
+        assert fal.calls == 2
+        assert paths[0] == paths[2] == store.get(ImageStore.key('a fire truck', FAL_SCHNELL, SIZE))
+
+        # the next books reuse the stored images, without any request
+        generator = BatchImageGenerator(model_name=FAL_SCHNELL, image_store=store)
+        assert generator.generate_batch(prompts) == paths
+        assert generator.generate_page('a ladder', 1) == paths[1]
+        assert fal.calls == 2
+        assert generator.backends == {'a fire truck': CACHED_BACKEND, 'a ladder': CACHED_BACKEND}
+
+
+def test_pages_sharing_a_failed_prompt_all_fail(tmp_path):
+    with fake_fal(FakeBackendConfig(image_queue_latency=0.0, image_latency=0.01, image_failure_rate=1.0)) as fal, clients.override(**{'rate_limiter:fal': RateLimiter('fal', RateLimit())}):
+        with pytest.raises(BatchImageGenerationError) as error:
+            BatchImageGenerator(model_name=FAL_SCHNELL, max_retries=0).generate_batch(['a fire truck', 'a ladder', 'a fire truck'])
+        assert fal.calls == 2
+        assert error.value.failed_indexes == [0, 1, 2]
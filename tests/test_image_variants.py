@@ -0,0 +1,93 @@
+import os
+
+import pytest
+from PIL import Image
+
+from v0 import clients
+from v0.crew import generate_story_book
+from v0.image_variants import VARIANTS, ImageVariantMaker, make_variants, srcset
+
+
+VARIANTS_OF_PAGE_1 = {
+    'thumb': {'path': 'images/page_1.thumb.webp', 'width': 180, 'height': 320},
+    'screen': {'path': 'images/page_1.screen.webp', 'width': 480, 'height': 853},
+    'print': {'path': 'images/page_1.print.webp', 'width': 720, 'height': 1280},
+}
+
+
+@pytest.fixture
+def output_dir(tmp_path):
+    os.makedirs(tmp_path / 'images')
+    Image.new('RGB', (720, 1280), (240, 200, 120)).save(tmp_path / 'images' / 'page_1.png')
+    return str(tmp_path)
+
+
+def test_make_variants(output_dir):
+    variants = make_variants('images/page_1.png', output_dir, 'page_1')
+    assert variants == VARIANTS_OF_PAGE_1
+    for variant in variants.values():
+        with Image.open(os.path.join(output_dir, variant['path'])) as image:
+            assert (image.format, image.width, image.height) == ('WEBP', variant['width'], variant['height'])
+
+
+def test_small_images_are_not_upscaled(tmp_path):
+    Image.new('RGBA', (100, 50)).save(tmp_path / 'small.png')
+    os.makedirs(tmp_path / 'images')
+    variants = make_variants('small.png', str(tmp_path), 'small')
+    assert {variant['width'] for variant in variants.values()} == {100}
+    assert list(variants) == list(VARIANTS)
+
+
+@pytest.mark.parametrize('relative_to, expected', [
+    ('', 'images/page_1.thumb.webp 180w, images/page_1.screen.webp 480w, images/page_1.print.webp 720w'),
+    ('french', '../images/page_1.thumb.webp 180w, ../images/page_1.screen.webp 480w, ../images/page_1.print.webp 720w'),
+])
+def test_srcset_lists_the_variants_by_width(relative_to, expected):
+    assert srcset(VARIANTS_OF_PAGE_1, relative_to) == expected
+
+
+def test_unknown_formats_are_refused():
+    with pytest.raises(ValueError, match='Unsupported image format'):
+        ImageVariantMaker.supported_format('gif')
+    assert ImageVariantMaker.supported_format('webp') == 'webp'
+
+
+def test_variants_are_made_in_the_worker_processes(output_dir):
+    maker = ImageVariantMaker(max_workers=1)
+    try:
+        assert maker.make('images/page_1.png', output_dir, 'page_1') == VARIANTS_OF_PAGE_1
+        assert not maker.broken
+    finally:
+        maker.shutdown()
+
+
+def test_broken_pool_falls_back_to_the_calling_thread(output_dir):
+    maker = ImageVariantMaker(max_workers=1)
+    try:
+        # a worker dying, like the ones running an unguarded main module
+        maker._get_executor().submit(os._exit, 1)
+        assert maker.make('images/page_1.png', output_dir, 'page_1') == VARIANTS_OF_PAGE_1
+        assert maker.broken
+        assert maker.make('images/page_1.png', output_dir, 'page_1') == VARIANTS_OF_PAGE_1
+        maker.start(wait=True)
+    finally:
+        maker.shutdown()
+
+
+def test_pages_use_the_variants(fake_backends, tmp_path):
+    fake_backends(pages=2)
+    output_dir = tmp_path / 'book'
+    maker = ImageVariantMaker(max_workers=1)
+    try:
+        with clients.override(image_variants=maker):
+            generate_story_book('firefighters', '3-6', 'French', output_dir=str(output_dir), use_cache=False, image_format='webp')
+    finally:
+        maker.shutdown()
+
+    for page in (1, 2):
+        with open(output_dir / f'page_{page}.html', 'r', encoding='utf-8') as f:
+            page_html = f.read()
+        # the fake template shows the illustration as a CSS background, an <img> would get the srcset (see test_render)
+        assert f"url('images/page_{page}.print.webp')" in page_html
+        for variant in VARIANTS:
+            assert os.path.exists(output_dir / 'images' / f'page_{page}.{variant}.webp')
@@ -0,0 +1,11 @@
+import pytest
+
+from v0.bench.import_time import IMPORT_BUDGETS, measure_import
+
+
+@pytest.mark.parametrize('module, budget', IMPORT_BUDGETS.items())
+def test_import_within_budget_without_side_effects(module, budget):
+    result = measure_import(module)
+    assert result['duration'] <= budget, f"{module} took {result['duration']:.3f}s, budget {budget:.2f}s"
+    assert result['clients'] == [], f'importing {module} created clients'
+    assert not result['crewai'], f'importing {module} imported crewai'
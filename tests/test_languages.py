@@ -0,0 +1,66 @@
+import os
+
+import pytest
+
+from v0.bench.fakes import patched
+from v0.crew import generate_story_book
+from v0.pipeline import language_directory, translation_task_name
+from v0.run_control import RunControl
+
+
+@pytest.mark.parametrize('language, directory', [
+    ('French', 'french'),
+    (' Simplified Chinese ', 'simplified_chinese'),
+    ('Português (Brasil)', 'português_brasil'),
+])
+def test_language_directory(language, directory):
+    assert language_directory(language) == directory
+
+
+def test_translation_task_name():
+    assert translation_task_name('Simplified Chinese') == 'translate_content_simplified_chinese_task'
+
+
+@pytest.mark.parametrize('streaming', [False, True])
+def test_one_book_in_several_languages(fake_backends, tmp_path, streaming):
+    fakes = fake_backends(pages=2)
+    llm = fakes['llm']
+    translation_prompts = []
+    answer = llm._answer
+
+    def recording_answer(messages):
+        prompt = '\n'.join(message['content'] for message in messages)
+        if 'Translate the text' in prompt:
+            translation_prompts.append(prompt)
+        return answer(messages)
+
+    events = []
+    output_dir = tmp_path / 'book'
+    with patched(llm, '_answer', recording_answer):
+        result = generate_story_book(
+            'firefighters', '3-6', ['French', 'Spanish', 'French'], output_dir=str(output_dir), use_cache=False,
+            image_format=None, streaming=streaming, run_control=RunControl(on_event=events.append),
+        )
+
+    names = [output['name'] for output in result['tasks_output']]
+    assert names.count('translate_content_task') == names.count('translate_content_spanish_task') == 1
+    assert 'translate_content_french_task' not in names
+    # every other task ran once for both languages
+    completed = [event['task'] for event in events if event['type'] == 'task_completed']
+    assert sorted(completed) == sorted(names)
+    # one translation per language (per page when streaming)
+    assert sum('"French"' in prompt for prompt in translation_prompts) == sum('"Spanish"' in prompt for prompt in translation_prompts) == (2 if streaming else 1)
+
+    for directory in ('french', 'spanish'):
+        for name in ('page_1.html', 'page_2.html', 'merged_book.html'):
+            assert (output_dir / directory / name).exists(), f'{directory}/{name}'
+        merged_book = (output_dir / directory / 'merged_book.html').read_text(encoding='utf-8')
+        # the pages have scripts, the merged book embeds them from the language directory
+        assert 'src="page_1.html"' in merged_book
+        page = (output_dir / directory / 'page_1.html').read_text(encoding='utf-8')
+        assert '../images/page_1.' in page
+    # the images and the narration are shared by the languages
+    assert sorted(os.listdir(output_dir / 'images')) == ['page_1.png', 'page_2.png']
+    assert (output_dir / 'audio.mp3').exists()
+    assert not (output_dir / 'page_1.html').exists()
+    assert sum(event['type'] == 'audio_ready' for event in events) == 1
@@ -0,0 +1,55 @@
+import pytest
+
+from v0.metrics import StageDurations, quantile, span_durations, stage_label, write_prometheus_textfile
+
+
+@pytest.mark.parametrize('span_name, stage', [
+    ('page_3', 'page_N'),
+    ('page_12', 'page_N'),
+    ('spanish/page_3', 'page_N'),
+    ('simplified_chinese/merged_book', 'merged_book'),
+    ('image_3', 'image_N'),
+    ('image_3_variants', 'image_N_variants'),
+    ('template', 'template'),
+    ('write_story_content_task', 'write_story_content_task'),
+])
+def test_stage_label(span_name, stage):
+    assert stage_label(span_name) == stage
+
+
+def test_span_durations_have_one_stage_per_step():
+    metrics = {'spans': [
+        {'kind': 'render', 'name': f'{language}/page_{i}', 'duration': 0.1}
+        for language in ('french', 'spanish') for i in range(1, 51)
+    ] + [{'kind': 'render', 'name': f'image_{i}_variants', 'duration': 0.2} for i in range(1, 51)]}
+    assert {(kind, stage) for kind, stage, _ in span_durations(metrics)} == {('render', 'page_N'), ('render', 'image_N_variants')}
+
+
+def test_stage_durations_are_bounded_with_exact_count_and_sum():
+    durations = StageDurations(max_samples=100, seed=0)
+    for _ in range(50):
+        durations.add(('render', 'page_N', float(i)) for i in range(1, 201))
+    summary = durations.stages[('render', 'page_N')]
+    assert summary.count == 50 * 200
+    assert summary.total == pytest.approx(50 * sum(range(1, 201)))
+    assert len(summary.samples) == 100
+
+
+def test_stage_durations_quantiles_follow_the_distribution():
+    durations = StageDurations(max_samples=500, seed=0)
+    durations.add(('crew', 'write_story_content_task', float(i)) for i in range(10_000))
+    values = sorted(durations.stages[('crew', 'write_story_content_task')].samples)
+    assert quantile(values, 0.5) == pytest.approx(5_000, rel=0.15)
+    assert quantile(values, 0.95) == pytest.approx(9_500, rel=0.05)
+
+
+def test_write_prometheus_textfile(tmp_path):
+    durations = StageDurations()
+    durations.add([('render', 'page_N', 1.0), ('render', 'page_N', 3.0), ('image', 'image_N', 2.0)])
+    path = tmp_path / 'baby_book.prom'
+    write_prometheus_textfile(durations, str(path))
+    lines = path.read_text().splitlines()
+    assert 'baby_book_stage_duration_seconds_count{kind="render",stage="page_N"} 2' in lines
+    assert 'baby_book_stage_duration_seconds_sum{kind="render",stage="page_N"} 4.0000' in lines
+    assert 'baby_book_stage_duration_seconds{kind="image",stage="image_N",quantile="0.5"} 2.0000' in lines
+    assert not (tmp_path / 'baby_book.prom.tmp').exists()
@@ -0,0 +1,84 @@
+import json
+
+import pytest
+
+from v0.output_repair import parse_model, repair_candidates
+from v0.pydantic_models import PageContents
+
+
+ONE = {'core_vocabulary_word': 'fire', 'content': 'The fire is hot.'}
+TWO = {'core_vocabulary_word': 'truck', 'content': 'The truck is red.'}
+PAGE_ONE = '{"core_vocabulary_word": "fire", "content": "The fire is hot."}'
+PAGE_TWO = '{"core_vocabulary_word": "truck", "content": "The truck is red."}'
+
+
+@pytest.mark.parametrize('answer, pages', [
+    # valid
+    (f'{{"pages": [{PAGE_ONE}, {PAGE_TWO}]}}', [ONE, TWO]),
+    # fenced, with text around it
+    (f'Here is the story:\n```json\n{{"pages": [{PAGE_ONE}]}}\n```\nEnjoy!', [ONE]),
+    (f'```\n{{"pages": [{PAGE_ONE}]}}\n```', [ONE]),
+    # text before and after the JSON
+    (f'Final Answer: {{"pages": [{PAGE_ONE}]}} Hope you like it.', [ONE]),
+    # unescaped newline and tab inside a string
+    ('{"pages": [{"core_vocabulary_word": "fire", "content": "The fire\nis\thot."}]}', [{'core_vocabulary_word': 'fire', 'content': 'The fire\nis\thot.'}]),
+    # unescaped double quotes inside a string
+    ('{"pages": [{"core_vocabulary_word": "fire", "content": "He said "hot" and ran."}]}', [{'core_vocabulary_word': 'fire', 'content': 'He said "hot" and ran.'}]),
+    # trailing commas
+    (f'{{"pages": [{PAGE_ONE}, {PAGE_TWO},],}}', [ONE, TWO]),
+    ('{"pages": [{"core_vocabulary_word": "fire", "content": "The fire is hot.",}]}', [ONE]),
+    # bare list, wrapped into the single list field
+    (f'[{PAGE_ONE}, {PAGE_TWO}]', [ONE, TWO]),
+    # truncated in the middle of a string: the half-written page is dropped
+    (f'{{"pages": [{PAGE_ONE}, {{"core_vocabulary_word": "truck", "content": "The tru', [ONE]),
+    # truncated in the middle of the array, between two pages
+    (f'{{"pages": [{PAGE_ONE}, {PAGE_TWO}', [ONE, TWO]),
+    (f'{{"pages": [{PAGE_ONE}, {PAGE_TWO},', [ONE, TWO]),
+    # truncated in the middle of an object: the incomplete page does not validate and is dropped
+    (f'{{"pages": [{PAGE_ONE}, {{"core_vocabulary_word": "truck"', [ONE]),
+    (f'{{"pages": [{PAGE_ONE}, {{"core_vocabulary_word": "truck", ', [ONE]),
+    # truncated right after an escape
+    (f'{{"pages": [{PAGE_ONE}, {{"core_vocabulary_word": "truck", "content": "The \\', [ONE]),
+    # a half-written string is only kept when nothing else is left
+    ('{"pages": [{"core_vocabulary_word": "fire", "content": "The fi', [{'core_vocabulary_word': 'fire', 'content': 'The fi'}]),
+])
+def test_parse_model_repairs(answer, pages):
+    result = parse_model(answer, PageContents)
+    assert result is not None
+    assert result.model_dump()['pages'] == pages
+
+
+@pytest.mark.parametrize('answer', [
+    '',
+    'I could not write the story.',
+    '```json\n```',
+    '{',
+    '[[[',
+    '{"pages": "not a list"}',
+    '{"pages": [{"content": "no vocabulary word"}]}',
+    '{"title": "no pages at all"}',
+])
+def test_parse_model_returns_none_when_unrepairable(answer):
+    assert parse_model(answer, PageContents) is None
+
+
+@pytest.mark.parametrize('answer, value', [
+    ('{"a": [1, 2, {"b": "c\nd"}],}', {'a': [1, 2, {'b': 'c\nd'}]}),
+    # cut in a string, in an object, in an array
+    ('{"a": [1, 2, {"b": "c', {'a': [1, 2]}),
+    ('{"a": [1, 2, {"b"', {'a': [1, 2]}),
+    ('[{"a": 1}, {"a": 2}, {"a": ', [{'a': 1}, {'a': 2}]),
+    ('{"a": 1, "b": [1, 2', {'a': 1, 'b': [1, 2]}),
+])
+def test_first_valid_candidate(answer, value):
+    for candidate in repair_candidates(answer):
+        try:
+            assert json.loads(candidate, strict=False) == value
+            return
+        except json.JSONDecodeError:
+            continue
+    pytest.fail(f'no candidate of {answer!r} is valid JSON')
+
+
+def test_repair_candidates_without_json():
+    assert list(repair_candidates('no json here')) == []
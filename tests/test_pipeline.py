@@ -0,0 +1,163 @@
+import json
+import os
+import time
+
+import pytest
+from crewai.tasks.output_format import OutputFormat
+from crewai.tasks.task_output import TaskOutput
+
+from v0 import clients
+from v0.bench.fakes import FakeElevenLabs, canned_outputs, placeholder_png
+from v0.checkpoint import CheckpointStore
+from v0.image_store import ImageStore
+from v0.metrics import MetricsRecorder
+from v0.pipeline import (
+    GENERATE_HTML_PAGES_TASK, GENERATE_ILLUSTRATIONS_TASK, PAGE_DEPENDENCIES_FILE, TRANSLATE_CONTENT_TASK, WRITE_STORY_CONTENT_TASK,
+    BookPostProcessor,
+)
+from v0.rate_limit import RateLimit, RateLimiter
+from v0.run_control import RunControl
+
+
+PAGES = 3
+OUTPUTS = canned_outputs(PAGES)
+TEMPLATE = '```html\n<html><body><img src="{{ illustration_path }}"><p>{{ english_text }}</p><p>{{ translated_text }}</p><b>{{ english_highlight_vocabulary_word }}</b><b>{{ translated_highlight_vocabulary_word }}</b></body></html>\n```'
+
+
+def task_output(name: str, json_dict: dict | None = None, raw: str | None = None) -> TaskOutput:
+    return TaskOutput(
+        name=name, description='', expected_output='', agent='',
+        raw=raw if raw is not None else json.dumps(json_dict), json_dict=json_dict,
+        output_format=OutputFormat.JSON if json_dict is not None else OutputFormat.RAW,
+    )
+
+
+@pytest.fixture
+def book(tmp_path):
+    """`book(**options)` makes a post-processor of `tmp_path/book` with the fake ElevenLabs, and the outputs of its tasks"""
+    images = []
+    for i in range(PAGES):
+        path = tmp_path / 'generated' / f'image_{i}.png'
+        path.parent.mkdir(exist_ok=True)
+        path.write_bytes(placeholder_png(rgb=(i, i, i)))
+        images.append(str(path))
+    outputs = {
+        WRITE_STORY_CONTENT_TASK: task_output(WRITE_STORY_CONTENT_TASK, OUTPUTS[WRITE_STORY_CONTENT_TASK]),
+        TRANSLATE_CONTENT_TASK: task_output(TRANSLATE_CONTENT_TASK, OUTPUTS[TRANSLATE_CONTENT_TASK]),
+        GENERATE_ILLUSTRATIONS_TASK: task_output(GENERATE_ILLUSTRATIONS_TASK, {'image_size': '72x128', 'illustration_paths': images}),
+        GENERATE_HTML_PAGES_TASK: task_output(GENERATE_HTML_PAGES_TASK, raw=TEMPLATE),
+    }
+    processors = []
+
+    def start(**options) -> tuple[BookPostProcessor, dict[str, TaskOutput], list[dict]]:
+        events = []
+        options = {'run_control': RunControl(on_event=events.append), **options}
+        processor = BookPostProcessor(str(tmp_path / 'book'), FakeElevenLabs(latency=0.0, chunk_latency=0.0), ImageStore(str(tmp_path / 'store')), **options)
+        processors.append(processor)
+        return processor, outputs, events
+
+    with clients.override(**{'rate_limiter:elevenlabs': RateLimiter('elevenlabs', RateLimit())}):
+        yield start
+    for processor in processors:
+        processor._executor.shutdown(wait=True)
+
+
+def wait_for(events, event_type, count=1, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while sum(event['type'] == event_type for event in events) < count and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert sum(event['type'] == event_type for event in events) >= count
+
+
+def test_book_files(book, tmp_path):
+    processor, outputs, events = book()
+    for output in outputs.values():
+        processor.on_task_complete(output)
+    processor.finish()
+
+    output_dir = tmp_path / 'book'
+    for name in ('audio.mp3', 'audio_manifest.json', 'template.html', 'merged_book.html', PAGE_DEPENDENCIES_FILE):
+        assert (output_dir / name).exists(), name
+    for i in range(PAGES):
+        assert (output_dir / 'images' / f'page_{i+1}.png').read_bytes() == placeholder_png(rgb=(i, i, i))
+        page_html = (output_dir / f'page_{i+1}.html').read_text(encoding='utf-8')
+        assert f'<img src="images/page_{i+1}.png">' in page_html
+        assert OUTPUTS[WRITE_STORY_CONTENT_TASK]['pages'][i]['content'] in page_html
+        assert OUTPUTS[TRANSLATE_CONTENT_TASK]['pages'][i]['content'] in page_html
+    merged_book = (output_dir / 'merged_book.html').read_text(encoding='utf-8')
+    assert [f'id="page-{i+1}"' in merged_book for i in range(PAGES)] == [True] * PAGES
+    assert sorted(event['page'] for event in events if event['type'] == 'page_rendered') == [1, 2, 3]
+
+
+def test_stages_start_as_soon_as_their_inputs_exist(book):
+    processor, outputs, events = book()
+    # the narration only needs the story text
+    processor.on_task_complete(outputs[WRITE_STORY_CONTENT_TASK])
+    wait_for(events, 'audio_ready')
+    # the images only need the illustrations
+    processor.on_task_complete(outputs[GENERATE_ILLUSTRATIONS_TASK])
+    wait_for(events, 'page_image', PAGES)
+    processor.on_task_complete(outputs[TRANSLATE_CONTENT_TASK])
+    time.sleep(0.1)
+    # the pages wait for the template
+    assert not [event for event in events if event['type'] == 'page_rendered']
+    processor.on_task_complete(outputs[GENERATE_HTML_PAGES_TASK])
+    wait_for(events, 'page_rendered', PAGES)
+    processor.finish()
+
+
+def test_finish_needs_every_task(book):
+    processor, outputs, _ = book()
+    processor.on_task_complete(outputs[WRITE_STORY_CONTENT_TASK])
+    with pytest.raises(ValueError, match=TRANSLATE_CONTENT_TASK):
+        processor.finish()
+    processor._executor.shutdown(wait=True)
+
+
+def test_streamed_images_are_replaced(book, tmp_path):
+    processor, outputs, events = book()
+    replaced = tmp_path / 'generated' / 'replaced.png'
+    replaced.write_bytes(placeholder_png(rgb=(9, 9, 9)))
+    # the streaming mode reports an image, then the final output of the task has another one
+    processor.on_page_image(0, str(replaced))
+    for output in outputs.values():
+        processor.on_task_complete(output)
+    processor.finish()
+    assert (tmp_path / 'book' / 'images' / 'page_1.png').read_bytes() == placeholder_png(rgb=(0, 0, 0))
+
+
+def test_resumed_book_skips_the_unchanged_artifacts(book, tmp_path):
+    processor, outputs, _ = book(checkpoint=CheckpointStore(str(tmp_path / 'book')))
+    for output in outputs.values():
+        processor.on_task_complete(output)
+    processor.finish()
+
+    # the second page has a new translation
+    translation = json.loads(json.dumps(OUTPUTS[TRANSLATE_CONTENT_TASK]))
+    translation['pages'][1]['content'] = 'Une nouvelle traduction'
+    metrics = MetricsRecorder()
+    processor, outputs, _ = book(checkpoint=CheckpointStore(str(tmp_path / 'book')), metrics=metrics)
+    for output in {**outputs, TRANSLATE_CONTENT_TASK: task_output(TRANSLATE_CONTENT_TASK, translation)}.values():
+        processor.on_task_complete(output)
+    processor.finish()
+
+    made = sorted(span.name for span in metrics.spans if span.attributes.get('cached') is False)
+    assert made == ['page_2']
+    assert 'Une nouvelle traduction' in (tmp_path / 'book' / 'page_2.html').read_text(encoding='utf-8')
+
+
+def test_page_dependencies(book, tmp_path):
+    processor, outputs, _ = book(translations={TRANSLATE_CONTENT_TASK: 'french'})
+    for output in outputs.values():
+        processor.on_task_complete(output)
+    processor.finish()
+
+    with open(tmp_path / 'book' / PAGE_DEPENDENCIES_FILE, 'r', encoding='utf-8') as f:
+        dependencies = json.load(f)
+    assert dependencies['translations'] == {TRANSLATE_CONTENT_TASK: 'french'}
+    page = dependencies['pages'][1]
+    assert sorted(page['inputs']) == sorted([WRITE_STORY_CONTENT_TASK, GENERATE_ILLUSTRATIONS_TASK, TRANSLATE_CONTENT_TASK])
+    assert page['derived'][TRANSLATE_CONTENT_TASK] == ['french/page_2', 'french/merged_book']
+    assert os.path.exists(tmp_path / 'book' / 'french' / 'page_2.html')
+    # the pages of a language directory use the shared images
+    assert '<img src="../images/page_2.png">' in (tmp_path / 'book' / 'french' / 'page_2.html').read_text(encoding='utf-8')
@@ -0,0 +1,180 @@
+import threading
+import time
+from email.utils import formatdate
+
+import pytest
+
+from v0 import rate_limit
+from v0.rate_limit import DEFAULT_RATE_LIMITS, RateLimit, RateLimiter, is_throttling, rate_limit_for, retry_after
+
+
+class FakeClock:
+    """Stands for the `time` module of v0.rate_limit, `sleep` only moves the clock"""
+
+    def __init__(self, now: float = 1_700_000_000.0):
+        self.now = now
+
+    def time(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float) -> None:
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(rate_limit, 'time', clock)
+    return clock
+
+
+class HTTPError(Exception):
+    def __init__(self, message='', status_code=None, headers=None):
+        super().__init__(message)
+        self.response = type('Response', (), {'status_code': status_code, 'headers': headers or {}})()
+
+
+@pytest.fixture(params=['memory', 'file'])
+def state_dir(request, tmp_path):
+    return str(tmp_path) if request.param == 'file' else None
+
+
+def test_requests_are_spaced(clock, state_dir):
+    limiter = RateLimiter('fal', RateLimit(requests_per_second=2), state_dir)
+    assert [limiter._reserve(0) for _ in range(4)] == pytest.approx([0.0, 0.5, 1.0, 1.5])
+    clock.sleep(10)
+    # the budget does not pile up while idle
+    assert [limiter._reserve(0) for _ in range(2)] == pytest.approx([0.0, 0.5])
+
+
+def test_token_budget_is_a_bucket_of_one_minute(clock, state_dir):
+    # 10 tokens per second, two calls of 30s worth of tokens fit in the minute
+    limiter = RateLimiter('bedrock', RateLimit(tokens_per_minute=600), state_dir)
+    assert [limiter._reserve(300) for _ in range(4)] == pytest.approx([0.0, 0.0, 30.0, 60.0])
+    clock.sleep(60)
+    assert limiter._reserve(300) == pytest.approx(30.0)
+
+
+def test_recorded_tokens_correct_the_budget(clock, state_dir):
+    limiter = RateLimiter('bedrock', RateLimit(tokens_per_minute=600), state_dir)
+    assert limiter._reserve(600) == 0.0
+    limiter.record_tokens(-300)
+    assert limiter._reserve(300) == pytest.approx(0.0)
+    assert limiter._reserve(300) == pytest.approx(30.0)
+
+
+def test_throttling_blocks_and_halves_the_rate(clock, state_dir):
+    limiter = RateLimiter('fal', RateLimit(requests_per_second=2), state_dir)
+    limiter._throttled(5.0)
+    assert limiter._reserve(0) == pytest.approx(5.0)
+    # half the rate: one request per second
+    assert limiter._reserve(0) == pytest.approx(6.0)
+    limiter._succeeded()
+    clock.sleep(100)
+    assert limiter._reserve(0) == 0.0
+    assert limiter._reserve(0) == pytest.approx(1 / (2 * 0.55))
+
+
+def test_backoff_without_retry_after_doubles(clock, state_dir):
+    limiter = RateLimiter('fal', RateLimit(), state_dir, base_delay=1.0, max_delay=3.0)
+    delays = []
+    for _ in range(4):
+        limiter._throttled(None)
+        delays.append(limiter._reserve(0))
+        clock.sleep(delays[-1])
+    assert 0.5 <= delays[0] <= 1.0
+    assert 1.0 <= delays[1] <= 2.0
+    assert 1.5 <= delays[2] <= 3.0
+    assert 1.5 <= delays[3] <= 3.0
+
+
+def test_call_retries_throttled_requests(clock, state_dir):
+    limiter = RateLimiter('fal', RateLimit(), state_dir)
+    attempts = []
+
+    def request():
+        attempts.append(clock.time())
+        if len(attempts) < 3:
+            raise HTTPError('slow down', 429, {'Retry-After': '2'})
+        return 'ok'
+
+    assert limiter.call(request) == 'ok'
+    assert [attempt - attempts[0] for attempt in attempts] == pytest.approx([0.0, 2.0, 4.0])
+    with pytest.raises(ValueError):
+        limiter.call(lambda: (_ for _ in ()).throw(ValueError('not throttling')))
+
+
+def test_file_state_is_shared_by_limiters(clock, tmp_path):
+    # two processes of the host are two limiters on the same directory
+    first = RateLimiter('fal', RateLimit(requests_per_second=1), str(tmp_path))
+    second = RateLimiter('fal', RateLimit(requests_per_second=1), str(tmp_path))
+    assert [first._reserve(0), second._reserve(0), first._reserve(0)] == pytest.approx([0.0, 1.0, 2.0])
+    second._throttled(10.0)
+    assert first._reserve(0) >= 10.0
+
+
+def test_file_slots_cap_the_jobs_across_limiters(tmp_path):
+    first = RateLimiter('hf', RateLimit(max_concurrency=1), str(tmp_path))
+    second = RateLimiter('hf', RateLimit(max_concurrency=1), str(tmp_path))
+    release = threading.Event()
+    entered = threading.Event()
+
+    def hold():
+        with first.acquire():
+            entered.set()
+            release.wait(5)
+
+    holder = threading.Thread(target=hold)
+    holder.start()
+    entered.wait(5)
+    started = time.perf_counter()
+    threading.Timer(0.3, release.set).start()
+    with second.acquire():
+        waited = time.perf_counter() - started
+    holder.join()
+    assert waited >= 0.25
+
+
+def test_rate_limit_from_environment(monkeypatch):
+    monkeypatch.delenv('RATE_LIMIT_FAL', raising=False)
+    assert rate_limit_for('fal') == DEFAULT_RATE_LIMITS['fal']
+    monkeypatch.setenv('RATE_LIMIT_FAL', 'requests_per_second=2.5, max_concurrency=none')
+    assert rate_limit_for('fal') == RateLimit(requests_per_second=2.5, tokens_per_minute=None, max_concurrency=None)
+    monkeypatch.setenv('RATE_LIMIT_BEDROCK', 'tokens_per_minute=1000')
+    assert rate_limit_for('bedrock') == RateLimit(requests_per_second=1.0, tokens_per_minute=1000, max_concurrency=8)
+    monkeypatch.setenv('RATE_LIMIT_OTHER', 'max_concurrency=3')
+    assert rate_limit_for('other') == RateLimit(max_concurrency=3)
+    assert rate_limit_for('unknown') == RateLimit()
+
+
+@pytest.mark.parametrize('headers, seconds', [
+    ({'Retry-After': '3'}, 3.0),
+    ({'retry-after': '1.5'}, 1.5),
+    ({'Retry-After': '-4'}, 0.0),
+    ({'Retry-After': formatdate(1_700_000_030, usegmt=True)}, 30.0),
+    ({'Retry-After': formatdate(1_699_999_990, usegmt=True)}, 0.0),
+    ({'Retry-After': 'soon'}, None),
+    ({}, None),
+])
+def test_retry_after(clock, headers, seconds):
+    assert retry_after(HTTPError(headers=headers)) == (None if seconds is None else pytest.approx(seconds))
+
+
+def test_retry_after_on_the_error_itself():
+    error = Exception()
+    error.headers = {'Retry-After': '7'}
+    assert retry_after(error) == 7.0
+    assert retry_after(ValueError('no headers')) is None
+
+
+@pytest.mark.parametrize('error, throttling', [
+    (HTTPError(status_code=429), True),
+    (HTTPError(status_code=529), True),
+    (HTTPError('Internal error', status_code=500), False),
+    (type('ThrottlingException', (Exception,), {})('slow'), True),
+    (Exception('Too Many Requests'), True),
+    (Exception('litellm.RateLimitError: rate limit reached'), True),
+    (ValueError('invalid prompt'), False),
+])
+def test_is_throttling(error, throttling):
+    assert is_throttling(error) is throttling
@@ -0,0 +1,141 @@
+import json
+import os
+
+import pytest
+
+from v0.bench.fakes import TASK_MARKERS
+from v0.crew import generate_story_book
+from v0.pipeline import PAGE_DEPENDENCIES_FILE, translation_task_name
+from v0.regenerate import OVERRIDE_BACKEND, regenerate_page
+
+
+@pytest.fixture
+def book(fake_backends, tmp_path):
+    """`book(languages)` makes a 3-page book in `tmp_path/book`, and returns its directory, the fakes and the prompts sent to the LLM since"""
+
+    def make(languages='French') -> tuple[str, dict, list[str]]:
+        fakes = fake_backends(pages=3)
+        output_dir = str(tmp_path / 'book')
+        generate_story_book('firefighters', '3-6', languages, output_dir=output_dir, use_cache=False, image_format=None)
+        prompts = []
+        answer = fakes['llm']._answer
+
+        def recording_answer(messages):
+            prompts.append('\n'.join(message['content'] for message in messages))
+            return answer(messages)
+
+        fakes['llm']._answer = recording_answer
+        return output_dir, fakes, prompts
+
+    return make
+
+
+def task_output(output_dir: str, name: str) -> dict:
+    with open(os.path.join(output_dir, 'result.json'), 'r', encoding='utf-8') as f:
+        return next(output for output in json.load(f)['tasks_output'] if output['name'] == name)['json_dict']
+
+
+def read(output_dir: str, name: str) -> str:
+    with open(os.path.join(output_dir, name), 'r', encoding='utf-8') as f:
+        return f.read()
+
+
+def test_unchanged_page_makes_nothing(book):
+    output_dir, fakes, prompts = book()
+    characters, calls = fakes['tts'].characters, fakes['fal'].calls
+    assert regenerate_page(output_dir, 1) == {'tasks': [], 'artifacts': []}
+    assert (prompts, fakes['tts'].characters, fakes['fal'].calls) == ([], characters, calls)
+
+
+def test_new_text_is_translated_and_narrated_again(book):
+    output_dir, fakes, prompts = book()
+    characters, calls = fakes['tts'].characters, fakes['fal'].calls
+    content = 'James climbs the ladder to the window.'
+    assert regenerate_page(output_dir, 1, content=content) == {
+        'tasks': ['write_story_content_task', 'translate_content_task'],
+        'artifacts': ['audio', 'page_2', 'merged_book'],
+    }
+    # only the page is translated again, and only its narration segment is new
+    translations = [prompt for prompt in prompts if TASK_MARKERS['translate_content_task'] in prompt]
+    assert len(prompts) == len(translations) == 1
+    assert content in translations[0]
+    assert fakes['tts'].characters == characters + len(content)
+    assert fakes['fal'].calls == calls
+
+    assert task_output(output_dir, 'write_story_content_task')['pages'][1]['content'] == content
+    assert content in read(output_dir, 'page_2.html')
+    assert content not in read(output_dir, 'page_1.html')
+    assert os.path.exists(os.path.join(output_dir, 'metrics_page_2.json'))
+
+
+def test_new_scene_is_drawn_again(book):
+    output_dir, fakes, prompts = book()
+    characters, calls = fakes['tts'].characters, fakes['fal'].calls
+    paths = task_output(output_dir, 'generate_illustrations_task')['illustration_paths']
+    assert regenerate_page(output_dir, 1, illustration_prompt='James waves from the fire truck') == {
+        'tasks': ['create_illustrations_task', 'generate_illustrations_task'],
+        'artifacts': ['image_2', 'image_2_variants', 'page_2', 'merged_book'],
+    }
+    # no LLM call and no narration, one new image
+    assert (prompts, fakes['tts'].characters, fakes['fal'].calls) == ([], characters, calls + 1)
+    assert task_output(output_dir, 'create_illustrations_task')['illustration_prompts'][1]['prompt'] == 'James waves from the fire truck'
+    new_paths = task_output(output_dir, 'generate_illustrations_task')['illustration_paths']
+    assert [new_paths[0], new_paths[2]] == [paths[0], paths[2]]
+    assert new_paths[1] != paths[1] and os.path.exists(new_paths[1])
+
+
+def test_given_illustration_is_used_as_it_is(book, tmp_path):
+    output_dir, fakes, prompts = book()
+    calls = fakes['fal'].calls
+    path = tmp_path / 'drawing.png'
+    path.write_bytes(b'\x89PNG drawing')
+    assert regenerate_page(output_dir, 2, illustration_path=str(path)) == {
+        'tasks': ['generate_illustrations_task'],
+        'artifacts': ['image_3', 'image_3_variants', 'page_3', 'merged_book'],
+    }
+    assert (prompts, fakes['fal'].calls) == ([], calls)
+    illustrations = task_output(output_dir, 'generate_illustrations_task')
+    assert illustrations['illustration_paths'][2] == str(path)
+    assert illustrations['backends'][2] == OVERRIDE_BACKEND
+    assert (tmp_path / 'book' / 'images' / 'page_3.png').read_bytes() == b'\x89PNG drawing'
+
+
+def test_given_translation_only_renders_the_page_again(book):
+    output_dir, fakes, prompts = book()
+    characters = fakes['tts'].characters
+    assert regenerate_page(output_dir, 0, translations={'French': {'content': 'Jacques monte.', 'core_vocabulary_word': 'monter'}}) == {
+        'tasks': ['translate_content_task'],
+        'artifacts': ['page_1', 'merged_book'],
+    }
+    assert (prompts, fakes['tts'].characters) == ([], characters)
+    assert 'Jacques monte.' in read(output_dir, 'page_1.html')
+
+
+def test_every_language_is_translated_again(book):
+    output_dir, _, prompts = book(['French', 'Spanish'])
+    spanish_task = translation_task_name('Spanish')
+    assert regenerate_page(output_dir, 0, content='James climbs the ladder.') == {
+        'tasks': ['write_story_content_task', 'translate_content_task', spanish_task],
+        'artifacts': ['audio', 'french/page_1', 'spanish/page_1', 'french/merged_book', 'spanish/merged_book'],
+    }
+    translations = [prompt for prompt in prompts if TASK_MARKERS['translate_content_task'] in prompt]
+    assert sum('"French"' in prompt for prompt in translations) == sum('"Spanish"' in prompt for prompt in translations) == 1
+    for directory in ('french', 'spanish'):
+        assert 'James climbs the ladder.' in read(output_dir, f'{directory}/page_1.html')
+
+    # a Spanish translation given by the editor leaves the French pages alone
+    assert regenerate_page(output_dir, 0, translations={'Spanish': {'content': 'Jaime sube.', 'core_vocabulary_word': 'subir'}}) == {
+        'tasks': [spanish_task],
+        'artifacts': ['spanish/page_1', 'spanish/merged_book'],
+    }
+
+
+def test_invalid_requests(book, tmp_path):
+    output_dir, _, _ = book()
+    with pytest.raises(ValueError, match='no page index 3'):
+        regenerate_page(output_dir, 3, content='...')
+    with pytest.raises(ValueError, match='no Spanish translation'):
+        regenerate_page(output_dir, 0, translations={'Spanish': {'content': '...', 'core_vocabulary_word': '...'}})
+    os.remove(os.path.join(output_dir, PAGE_DEPENDENCIES_FILE))
+    with pytest.raises(ValueError, match=PAGE_DEPENDENCIES_FILE):
+        regenerate_page(output_dir, 0, content='...')
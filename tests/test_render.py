@@ -0,0 +1,79 @@
+import re
+
+from v0.bench.fakes import PAGE_TEMPLATE
+from v0.render import compile_template, page_data, render_page, responsive_images, scope_page_css, write_merged_book
+
+
+STATIC_TEMPLATE = """<!DOCTYPE html>
+<html>
+<head><style>body { background: #fff; } .highlight { color: red; }</style></head>
+<body class="story">
+<img src="{{ illustration_path }}" alt="">
+<p id="text">{{ english_text }} <span class="highlight">{{ english_highlight_vocabulary_word }}</span></p>
+</body>
+</html>"""
+
+# a page script finding its elements by id, e.g. to highlight the vocabulary word
+SCRIPT_TEMPLATE = STATIC_TEMPLATE.replace('</body>', "<script>document.getElementById('text').classList.add('ready');</script>\n</body>")
+
+
+def render_book(tmp_path, html_template, pages=3):
+    template = compile_template(html_template)
+    page_htmls = [
+        render_page(template, page_data(f'images/page_{i+1}.png', {'content': f'Page {i+1}', 'core_vocabulary_word': 'fire'}, {'content': f'第{i+1}页', 'core_vocabulary_word': '火'}), str(tmp_path), i)
+        for i in range(pages)
+    ]
+    with open(write_merged_book(page_htmls, str(tmp_path)), encoding='utf-8') as f:
+        return f.read()
+
+
+def test_pages_are_rendered_from_the_compiled_template(tmp_path):
+    render_book(tmp_path, STATIC_TEMPLATE)
+    for i in range(3):
+        page = (tmp_path / f'page_{i+1}.html').read_text(encoding='utf-8')
+        assert f'Page {i+1}' in page
+        assert f'images/page_{i+1}.png' in page
+
+
+def test_merged_book_inlines_pages_without_scripts(tmp_path):
+    merged = render_book(tmp_path, STATIC_TEMPLATE)
+    assert '<iframe' not in merged
+    # the CSS of the template is included once, its body rules apply to every page section
+    assert merged.count('.highlight { color: red; }') == 1
+    assert '.book-page { background: #fff; }' in merged
+    assert len(re.findall(r'<section class="book-page story" id="page-\d">', merged)) == 3
+    # only the images after the first page are lazy-loaded
+    assert '<img src="images/page_1.png" alt="">' in merged
+    assert '<img src="images/page_2.png" alt="" loading="lazy" decoding="async">' in merged
+
+
+def test_merged_book_embeds_pages_with_scripts(tmp_path):
+    merged = render_book(tmp_path, SCRIPT_TEMPLATE)
+    # every page runs its script in its own document, where its ids are unique
+    assert '<script' not in merged
+    assert merged.count('id="text"') == 0
+    assert '<iframe src="page_1.html" title="Page 1"></iframe>' in merged
+    assert '<iframe src="page_3.html" title="Page 3" loading="lazy"></iframe>' in merged
+    page = (tmp_path / 'page_2.html').read_text(encoding='utf-8')
+    assert page.count('id="text"') == 1
+    assert "getElementById('text')" in page
+
+
+def test_fake_template_pages_keep_their_script(tmp_path):
+    merged = render_book(tmp_path, PAGE_TEMPLATE, pages=2)
+    assert merged.count('<iframe') == 2
+    assert 'DOMContentLoaded' not in merged
+
+
+def test_scope_page_css():
+    css = '<style>html, body { margin: 0 } body.story p { color: #123 } .body { x: 1 } #body-id { y: 2 }</style>'
+    assert scope_page_css(css) == '<style>.book-page, .book-page { margin: 0 } .book-page.story p { color: #123 } .body { x: 1 } #body-id { y: 2 }</style>'
+
+
+def test_responsive_images():
+    html = '<img src="images/page_1.webp" alt=""><img src="images/other.png"><img src="images/page_1.webp" srcset="x.webp 1x">'
+    srcset = 'images/page_1_screen.webp 720w, images/page_1.webp 1440w'
+    result = responsive_images(html, 'images/page_1.webp', srcset)
+    assert result.count('srcset=') == 2
+    assert f'<img src="images/page_1.webp" alt="" srcset="{srcset}" sizes="(max-width: 21cm) 100vw, 21cm">' in result
+    assert '<img src="images/other.png">' in result
@@ -0,0 +1,205 @@
+import json
+import threading
+import time
+
+import pytest
+from crewai import LLM, Agent, Crew, Task
+
+from v0.crew import StoryBookCrew
+from v0.metrics import MetricsRecorder
+from v0.pydantic_models import PageContent
+from v0.run_control import BookCancelled, RunControl
+from v0.scheduler import MODEL_FALLBACKS, ParallelTaskScheduler, build_task_graph, build_task_output, find_critical_path
+
+
+# outline -> translation ---------------> book
+#         -> art_direction -> prompts --/
+DURATIONS = {'outline': 0.1, 'translation': 0.3, 'art_direction': 0.1, 'prompts': 0.1, 'book': 0.05}
+PAGE = {'core_vocabulary_word': 'fire', 'content': 'The fire is hot.'}
+CONTEXT = {'outline': [], 'translation': ['outline'], 'art_direction': ['outline'], 'prompts': ['art_direction'], 'book': ['translation', 'prompts']}
+
+
+def make_agent() -> Agent:
+    return Agent(role='Writer', goal='Write a book', backstory='A children book author', llm=LLM(model='openai/gpt-4o-mini'))
+
+
+def make_tasks(context: dict[str, list[str]] = CONTEXT, agent: Agent | None = None) -> list[Task]:
+    agent = agent or make_agent()
+    tasks: dict[str, Task] = {}
+    for name, dependencies in context.items():
+        tasks[name] = Task(name=name, description=f'Write the {name}', expected_output=name, agent=agent, context=[tasks[d] for d in dependencies])
+    return list(tasks.values())
+
+
+class Stages:
+    """Direct stages sleeping for the duration of their task, recording when they ran and what context they got"""
+
+    def __init__(self, durations: dict[str, float] = DURATIONS):
+        self.durations = durations
+        self.runs: dict[str, tuple[float, float]] = {}
+        self.contexts: dict[str, list[str]] = {}
+        self._lock = threading.Lock()
+
+    def stage(self, task: Task, context_outputs) -> object:
+        start = time.perf_counter()
+        time.sleep(self.durations[task.name])
+        with self._lock:
+            self.runs[task.name] = (start, time.perf_counter())
+            self.contexts[task.name] = [output.raw for output in context_outputs]
+        return build_task_output(task, f'{task.name} done')
+
+    def scheduler(self, tasks: list[Task], **options) -> ParallelTaskScheduler:
+        agent = tasks[0].agent
+        crew = Crew(agents=[agent], tasks=tasks)
+        return ParallelTaskScheduler(crew, direct_stages={task.name: self.stage for task in tasks}, **options)
+
+
+def test_graph_follows_the_declared_context():
+    assert build_task_graph(make_tasks()) == CONTEXT
+
+
+@pytest.mark.parametrize('change, error', [
+    ({'book': ['translation', 'translation_2']}, 'not part of the crew'),
+    ({'outline': ['book']}, 'cycle'),
+])
+def test_invalid_graphs_are_rejected(change, error):
+    tasks = make_tasks()
+    by_name = {task.name: task for task in tasks}
+    for name, dependencies in change.items():
+        by_name[name].context = [by_name.get(d) or Task(name=d, description=d, expected_output=d, agent=tasks[0].agent) for d in dependencies]
+    with pytest.raises(ValueError, match=error):
+        build_task_graph(tasks)
+
+
+def test_tasks_need_unique_names():
+    tasks = make_tasks()
+    tasks[1].name = tasks[0].name
+    with pytest.raises(ValueError, match='unique name'):
+        build_task_graph(tasks)
+
+
+@pytest.mark.parametrize('durations, path', [
+    (DURATIONS, ['outline', 'translation', 'book']),
+    ({**DURATIONS, 'prompts': 0.5}, ['outline', 'art_direction', 'prompts', 'book']),
+])
+def test_critical_path_is_the_longest_chain(durations, path):
+    assert find_critical_path(CONTEXT, durations) == path
+
+
+def test_critical_path_of_an_empty_graph():
+    assert find_critical_path({}, {}) == []
+
+
+def test_independent_branches_run_in_parallel():
+    stages = Stages()
+    scheduler = stages.scheduler(make_tasks())
+    result = scheduler.kickoff({})
+
+    assert [output.raw for output in result.tasks_output] == [f'{name} done' for name in CONTEXT]
+    assert result.raw == 'book done'
+    for name, dependencies in CONTEXT.items():
+        assert stages.contexts[name] == [f'{d} done' for d in dependencies]
+        for dependency in dependencies:
+            assert stages.runs[name][0] >= stages.runs[dependency][1], f'{name} started before {dependency} ended'
+    # the translation runs while the art direction and the prompts are written
+    assert stages.runs['translation'][0] < stages.runs['prompts'][1]
+    assert stages.runs['art_direction'][0] < stages.runs['translation'][1]
+
+    report = scheduler.report
+    assert report.critical_path == ['outline', 'translation', 'book']
+    assert report.wall_time < sum(DURATIONS.values())
+    assert report.wall_time == pytest.approx(report.critical_path_duration, abs=0.15)
+
+
+def test_sequential_with_one_worker():
+    stages = Stages()
+    stages.scheduler(make_tasks(), max_workers=1).kickoff({})
+    runs = sorted(stages.runs.values())
+    assert all(previous[1] <= following[0] for previous, following in zip(runs, runs[1:]))
+
+
+def test_completed_tasks_are_not_run_again():
+    stages = Stages()
+    tasks = make_tasks()
+    completed = {name: build_task_output(task, f'{name} done') for name, task in zip(CONTEXT, tasks) if name in ('outline', 'translation')}
+    scheduler = stages.scheduler(tasks)
+    scheduler.kickoff({}, completed=completed)
+    assert sorted(stages.runs) == ['art_direction', 'book', 'prompts']
+    assert scheduler.report.timings['translation'].cached
+
+
+def test_no_task_starts_once_the_book_is_cancelled():
+    stages = Stages()
+    run_control = RunControl()
+    scheduler = stages.scheduler(make_tasks(), run_control=run_control, on_task_complete=lambda output: output.name == 'outline' and run_control.cancel())
+    with pytest.raises(BookCancelled):
+        scheduler.kickoff({})
+    assert list(stages.runs) == ['outline']
+
+
+class ScriptedLLM(LLM):
+    """LLM giving the same final answer to every call, `on_call` runs during each call"""
+
+    def __init__(self, model: str, answer: dict | str, on_call=lambda: None):
+        super().__init__(model=model)
+        self.answer = answer if isinstance(answer, str) else json.dumps(answer)
+        self.on_call = on_call
+        self.calls = 0
+
+    def supports_function_calling(self) -> bool:
+        return False
+
+    def supports_stop_words(self) -> bool:
+        return False
+
+    def call(self, messages, callbacks=[]) -> str:
+        self.calls += 1
+        self.on_call()
+        return f'Thought: I now know the final answer\nFinal Answer: {self.answer}'
+
+
+def test_invalid_output_runs_again_on_the_fallback_llm():
+    agent = make_agent()
+    fast_llm = agent.llm = ScriptedLLM('fast', 'not a page at all')
+    llms_during_fallback = []
+    fallback_llm = ScriptedLLM('strong', PAGE, on_call=lambda: llms_during_fallback.append(agent.llm))
+    task = Task(name='write_page', description='Write a page', expected_output='A page', agent=agent, output_pydantic=PageContent)
+    metrics = MetricsRecorder()
+    scheduler = ParallelTaskScheduler(Crew(agents=[agent], tasks=[task]), fallback_llms={'write_page': fallback_llm}, metrics=metrics)
+
+    result = scheduler.kickoff({})
+    assert result.pydantic == PageContent(**PAGE)
+    assert fast_llm.calls >= 1 and fallback_llm.calls == 1
+    # the shared agent kept its own LLM all along, for the tasks it may be running meanwhile
+    assert llms_during_fallback == [fast_llm]
+    assert agent.llm is fast_llm and task.agent is agent
+    assert metrics.counters[MODEL_FALLBACKS] == 1
+    span = next(span for span in metrics.spans if span.name == 'write_page')
+    assert (span.attributes['model'], span.attributes['fallback_model']) == ('fast', 'strong')
+
+
+def test_valid_output_does_not_use_the_fallback_llm():
+    agent = make_agent()
+    agent.llm = ScriptedLLM('fast', PAGE)
+    fallback_llm = ScriptedLLM('strong', PAGE)
+    task = Task(name='write_page', description='Write a page', expected_output='A page', agent=agent, output_pydantic=PageContent)
+    ParallelTaskScheduler(Crew(agents=[agent], tasks=[task]), fallback_llms={'write_page': fallback_llm}).kickoff({})
+    assert fallback_llm.calls == 0
+
+
+def test_low_complexity_tasks_are_routed_to_the_fast_model():
+    story_book_crew = StoryBookCrew(target_languages=['French', 'Spanish'])
+    crew = story_book_crew.crew()
+    tasks = {task.name: task for task in crew.tasks}
+    translator_llm = story_book_crew.agent_llm('translator')
+    fast_llm = story_book_crew.agent_llm('translator', fast=True)
+
+    routed = sorted(name for name, task in tasks.items() if task.agent.llm is fast_llm)
+    assert routed == sorted(story_book_crew.translation_tasks)
+    assert {name: llm.model for name, llm in story_book_crew.fallback_llms.items()} == {name: translator_llm.model for name in routed}
+    # every routed task has its own copy of the agent, added to the crew
+    assert all(tasks[name].agent in crew.agents for name in routed)
+    assert len({id(tasks[name].agent) for name in routed}) == len(routed)
+    # the tool calling task stays on the model of its agent
+    assert tasks['generate_illustrations_task'].agent.llm.model == story_book_crew.agent_llm('illustrator').model
+    assert 'generate_illustrations_task' not in story_book_crew.fallback_llms
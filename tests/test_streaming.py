@@ -0,0 +1,106 @@
+import json
+
+import pytest
+
+from v0.pydantic_models import IllustrationPrompt, PageContent
+from v0.streaming import ArrayItemParser
+
+
+PAGES = [
+    {'core_vocabulary_word': 'fire', 'content': 'The {fire} is [hot], said "James".'},
+    {'core_vocabulary_word': 'ladder', 'content': 'Up the ladder \\ down the pole,\nthen a é and a ☃.'},
+    {'core_vocabulary_word': 'truck', 'content': 'Braces }{ and brackets ][ inside a string: {"pages": []}'},
+]
+DOCUMENT = json.dumps({'title': 'A "pages" title [with] {braces}', 'pages': PAGES, 'after': [{'core_vocabulary_word': 'x', 'content': 'not a page'}]})
+# escapes as \uXXXX instead of the characters
+ASCII_DOCUMENT = json.dumps({'pages': PAGES}, ensure_ascii=True)
+BARE_LIST = json.dumps(PAGES, indent=2)
+# unescaped double quotes inside a string, as the LLM writes them
+UNESCAPED = '{"pages": [{"core_vocabulary_word": "hot", "content": "He said "hot!" and ran."}, ' + json.dumps(PAGES[2]) + ']}'
+UNESCAPED_PAGES = [{'core_vocabulary_word': 'hot', 'content': 'He said "hot!" and ran.'}, PAGES[2]]
+
+
+def feed_all(chunks, field='pages', model=PageContent):
+    parser = ArrayItemParser(field, model)
+    items = []
+    for chunk in chunks:
+        items += parser.feed(chunk)
+    return [item.model_dump() for item in items]
+
+
+@pytest.mark.parametrize('document, pages', [
+    (DOCUMENT, PAGES),
+    (ASCII_DOCUMENT, PAGES),
+    (BARE_LIST, PAGES),
+    (UNESCAPED, UNESCAPED_PAGES),
+])
+def test_same_items_at_every_split(document, pages):
+    assert feed_all([document]) == pages
+    for offset in range(len(document) + 1):
+        assert feed_all([document[:offset], document[offset:]]) == pages, f'split at {offset}: {document[:offset]!r}'
+
+
+@pytest.mark.parametrize('document, pages', [
+    (DOCUMENT, PAGES),
+    (ASCII_DOCUMENT, PAGES),
+    (UNESCAPED, UNESCAPED_PAGES),
+])
+def test_same_items_one_character_at_a_time(document, pages):
+    assert feed_all(list(document)) == pages
+
+
+def test_same_items_at_every_pair_of_splits():
+    for first in range(0, len(ASCII_DOCUMENT), 3):
+        for second in range(first, len(ASCII_DOCUMENT) + 1, 7):
+            chunks = [ASCII_DOCUMENT[:first], ASCII_DOCUMENT[first:second], ASCII_DOCUMENT[second:]]
+            assert feed_all(chunks) == PAGES, f'split at {first} and {second}'
+
+
+def test_items_come_out_as_soon_as_they_are_complete():
+    parser = ArrayItemParser('pages', PageContent)
+    first_end = DOCUMENT.index(json.dumps(PAGES[0])) + len(json.dumps(PAGES[0]))
+    assert [item.model_dump() for item in parser.feed(DOCUMENT[:first_end])] == PAGES[:1]
+    assert [item.model_dump() for item in parser.feed(DOCUMENT[first_end:])] == PAGES[1:]
+
+
+def test_only_the_target_field_and_valid_items():
+    document = json.dumps({
+        'character_designs': [{'prompt': 'not this one', 'character_names': []}],
+        'illustration_prompts': [{'prompt': 'a', 'character_names': ['James']}, {'prompt': 'missing names'}, {'prompt': 'b', 'character_names': []}],
+    })
+    for offset in range(len(document) + 1):
+        items = feed_all([document[:offset], document[offset:]], 'illustration_prompts', IllustrationPrompt)
+        assert items == [{'prompt': 'a', 'character_names': ['James']}, {'prompt': 'b', 'character_names': []}]
+
+
+def test_discarded_streamed_prompts_do_not_reach_the_book(fake_backends, tmp_path):
+    from v0 import streaming
+    from v0.bench.fakes import patched
+    from v0.crew import generate_story_book
+    from v0.pipeline import _key
+
+    fake_backends(pages=3)
+    fake_stream = streaming.stream_completion
+
+    def stream_completion(llm, messages, token_process=None):
+        if 'AI illustration prompts' not in messages[-1]['content'] + messages[0]['content']:
+            yield from fake_stream(llm, messages, token_process)
+            return
+        # every page gets a prompt, then the answer stops validating: the agent writes the prompts again
+        stale_prompts = [{'prompt': f'stale prompt of page {i+1}', 'character_names': []} for i in range(3)]
+        yield json.dumps({'illustration_prompts': stale_prompts + [{'character_names': []}]})
+
+    output_dir = tmp_path / 'book'
+    with patched(streaming, 'stream_completion', stream_completion):
+        result = generate_story_book('firefighters', '3-6', 'Chinese', output_dir=str(output_dir), use_cache=False, streaming=True)
+
+    outputs = {output['name']: output for output in result['tasks_output']}
+    prompts = [prompt['prompt'] for prompt in outputs['create_illustrations_task']['json_dict']['illustration_prompts']]
+    assert not any('stale' in prompt for prompt in prompts)
+    # every page was prepared from the image of the prompt the agent wrote, not of the streamed one
+    paths = outputs['generate_illustrations_task']['json_dict']['illustration_paths']
+    with open(output_dir / 'checkpoints' / 'artifacts.json', encoding='utf-8') as f:
+        artifacts = json.load(f)
+    assert [artifacts[f'image_{i+1}']['key'] for i in range(3)] == [_key(path) for path in paths]
+    for i in range(3):
+        assert (output_dir / f'page_{i+1}.html').exists()
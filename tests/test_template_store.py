@@ -0,0 +1,108 @@
+import json
+import os
+import threading
+
+import pytest
+
+from v0.template_store import REQUIRED_PLACEHOLDERS, TemplateStore, missing_placeholders, style_similarity
+
+
+def make_template(title: str) -> str:
+    return f'<html><body><h1>{title}</h1>' + ''.join(f'<p>{{{{ {name} }}}}</p>' for name in REQUIRED_PLACEHOLDERS) + '</body></html>'
+
+
+def index(store: TemplateStore) -> dict:
+    with open(os.path.join(store.root, 'index.json'), 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+@pytest.mark.parametrize('html_template, missing', [
+    (make_template('ok'), []),
+    ('<p>{{ illustration_path }}</p>', list(REQUIRED_PLACEHOLDERS[1:])),
+    ('<p>{{ illustration_path </p>', list(REQUIRED_PLACEHOLDERS)),
+])
+def test_missing_placeholders(html_template, missing):
+    assert missing_placeholders(html_template) == missing
+
+
+@pytest.mark.parametrize('art_style, other_art_style, similarity', [
+    ('Soft watercolor', 'soft  WATERCOLOR!', 1.0),
+    ('soft watercolor', 'bold watercolor', 1 / 3),
+    ('soft watercolor', 'pixel art', 0.0),
+    ('', 'pixel art', 0.0),
+])
+def test_style_similarity(art_style, other_art_style, similarity):
+    assert style_similarity(art_style, other_art_style) == pytest.approx(similarity)
+
+
+def test_invalid_templates_are_not_saved(tmp_path):
+    store = TemplateStore(str(tmp_path))
+    assert store.save('<p>{{ illustration_path }}</p>', '3-6', 'watercolor') is None
+    assert not os.path.exists(tmp_path / 'index.json')
+
+
+def test_lookup_picks_the_closest_style_of_the_age_range(tmp_path):
+    store = TemplateStore(str(tmp_path), reuse_rate=1.0)
+    store.save(make_template('watercolor'), '3-6', 'soft watercolor')
+    store.save(make_template('bold watercolor'), '3-6', 'bold watercolor pastel')
+    watercolor_for_babies = store.save(make_template('babies'), '0-2', 'soft watercolor')
+
+    assert store.lookup('3-6', 'soft watercolor') == make_template('watercolor')
+    assert store.lookup('3-6', 'pixel art') is None
+    assert store.lookup('6-9', 'soft watercolor') is None
+    assert store.lookup('0-2', 'soft watercolor') == make_template('babies')
+    assert index(store)[watercolor_for_babies]['uses'] == 1
+
+
+def test_saving_a_template_again_keeps_its_entry(tmp_path):
+    store = TemplateStore(str(tmp_path), reuse_rate=1.0)
+    template_id = store.save(make_template('watercolor'), '3-6', 'watercolor')
+    store.lookup('3-6', 'watercolor')
+    assert store.save(make_template('watercolor'), '3-6', 'watercolor') == template_id
+    assert index(store)[template_id]['uses'] == 1
+
+
+@pytest.mark.parametrize('reuse_rate', [0.0, 0.5, 1.0])
+def test_reuse_rate(tmp_path, reuse_rate):
+    store = TemplateStore(str(tmp_path), reuse_rate=reuse_rate, seed=1)
+    store.save(make_template('watercolor'), '3-6', 'watercolor')
+    reused = sum(store.lookup('3-6', 'watercolor') is not None for _ in range(200))
+    assert reused == pytest.approx(200 * reuse_rate, abs=25)
+
+
+def test_same_seed_same_decisions(tmp_path):
+    decisions = []
+    for root in ('first', 'second'):
+        store = TemplateStore(str(tmp_path / root), reuse_rate=0.5, seed=7)
+        for title in ('a', 'b', 'c'):
+            store.save(make_template(title), '3-6', 'watercolor')
+        decisions.append([store.lookup('3-6', 'watercolor') for _ in range(30)])
+    assert decisions[0] == decisions[1]
+    assert len(set(decisions[0])) == 4  # None and the three equally close templates
+
+
+def test_concurrent_stores_keep_every_entry_and_use(tmp_path):
+    # one store per thread, as in separate processes they only share the lock file
+    stores = [TemplateStore(str(tmp_path), reuse_rate=1.0) for _ in range(8)]
+    template_id = stores[0].save(make_template('shared'), '3-6', 'watercolor')
+    errors = []
+
+    def work(i: int, store: TemplateStore) -> None:
+        try:
+            for j in range(10):
+                store.save(make_template(f'{i}-{j}'), '6-9', 'pixel art')
+                store.lookup('3-6', 'watercolor')
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=work, args=(i, store)) for i, store in enumerate(stores)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert not errors
+    entries = index(stores[0])
+    assert len(entries) == 1 + 8 * 10
+    assert entries[template_id]['uses'] == 8 * 10
+    assert not [name for name in os.listdir(tmp_path) if name.endswith('.tmp')]
@@ -0,0 +1,111 @@
+"""
+asyncio entry point of the book generation, to embed it in an async web service.
+
+    async def create_book(websocket):
+        book = asyncio.create_task(generate_story_book_in_thread('firefighters', '3-6', 'Chinese', on_event=websocket.send_json))
+        ...
+        book.cancel()  # stops the book and cancels its fal jobs
+
+This is a thread-pool adapter, not an async pipeline: crewai runs its agents synchronously, so the
+whole synchronous pipeline of a book runs on one of the shared worker threads of
+`clients.book_executor` (with its own task, image and TTS threads), and the coroutine only awaits
+it. The event loop is not blocked, but every book holds its threads for its whole run, and at most
+`BOOK_WORKERS` (64 by default) books run at the same time: the others wait for a free thread.
+
+The progress events of every task and page (see `v0.run_control`) are delivered on the loop, in
+order. Cancelling the coroutine cancels the book: no new task, page or TTS segment starts, the
+narration streams are dropped and the fal jobs in flight are cancelled on fal's side (from a
+thread, the cancel requests do not hold up the loop).
+"""
+import asyncio
+import functools
+import inspect
+from typing import Any, Awaitable, Callable
+
+from v0 import clients
+from v0.run_control import BOOK_CANCELLED, BOOK_COMPLETED, BOOK_FAILED, RunControl
+
+
+EventHandler = Callable[[dict[str, Any]], Awaitable[None] | None]
+
+
+async def generate_story_book_in_thread(
+    story_theme: str | None = None,
+    age_range: str | None = None,
+    target_language: str | list[str] | None = None,
+    output_dir: str | None = None,
+    on_event: EventHandler | None = None,
+    **kwargs: Any,
+) -> dict:
+    """
+    Run `generate_story_book` on a thread of `clients.book_executor` and await it, waiting for a
+    free thread first if `BOOK_WORKERS` books are already running.
+
+    Args:
+        on_event: Called on the event loop with every progress event, in order: the start and end
+            of every task, every page image and rendered page, the audio, then one of
+            'book_completed', 'book_failed' or 'book_cancelled'. A coroutine function is awaited
+            before the next event is delivered
+        kwargs: The other arguments of `generate_story_book`, e.g. `streaming=True`
+
+    Returns:
+        dict: The complete result dictionary containing all story content
+
+    Raises:
+        asyncio.CancelledError: If the coroutine was cancelled, the book is cancelled too
+    """
+    from v0.crew import generate_story_book
+
+    loop = asyncio.get_running_loop()
+    events: asyncio.Queue = asyncio.Queue()
+    run_control = RunControl(on_event=lambda event: loop.call_soon_threadsafe(events.put_nowait, event))
+    listener = loop.create_task(_deliver(events, on_event)) if on_event is not None else None
+
+    book = clients.book_executor().submit(functools.partial(
+        generate_story_book, story_theme, age_range, target_language, output_dir, run_control=run_control, **kwargs,
+    ))
+    try:
+        result_dict = await asyncio.wrap_future(book)
+    except asyncio.CancelledError:
+        # fal_client.cancel is a blocking request per job in flight
+        try:
+            await asyncio.shield(loop.run_in_executor(None, run_control.cancel))
+        finally:
+            run_control.emit(BOOK_CANCELLED)
+            _close(events, listener)
+        raise
+    except Exception as e:
+        run_control.emit(BOOK_FAILED, error=f'{type(e).__name__}: {e}')
+        await _drain(events, listener)
+        raise
+    run_control.emit(BOOK_COMPLETED)
+    await _drain(events, listener)
+    return result_dict
+
+
+async def _deliver(events: asyncio.Queue, on_event: EventHandler) -> None:
+    """Hand the events to `on_event` one at a time until the None that closes the queue"""
+    while True:
+        event = await events.get()
+        if event is None:
+            return
+        try:
+            result = on_event(event)
+            if inspect.isawaitable(result):
+                await result
+        except Exception as e:
+            print(f"Progress listener failed on {event['type']}: {e}")
+
+
+def _close(events: asyncio.Queue, listener: asyncio.Task | None) -> None:
+    """End the event queue after the events already emitted, without waiting for the listener"""
+    if listener is not None:
+        # the emitted events are put into the queue by callbacks scheduled before this one
+        asyncio.get_running_loop().call_soon(events.put_nowait, None)
+
+
+async def _drain(events: asyncio.Queue, listener: asyncio.Task | None) -> None:
+    """End the event queue and wait until every event was delivered"""
+    _close(events, listener)
+    if listener is not None:
+        await listener
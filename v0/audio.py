@@ -0,0 +1,163 @@
+"""
+Page-by-page narration with ElevenLabs.
+
+Every page is synthesized separately (several at a time) and cached by a hash of its text and
+voice settings, so editing one page only re-synthesizes that page. The segments are then
+concatenated into a single mp3 together with a manifest of where each page starts and ends.
+"""
+import hashlib
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING
+
+from v0 import clients
+from v0.metrics import TTS, MetricsRecorder
+from v0.run_control import RunControl
+
+if TYPE_CHECKING:
+    from elevenlabs.client import ElevenLabs
+
+
+VOICE_ID = "XfNU2rGpBa01ckF309OY"
+MODEL_ID = "eleven_multilingual_v2"
+OUTPUT_FORMAT = "mp3_44100_192"
+DEFAULT_AUDIO_CACHE_DIR = os.path.join('.cache', 'audio')
+
+
+def segment_key(text: str, voice_id: str = VOICE_ID, model_id: str = MODEL_ID, output_format: str = OUTPUT_FORMAT) -> str:
+    payload = json.dumps([text, voice_id, model_id, output_format], ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def mp3_duration(num_bytes: int, output_format: str = OUTPUT_FORMAT) -> float:
+    """Duration in seconds of a constant bitrate mp3, e.g. 'mp3_44100_192' is 192 kbps"""
+    bitrate_kbps = int(output_format.split('_')[-1])
+    return num_bytes * 8 / (bitrate_kbps * 1000)
+
+
+def synthesize_segment(
+    client: 'ElevenLabs',
+    text: str,
+    cache_dir: str = DEFAULT_AUDIO_CACHE_DIR,
+    voice_id: str = VOICE_ID,
+    model_id: str = MODEL_ID,
+    output_format: str = OUTPUT_FORMAT,
+    metrics: MetricsRecorder | None = None,
+    span_name: str = 'segment',
+    run_control: RunControl | None = None,
+) -> str:
+    """
+    Synthesize one segment of text, or reuse it from the cache. With `run_control`, the stream is
+    dropped (and nothing is cached) as soon as the book is cancelled.
+
+    Returns:
+        str: Path of the cached mp3 segment
+    """
+    key = segment_key(text, voice_id, model_id, output_format)
+    path = os.path.join(cache_dir, key[:2], f'{key}.mp3')
+    with (metrics or MetricsRecorder()).span(TTS, span_name, cached=True, characters=0) as attributes:
+        if os.path.exists(path):
+            return path
+        if run_control is not None:
+            run_control.raise_if_cancelled()
+
+        attributes.update(cached=False, characters=len(text))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{threading.get_ident()}.tmp'
+
+        def download() -> None:
+            # the request is only sent once the response is iterated
+            response = client.text_to_speech.convert(
+                text=text,
+                voice_id=voice_id,
+                model_id=model_id,
+                output_format=output_format,
+            )
+            with open(tmp_path, 'wb') as f:
+                for chunk in response:
+                    if run_control is not None:
+                        run_control.raise_if_cancelled()
+                    if chunk:
+                        f.write(chunk)
+
+        try:
+            clients.rate_limiter('elevenlabs').call(download)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        os.replace(tmp_path, path)
+        return path
+
+
+def generate_book_audio(
+    client: 'ElevenLabs',
+    page_texts: list[str],
+    output_dir: str,
+    file_name: str = 'audio.mp3',
+    max_concurrency: int = 4,
+    cache_dir: str = DEFAULT_AUDIO_CACHE_DIR,
+    voice_id: str = VOICE_ID,
+    model_id: str = MODEL_ID,
+    output_format: str = OUTPUT_FORMAT,
+    metrics: MetricsRecorder | None = None,
+    run_control: RunControl | None = None,
+) -> dict:
+    """
+    Narrate every page in parallel and merge the segments into one audio file.
+
+    Args:
+        client: ElevenLabs client
+        page_texts: Text of each page, in page order
+        output_dir: Directory to save the audio file and its manifest into
+        file_name: Name of the merged audio file
+        max_concurrency: Maximum number of TTS requests in flight
+        metrics: If given, a span with the duration and characters of every TTS call is recorded
+        run_control: If given, the narration stops when the book is cancelled
+
+    Returns:
+        dict: The manifest, also saved as `audio_manifest.json`, with the start and end offset
+            of every page in the merged file, in seconds and in bytes (end excluded, to seek with
+            `Range` requests)
+    """
+    with ThreadPoolExecutor(max_workers=max(1, min(max_concurrency, len(page_texts)))) as executor:
+        segment_paths = list(executor.map(
+            lambda i: synthesize_segment(client, page_texts[i], cache_dir, voice_id, model_id, output_format, metrics, f'page_{i+1}', run_control),
+            range(len(page_texts)),
+        ))
+
+    pages = []
+    offset = 0.0
+    byte_offset = 0
+    output_file = os.path.join(output_dir, file_name)
+    # constant bitrate mp3 frames can be concatenated as they are
+    with open(output_file, 'wb') as out:
+        for i, segment_path in enumerate(segment_paths):
+            with open(segment_path, 'rb') as f:
+                data = f.read()
+            out.write(data)
+            duration = mp3_duration(len(data), output_format)
+            pages.append({
+                'page': i + 1,
+                'start': round(offset, 3),
+                'end': round(offset + duration, 3),
+                'segment': os.path.basename(segment_path),
+                'byte_start': byte_offset,
+                'byte_end': byte_offset + len(data),
+            })
+            offset += duration
+            byte_offset += len(data)
+
+    manifest = {
+        'file': file_name,
+        'voice_id': voice_id,
+        'model_id': model_id,
+        'output_format': output_format,
+        'duration': round(offset, 3),
+        'pages': pages,
+    }
+    with open(os.path.join(output_dir, 'audio_manifest.json'), 'w+', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=4)
+    return manifest
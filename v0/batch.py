@@ -0,0 +1,187 @@
+"""
+Batch book generation from a JSONL file of job specs.
+
+Each line is a job like
+    {"story_theme": "...", "age_range": "1-6", "target_language": "Chinese", "output_dir": "books/firefighter"}
+(`id`, `output_dir`, `template_reuse_rate`, `streaming` and `image_format` are optional). Jobs run on a bounded pool of worker threads that share
+the LLM, fal and ElevenLabs clients of `v0.clients`. Jobs are read lazily and at most
+a few of them are queued ahead of the workers, and only a small summary of every book is kept,
+so a file with thousands of jobs does not hold every `result_dict` in memory.
+
+With `--prometheus-textfile`, the p50/p95 duration of every stage over the books of the batch
+is written for the node-exporter textfile collector. With `--bundle-root`, every finished book is
+exported as a versioned bundle (see `v0.bundle`).
+
+Usage:
+    python -m v0.batch jobs.jsonl --workers 4 --log batch_log.jsonl
+"""
+import argparse
+import json
+import os
+import threading
+import time
+import traceback
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Iterator
+
+from v0.bundle import export_book
+from v0.crew import generate_story_book
+from v0.metrics import StageDurations, span_durations, write_prometheus_textfile
+
+
+JOB_FIELDS = ('story_theme', 'age_range', 'target_language', 'output_dir', 'template_reuse_rate', 'streaming', 'image_format')
+
+
+def read_jobs(jobs_file: str) -> Iterator[dict]:
+    """Yield the jobs of a JSONL file one by one, with an `id` (the line number if not given)"""
+    with open(jobs_file, 'r', encoding='utf-8') as f:
+        for line_number, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            job = json.loads(line)
+            job.setdefault('id', str(line_number))
+            yield job
+
+
+def completed_job_ids(log_file: str) -> set[str]:
+    """Ids of the jobs that already succeeded according to a previous log"""
+    done = set()
+    if os.path.exists(log_file):
+        with open(log_file, 'r', encoding='utf-8') as f:
+            for line in f:
+                entry = json.loads(line)
+                if entry.get('status') == 'done':
+                    done.add(entry['id'])
+    return done
+
+
+def summarize(result_dict: dict, output_dir: str) -> dict:
+    """The few fields of a book that are worth logging"""
+    outputs = {task['name']: task for task in result_dict['tasks_output']}
+    outline = outputs.get('develop_story_outline_task', {}).get('json_dict') or {}
+    pages = outputs.get('write_story_content_task', {}).get('json_dict') or {}
+    return {
+        'output_dir': output_dir,
+        'title': outline.get('title'),
+        'pages': len(pages.get('pages', [])),
+        'total_tokens': result_dict.get('token_usage', {}).get('total_tokens'),
+    }
+
+
+class BatchRunner:
+    """Runs book jobs on a bounded worker pool and appends their status to a JSONL log"""
+
+    def __init__(self, log_file: str, workers: int = 4, output_root: str = 'batch_output', skip_done: bool = True, prometheus_textfile: str | None = None, bundle_root: str | None = None):
+        """
+        Args:
+            log_file: JSONL file receiving one `started` and one `done`/`failed` line per job
+            workers: Number of books generated at the same time
+            output_root: Parent directory of the books whose job has no `output_dir`
+            skip_done: Skip the jobs already logged as `done`, so an interrupted batch can be re-run
+            prometheus_textfile: If given, stage duration quantiles are written to this `.prom` file
+                after every job
+            bundle_root: If given, every finished book is exported into a bundle under this directory
+        """
+        self.log_file = log_file
+        self.workers = workers
+        self.output_root = output_root
+        self.skip_done = skip_done
+        self.prometheus_textfile = prometheus_textfile
+        self.bundle_root = bundle_root
+        self._log_lock = threading.Lock()
+        # bounded, a batch of thousands of books does not keep every span
+        self._durations = StageDurations()
+
+    def run(self, jobs: Iterator[dict]) -> dict[str, int]:
+        """
+        Run every job and return the number of jobs per final status.
+        """
+        done_ids = completed_job_ids(self.log_file) if self.skip_done else set()
+        counts = {'done': 0, 'failed': 0, 'skipped': 0}
+        max_pending = self.workers * 2  # only keep a few jobs queued ahead of the workers
+        pending: set[Future] = set()
+
+        def collect(finished: set[Future]) -> None:
+            for future in finished:
+                counts[future.result()] += 1
+
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='book') as executor:
+            for job in jobs:
+                if job['id'] in done_ids:
+                    counts['skipped'] += 1
+                    continue
+                if len(pending) >= max_pending:
+                    finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(finished)
+                pending.add(executor.submit(self._run_job, job))
+            collect(wait(pending).done)
+        return counts
+
+    def _run_job(self, job: dict) -> str:
+        kwargs = {field: job[field] for field in JOB_FIELDS if field in job}
+        kwargs.setdefault('output_dir', os.path.join(self.output_root, job['id']))
+        self._log({'id': job['id'], 'status': 'started', **kwargs})
+        start = time.perf_counter()
+        try:
+            result_dict = generate_story_book(**kwargs)
+            summary = summarize(result_dict, kwargs['output_dir'])
+            del result_dict
+            if self.bundle_root is not None:
+                summary['bundle_version'] = export_book(kwargs['output_dir'], self.bundle_root)['version']
+        except Exception as e:
+            self._record_metrics(kwargs['output_dir'])
+            self._log({
+                'id': job['id'],
+                'status': 'failed',
+                'duration': round(time.perf_counter() - start, 3),
+                'error': f'{type(e).__name__}: {e}',
+                'traceback': traceback.format_exc(),
+            })
+            return 'failed'
+        self._record_metrics(kwargs['output_dir'])
+        self._log({'id': job['id'], 'status': 'done', 'duration': round(time.perf_counter() - start, 3), **summary})
+        return 'done'
+
+    def _record_metrics(self, output_dir: str) -> None:
+        """Add the stage durations of a book to the batch quantiles"""
+        metrics_file = os.path.join(output_dir, 'metrics.json')
+        if self.prometheus_textfile is None or not os.path.exists(metrics_file):
+            return
+        with open(metrics_file, 'r', encoding='utf-8') as f:
+            metrics = json.load(f)
+        with self._log_lock:
+            self._durations.add(span_durations(metrics))
+            write_prometheus_textfile(self._durations, self.prometheus_textfile)
+
+    def _log(self, entry: dict) -> None:
+        entry['time'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+        with self._log_lock:
+            with open(self.log_file, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Generate many story books from a JSONL file of jobs')
+    parser.add_argument('jobs_file', help='JSONL file, one job per line with story_theme, age_range, target_language and optionally output_dir and id')
+    parser.add_argument('--workers', type=int, default=4, help='Number of books generated at the same time')
+    parser.add_argument('--log', default='batch_log.jsonl', help='JSONL status and result log')
+    parser.add_argument('--output-root', default='batch_output', help='Parent directory of the books without output_dir')
+    parser.add_argument('--rerun-done', action='store_true', help='Also run the jobs already logged as done')
+    parser.add_argument('--prometheus-textfile', help='Write p50/p95 stage durations to this .prom file for the node-exporter textfile collector')
+    parser.add_argument('--bundle-root', help='Export every finished book as a versioned bundle under this directory')
+    parser.add_argument('--rate-limit-state-dir', help='Share the provider rate limits with the other batch processes using this directory')
+    args = parser.parse_args()
+    if args.rate_limit_state_dir:
+        os.environ['RATE_LIMIT_STATE_DIR'] = args.rate_limit_state_dir
+
+    runner = BatchRunner(
+        args.log, workers=args.workers, output_root=args.output_root, skip_done=not args.rerun_done,
+        prometheus_textfile=args.prometheus_textfile, bundle_root=args.bundle_root,
+    )
+    counts = runner.run(read_jobs(args.jobs_file))
+    print(f"Batch finished: {counts['done']} done, {counts['failed']} failed, {counts['skipped']} skipped (see {args.log})")
+
+
+if __name__ == '__main__':
+    main()
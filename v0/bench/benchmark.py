@@ -0,0 +1,206 @@
+"""
+Offline benchmark of the book pipeline and of the batch image tool.
+
+Runs `generate_story_book` and `BatchImageGenerator.generate_batch` against the local
+fakes of `v0.bench.fakes` for every combination of page count and concurrency, and reports the
+end-to-end time, the time of every stage and the throughput. Compare against the results of a
+previous run with `--baseline` to catch regressions before deploying.
+
+Usage:
+    python -m v0.bench.benchmark --pages 5 10 20 50 --concurrency 1 4 16 64 --output bench_results.json
+    python -m v0.bench.benchmark --baseline bench_results.json --output bench_new.json --tolerance 0.2
+"""
+import argparse
+import contextlib
+import functools
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+from dataclasses import asdict, fields
+from typing import Any
+
+from v0 import clients
+from v0.bench.fakes import FakeBackendConfig, fake_backends, fake_fal
+from v0.metrics import TASK, MetricsRecorder
+
+
+DEFAULT_PAGES = [5, 10, 20, 50]
+DEFAULT_CONCURRENCY = [1, 4, 16, 64]
+
+
+def stage_times(metrics: dict[str, Any]) -> dict[str, float]:
+    """
+    Time of every stage of a `metrics.json`: the duration of every crew task, and for the other
+    span kinds the wall time from the first span start to the last span end.
+    """
+    stages = {}
+    extents: dict[str, tuple[float, float]] = {}
+    for span in metrics['spans']:
+        if span['kind'] == TASK:
+            stages[span['name']] = span['duration']
+        else:
+            start, end = extents.get(span['kind'], (span['start'], span['end']))
+            extents[span['kind']] = (min(start, span['start']), max(end, span['end']))
+    for kind, (start, end) in extents.items():
+        stages[kind] = round(end - start, 4)
+    return stages
+
+
+def bench_image_tool(pages: int, concurrency: int, config: FakeBackendConfig) -> dict[str, Any]:
+    """Generate `pages` images with the batch image generator and at most `concurrency` fal jobs in flight"""
+    from v0.image_batch import BatchImageGenerator
+    from v0.image_store import ImageStore
+
+    with tempfile.TemporaryDirectory() as work_dir, fake_fal(config) as fal:
+        metrics = MetricsRecorder()
+        generator = BatchImageGenerator(
+            image_store=ImageStore(os.path.join(work_dir, 'images')),
+            metrics=metrics,
+            max_concurrency=concurrency,
+            retry_delay=0.1,
+        )
+        prompts = [f'benchmark page {i+1}' for i in range(pages)]
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            generator.generate_batch(prompts)
+        wall_time = time.perf_counter() - start
+        return {
+            'wall_time': round(wall_time, 4),
+            'throughput': round(pages / wall_time, 4),
+            'stages': stage_times(metrics.to_dict()),
+            'fal_calls': fal.calls,
+            'hf_calls': fal.hf.calls,
+            'image_backends': fal.router.health(),
+        }
+
+
+def bench_book(pages: int, concurrency: int, config: FakeBackendConfig, streaming: bool = False) -> dict[str, Any]:
+    """Generate a whole book of `pages` pages with at most `concurrency` image and TTS requests in flight"""
+    from v0.crew import generate_story_book
+
+    previous_dir = os.getcwd()
+    with tempfile.TemporaryDirectory() as work_dir:
+        output_dir = os.path.join(work_dir, 'book')
+        # the transcoding pool is process-wide, its start-up is not part of a book
+        clients.image_variants().start(wait=True)
+        with fake_backends(pages, config, os.path.join(work_dir, 'images')) as fakes:
+            # the task output, audio and image caches live under the working directory
+            os.chdir(work_dir)
+            try:
+                start = time.perf_counter()
+                with contextlib.redirect_stdout(io.StringIO()):
+                    generate_story_book('firefighters', '3-6', 'Chinese', output_dir=output_dir, use_cache=False, max_concurrency=concurrency, streaming=streaming)
+                wall_time = time.perf_counter() - start
+            finally:
+                os.chdir(previous_dir)
+        with open(os.path.join(output_dir, 'metrics.json'), 'r', encoding='utf-8') as f:
+            metrics = json.load(f)
+        return {
+            'wall_time': round(wall_time, 4),
+            'throughput': round(pages / wall_time, 4),
+            'stages': stage_times(metrics),
+            'total_tokens': metrics['totals'].get(TASK, {}).get('total_tokens', 0),
+            'fal_calls': fakes['fal'].calls,
+            'hf_calls': fakes['fal'].hf.calls,
+            'image_backends': fakes['fal'].router.health(),
+            'tts_characters': fakes['tts'].characters,
+        }
+
+
+BENCHMARKS = {
+    'image_tool': bench_image_tool,
+    'book': bench_book,
+    'book_streaming': functools.partial(bench_book, streaming=True),
+}
+
+
+def run_benchmarks(benchmarks: list[str], page_counts: list[int], concurrency_levels: list[int], config: FakeBackendConfig, repeat: int = 1) -> list[dict[str, Any]]:
+    """
+    Run every benchmark for every page count and concurrency level.
+
+    Returns:
+        list[dict]: One result per combination, the fastest of `repeat` runs. Failed runs have an
+            `error` instead of timings.
+    """
+    results = []
+    for name in benchmarks:
+        for pages in page_counts:
+            for concurrency in concurrency_levels:
+                result = {'benchmark': name, 'pages': pages, 'concurrency': concurrency}
+                runs = []
+                for _ in range(repeat):
+                    try:
+                        runs.append(BENCHMARKS[name](pages, concurrency, config))
+                    except Exception as e:
+                        result['error'] = f'{type(e).__name__}: {e}'
+                if runs:
+                    result.update(min(runs, key=lambda run: run['wall_time']))
+                    result['failed_runs'] = repeat - len(runs)
+                results.append(result)
+                print(format_result(result), file=sys.stderr)
+    return results
+
+
+def format_result(result: dict[str, Any]) -> str:
+    label = f"{result['benchmark']:<10} pages={result['pages']:<3} concurrency={result['concurrency']:<3}"
+    if 'wall_time' not in result:
+        return f"{label} FAILED {result['error']}"
+    stages = ', '.join(f'{stage} {duration:.2f}s' for stage, duration in result['stages'].items())
+    return f"{label} {result['wall_time']:7.2f}s {result['throughput']:6.2f} pages/s | {stages}"
+
+
+def find_regressions(results: list[dict[str, Any]], baseline: list[dict[str, Any]], tolerance: float) -> list[str]:
+    """Combinations slower than the baseline by more than `tolerance` (e.g. 0.2 = 20%), or newly failing"""
+    baseline_by_key = {(b['benchmark'], b['pages'], b['concurrency']): b for b in baseline}
+    regressions = []
+    for result in results:
+        previous = baseline_by_key.get((result['benchmark'], result['pages'], result['concurrency']))
+        if previous is None or 'wall_time' not in previous:
+            continue
+        label = f"{result['benchmark']} pages={result['pages']} concurrency={result['concurrency']}"
+        if 'wall_time' not in result:
+            regressions.append(f"{label}: failed ({result['error']})")
+        elif result['wall_time'] > previous['wall_time'] * (1 + tolerance):
+            regressions.append(f"{label}: {result['wall_time']:.2f}s vs {previous['wall_time']:.2f}s")
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Benchmark the book pipeline against local fake backends')
+    parser.add_argument('--benchmark', nargs='+', choices=list(BENCHMARKS), default=list(BENCHMARKS), help='Benchmarks to run')
+    parser.add_argument('--pages', nargs='+', type=int, default=DEFAULT_PAGES, help='Page counts')
+    parser.add_argument('--concurrency', nargs='+', type=int, default=DEFAULT_CONCURRENCY, help='Maximum image and TTS requests in flight')
+    parser.add_argument('--repeat', type=int, default=1, help='Runs per combination, the fastest is kept')
+    parser.add_argument('--output', default='bench_results.json', help='File to write the results to')
+    parser.add_argument('--baseline', help='Results of a previous run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed slowdown against the baseline (0.2 = 20%%)')
+    for config_field in fields(FakeBackendConfig):
+        parser.add_argument(f"--{config_field.name.replace('_', '-')}", type=type(config_field.default), default=config_field.default)
+    args = parser.parse_args()
+    baseline = None
+    if args.baseline:
+        # read before the results are written, the output may not overwrite the baseline
+        if os.path.abspath(args.output) == os.path.abspath(args.baseline):
+            parser.error('--output and --baseline are the same file, the baseline would be overwritten')
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)['results']
+
+    config = FakeBackendConfig(**{config_field.name: getattr(args, config_field.name) for config_field in fields(FakeBackendConfig)})
+    results = run_benchmarks(args.benchmark, args.pages, args.concurrency, config, args.repeat)
+    with open(args.output, 'w+', encoding='utf-8') as f:
+        json.dump({'config': asdict(config), 'results': results}, f, indent=4)
+    print(f'Results written to {args.output}')
+
+    if baseline is not None:
+        regressions = find_regressions(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f'REGRESSION {regression}')
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,470 @@
+"""
+Local stand-ins for Bedrock, fal, Hugging Face and ElevenLabs, so the pipeline can be benchmarked offline.
+
+Every fake sleeps for a configurable latency and fails with a configurable probability, and
+returns canned data shaped like the real thing: JSON matching the pydantic models for the LLM,
+URLs of placeholder PNGs served on localhost for fal, placeholder images for Hugging Face, and
+streamed mp3-sized chunks for TTS.
+"""
+import functools
+import http.server
+import json
+import random
+import re
+import struct
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Any, Iterator
+
+import fal_client
+from crewai import LLM
+from litellm.types.utils import Usage
+
+
+@dataclass
+class FakeBackendConfig:
+    """Latency (seconds) and failure rate (0-1) of every fake backend"""
+    llm_latency: float = 0.2  # time to first token
+    llm_tokens_per_second: float = 0.0  # generation speed of the answers, 0 = instant
+    llm_failure_rate: float = 0.0
+    image_queue_latency: float = 0.1
+    image_latency: float = 0.5
+    image_failure_rate: float = 0.0
+    image_slow_rate: float = 0.0  # fal dev jobs stuck in a backed-up queue
+    image_slow_latency: float = 5.0
+    hf_latency: float = 1.0
+    image_hedge_after: float = 1.0  # image router thresholds, scaled to the fake latencies
+    image_timeout: float = 3.0
+    tts_latency: float = 0.2  # time to first chunk
+    tts_chunk_latency: float = 0.01
+    tts_failure_rate: float = 0.0
+    throttle_rate: float = 0.0  # fal and TTS requests answered with a 429
+    throttle_retry_after: float = 0.2
+    seed: int = 0
+
+
+class FakeBackendError(Exception):
+    """Injected failure of a fake backend"""
+
+
+class FakeThrottlingError(FakeBackendError):
+    """Injected 429 of a fake backend, with a Retry-After header"""
+
+    def __init__(self, retry_after: float):
+        super().__init__('Injected 429 Too Many Requests')
+        self.status_code = 429
+        self.headers = {'retry-after': str(retry_after)}
+
+
+class _Failures:
+    """Thread-safe, seeded coin flips deciding which calls fail"""
+
+    def __init__(self, rate: float, seed: int):
+        self.rate = rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def maybe_fail(self, what: str) -> None:
+        with self._lock:
+            failed = self._random.random() < self.rate
+        if failed:
+            raise FakeBackendError(f'Injected {what} failure')
+
+    def maybe_throttle(self, retry_after: float) -> None:
+        with self._lock:
+            throttled = self._random.random() < self.rate
+        if throttled:
+            raise FakeThrottlingError(retry_after)
+
+
+def placeholder_png(width: int = 72, height: int = 128, rgb: tuple[int, int, int] = (240, 200, 120)) -> bytes:
+    """A valid single-color PNG"""
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+
+    row = b'\x00' + bytes(rgb) * width
+    return (
+        b'\x89PNG\r\n\x1a\n'
+        + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+        + chunk(b'IDAT', zlib.compress(row * height))
+        + chunk(b'IEND', b'')
+    )
+
+
+class _PlaceholderHandler(http.server.BaseHTTPRequestHandler):
+    def __init__(self, *args, png: bytes, **kwargs):
+        self.png = png
+        super().__init__(*args, **kwargs)
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/png')
+        self.send_header('Content-Length', str(len(self.png)))
+        self.end_headers()
+        self.wfile.write(self.png)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class PlaceholderImageServer:
+    """Serves the same placeholder PNG on every path of a local HTTP server"""
+
+    def __init__(self, png: bytes | None = None):
+        handler = functools.partial(_PlaceholderHandler, png=png or placeholder_png())
+        self._server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    def url(self, name: str) -> str:
+        host, port = self._server.server_address
+        return f'http://{host}:{port}/{name}.png'
+
+    def __enter__(self) -> 'PlaceholderImageServer':
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def canned_outputs(pages: int) -> dict[str, Any]:
+    """Task name -> JSON output of a book with `pages` pages"""
+    words = ['fire', 'truck', 'hose', 'ladder', 'helmet', 'siren', 'water', 'smoke', 'hero', 'station']
+    translations = ['火', '卡车', '水管', '梯子', '头盔', '警报', '水', '烟', '英雄', '消防站']
+    return {
+        'research_story_theme_task': {
+            'theme': 'A brave little firefighter',
+            'educational_elements': ['fire safety', 'teamwork', 'courage'],
+        },
+        'develop_story_outline_task': {
+            'title': 'Little Firefighter James',
+            'character_descriptions': ['James, a curious five-year-old', 'Captain Rosa, the fire chief'],
+            'pages': [
+                {
+                    'core_vocabulary': words[i % len(words)],
+                    'plot_point': f'James learns about the {words[i % len(words)]} (page {i+1})',
+                    'educational_elements': 'fire safety',
+                }
+                for i in range(pages)
+            ],
+        },
+        'write_story_content_task': {
+            'pages': [
+                {'core_vocabulary_word': words[i % len(words)], 'content': f'On page {i+1}, James points at the big red {words[i % len(words)]}.'}
+                for i in range(pages)
+            ],
+        },
+        'design_art_direction_task': {
+            'character_designs': [
+                {'name': 'James', 'design': 'small boy, red helmet, yellow coat'},
+                {'name': 'Captain Rosa', 'design': 'tall woman, black helmet, warm smile'},
+            ],
+            'color_palette': 'warm red, sunny yellow, sky blue, soft cream',
+            'art_style': 'soft watercolor, rounded shapes',
+        },
+        'create_illustrations_task': {
+            'illustration_prompts': [
+                {'prompt': f'James looking at the {words[i % len(words)]} at the fire station, scene {i+1}', 'character_names': ['James']}
+                for i in range(pages)
+            ],
+        },
+        'translate_content_task': {
+            'pages': [
+                {'core_vocabulary_word': translations[i % len(translations)], 'content': f'第{i+1}页，詹姆斯指着红色的{translations[i % len(translations)]}。'}
+                for i in range(pages)
+            ],
+        },
+    }
+
+
+PAGE_TEMPLATE = """<!DOCTYPE html>
+<html>
+<head>
+<style>
+body { margin: 0; font-family: sans-serif; }
+.page { width: 210mm; height: 297mm; background: url('{{ illustration_path }}') center / cover; }
+.highlight { color: #d33; font-weight: bold; }
+</style>
+<script>document.addEventListener('DOMContentLoaded', function () { document.body.classList.add('ready'); });</script>
+</head>
+<body>
+<div class="page">
+<p class="english">{{ english_text }} <span class="highlight">{{ english_highlight_vocabulary_word }}</span></p>
+<p class="translated">{{ translated_text }} <span class="highlight">{{ translated_highlight_vocabulary_word }}</span></p>
+</div>
+</body>
+</html>"""
+
+# a phrase of the description of every task, to tell which task a prompt belongs to
+TASK_MARKERS = {
+    'research_story_theme_task': 'research proper topics',
+    'develop_story_outline_task': 'detailed story outline',
+    'write_story_content_task': 'engaging, age-appropriate story text',
+    'design_art_direction_task': 'art style guidelines',
+    'create_illustrations_task': 'AI illustration prompts',
+    'generate_illustrations_task': 'Generate actual illustrations',
+    'translate_content_task': 'Translate the text',
+    'generate_html_pages_task': 'HTML template',
+}
+
+
+class FakeLLM(LLM):
+    """
+    LLM answering every task of the crew with canned output after `latency` seconds.
+
+    The illustration task first calls the batch image tool with the canned prompts, then answers
+    with the image paths returned by the tool. Token usage is reported to the crew like litellm
+    does (about 4 characters per token), so the token metrics are not empty. `stream` answers the
+    streaming stages of the crew, chunk by chunk at `tokens_per_second`.
+    """
+
+    def __init__(self, pages: int, latency: float = 0.2, failure_rate: float = 0.0, seed: int = 0, tokens_per_second: float = 0.0):
+        super().__init__(model='bench/fake-llm')
+        self.pages = pages
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.outputs = canned_outputs(pages)
+        self._failures = _Failures(failure_rate, seed)
+
+    def supports_function_calling(self) -> bool:
+        return False
+
+    def supports_stop_words(self) -> bool:
+        return False
+
+    def call(self, messages: list[dict[str, str]], callbacks: list[Any] = []) -> str:
+        time.sleep(self.latency)
+        self._failures.maybe_fail('LLM')
+        answer = self._answer(messages)
+        time.sleep(self._generation_time(answer))
+        usage = self._usage(messages, answer)
+        for callback in callbacks:
+            if hasattr(callback, 'log_success_event'):
+                callback.log_success_event({}, {'usage': usage}, None, None)
+        return answer
+
+    def stream(self, messages: list[dict[str, str]], token_process: Any = None) -> Iterator[str]:
+        """Stand-in for `v0.streaming.stream_completion`: the bare JSON answer in chunks of about 10 tokens"""
+        time.sleep(self.latency)
+        self._failures.maybe_fail('LLM')
+        answer = self._answer(messages).split('Final Answer: ', 1)[-1]
+        for start in range(0, len(answer), 40):
+            chunk = answer[start:start + 40]
+            time.sleep(self._generation_time(chunk))
+            yield chunk
+        if token_process is not None:
+            usage = self._usage(messages, answer)
+            token_process.sum_successful_requests(1)
+            token_process.sum_prompt_tokens(usage.prompt_tokens)
+            token_process.sum_completion_tokens(usage.completion_tokens)
+
+    def _generation_time(self, text: str) -> float:
+        return len(text) / 4 / self.tokens_per_second if self.tokens_per_second else 0.0
+
+    def _usage(self, messages: list[dict[str, str]], answer: str) -> Usage:
+        prompt = '\n'.join(message['content'] for message in messages)
+        return Usage(prompt_tokens=len(prompt) // 4, completion_tokens=len(answer) // 4, total_tokens=(len(prompt) + len(answer)) // 4)
+
+    def _answer(self, messages: list[dict[str, str]]) -> str:
+        prompt = '\n'.join(message['content'] for message in messages)
+        task_name = next((name for name, marker in TASK_MARKERS.items() if marker in prompt), None)
+        if task_name is None:
+            raise FakeBackendError(f'No canned answer for prompt: {prompt[:200]}')
+
+        page = re.search(r'Translate only page (\d+) of the story', prompt)
+        if task_name == 'translate_content_task' and page:
+            # translation of a single page in the streaming mode
+            return json.dumps(self.outputs[task_name]['pages'][int(page.group(1)) - 1], ensure_ascii=False)
+
+        if task_name == 'generate_illustrations_task':
+            last = messages[-1]
+            paths = re.findall(r"'([^']+\.png)'", last['content']) if last['role'] == 'assistant' else []
+            if len(paths) < self.pages:
+                # no (complete) tool result yet, call the tool
+                art_direction = self.outputs['design_art_direction_task']
+                tool_input = {**self.outputs['create_illustrations_task'], **art_direction}
+                return f'Thought: I need to generate the illustrations\nAction: Batch Image Generation Tool\nAction Input: {json.dumps(tool_input)}'
+            output = {'image_size': '720x1280', 'illustration_paths': paths[-self.pages:]}
+        elif task_name == 'generate_html_pages_task':
+            return f'Thought: I now know the final answer\nFinal Answer: ```html\n{PAGE_TEMPLATE}\n```'
+        else:
+            output = self.outputs[task_name]
+        return f'Thought: I now know the final answer\nFinal Answer: {json.dumps(output, ensure_ascii=False)}'
+
+
+class FakeFal:
+    """Stand-in for `fal_client.subscribe` returning placeholder images from a local server, and for `fal_client.cancel`"""
+
+    def __init__(self, server: PlaceholderImageServer, queue_latency: float = 0.1, latency: float = 0.5, failure_rate: float = 0.0, seed: int = 0, slow_rate: float = 0.0, slow_latency: float = 5.0, throttle_rate: float = 0.0, throttle_retry_after: float = 0.2):
+        self.server = server
+        self.queue_latency = queue_latency
+        self.latency = latency
+        self.slow_latency = slow_latency
+        self.calls = 0
+        self._failures = _Failures(failure_rate, seed)
+        self._slow = _Failures(slow_rate, seed + 1)
+        self._throttles = _Failures(throttle_rate, seed + 2)
+        self.throttle_retry_after = throttle_retry_after
+        self._lock = threading.Lock()
+        # set by `fake_fal`: the Hugging Face fake and the image router in use
+        self.hf: FakeHFInference | None = None
+        self.router: Any = None
+        self.cancelled = 0
+        # request id -> set when the job is cancelled
+        self._jobs: dict[str, threading.Event] = {}
+
+    def subscribe(self, application: str, arguments: dict, with_logs: bool = False, on_enqueue=None, on_queue_update=None) -> dict:
+        with self._lock:
+            self.calls += 1
+            request_number = self.calls
+            request_id = f'request-{request_number}'
+            cancelled = self._jobs[request_id] = threading.Event()
+        try:
+            self._throttles.maybe_throttle(self.throttle_retry_after)
+            if on_enqueue:
+                on_enqueue(request_id)
+            if on_queue_update:
+                on_queue_update(fal_client.Queued(position=0))
+            self._wait(cancelled, self.queue_latency)
+            if application.endswith('/dev'):
+                try:
+                    self._slow.maybe_fail('queue')
+                except FakeBackendError:
+                    self._wait(cancelled, self.slow_latency)
+            if on_queue_update:
+                on_queue_update(fal_client.InProgress(logs=[]))
+            self._wait(cancelled, self.latency)
+            self._failures.maybe_fail('image generation')
+            return {'images': [{'url': self.server.url(f'image_{request_number}'), **arguments['image_size']}]}
+        finally:
+            with self._lock:
+                self._jobs.pop(request_id, None)
+
+    def cancel(self, application: str, request_id: str) -> None:
+        """Stand-in for `fal_client.cancel`, the job fails right away"""
+        with self._lock:
+            job = self._jobs.get(request_id)
+            if job is not None and not job.is_set():
+                job.set()
+                self.cancelled += 1
+
+    @staticmethod
+    def _wait(cancelled: threading.Event, seconds: float) -> None:
+        if cancelled.wait(seconds):
+            raise FakeBackendError('fake job cancelled')
+
+
+class FakeHFInference:
+    """Stand-in for the Hugging Face `InferenceClient` returning placeholder images"""
+
+    def __init__(self, latency: float = 1.0, failure_rate: float = 0.0, seed: int = 0):
+        self.latency = latency
+        self.calls = 0
+        self._failures = _Failures(failure_rate, seed)
+        self._lock = threading.Lock()
+
+    def text_to_image(self, prompt: str, model: str | None = None, width: int | None = None, height: int | None = None) -> Any:
+        from PIL import Image
+
+        with self._lock:
+            self.calls += 1
+        time.sleep(self.latency)
+        self._failures.maybe_fail('image generation')
+        return Image.new('RGB', (72, 128), (240, 200, 120))
+
+
+class _FakeTextToSpeech:
+    def __init__(self, client: 'FakeElevenLabs'):
+        self.client = client
+
+    def convert(self, text: str, voice_id: str, model_id: str, output_format: str) -> Iterator[bytes]:
+        client = self.client
+        client._throttles.maybe_throttle(client.throttle_retry_after)
+        with client._lock:
+            client.characters += len(text)
+        time.sleep(client.latency)
+        client._failures.maybe_fail('TTS')
+        # about one second of 192 kbps audio per 15 characters, streamed in 4 KB chunks
+        remaining = max(1, len(text) // 15) * 24000
+        while remaining > 0:
+            size = min(4096, remaining)
+            remaining -= size
+            time.sleep(client.chunk_latency)
+            yield b'\xff' * size
+
+
+class FakeElevenLabs:
+    """Stand-in for the ElevenLabs client streaming fake mp3 chunks"""
+
+    def __init__(self, latency: float = 0.2, chunk_latency: float = 0.01, failure_rate: float = 0.0, seed: int = 0, throttle_rate: float = 0.0, throttle_retry_after: float = 0.2):
+        self.latency = latency
+        self.chunk_latency = chunk_latency
+        self.characters = 0
+        self._failures = _Failures(failure_rate, seed)
+        self._throttles = _Failures(throttle_rate, seed + 2)
+        self.throttle_retry_after = throttle_retry_after
+        self._lock = threading.Lock()
+        self.text_to_speech = _FakeTextToSpeech(self)
+
+
+@contextmanager
+def patched(target: Any, attribute: str, value: Any) -> Iterator[None]:
+    """Temporarily set `target.attribute` to `value`"""
+    original = getattr(target, attribute)
+    setattr(target, attribute, value)
+    try:
+        yield
+    finally:
+        setattr(target, attribute, original)
+
+
+@contextmanager
+def fake_fal(config: FakeBackendConfig) -> Iterator[FakeFal]:
+    """
+    Serve placeholder images and route `fal_client.subscribe` of the image backends to them. The
+    Hugging Face backend is replaced too (`fal.hf`), and the shared image router uses the
+    thresholds of `config`.
+    """
+    from v0 import clients, image_providers
+
+    with PlaceholderImageServer() as server:
+        fal = FakeFal(
+            server, config.image_queue_latency, config.image_latency, config.image_failure_rate, config.seed,
+            config.image_slow_rate, config.image_slow_latency, config.throttle_rate, config.throttle_retry_after,
+        )
+        fal.hf = FakeHFInference(config.hf_latency, config.image_failure_rate, config.seed)
+        fal.router = image_providers.default_router(hedge_after=config.image_hedge_after, timeout=config.image_timeout)
+        with (
+            patched(image_providers.fal_client, 'subscribe', fal.subscribe),
+            patched(image_providers.fal_client, 'cancel', fal.cancel),
+            clients.override(hf_inference=fal.hf, image_router=fal.router),
+        ):
+            yield fal
+
+
+@contextmanager
+def fake_backends(pages: int, config: FakeBackendConfig, image_store_root: str) -> Iterator[dict[str, Any]]:
+    """
+    Replace the shared LLMs, fal and ElevenLabs clients with fakes.
+
+    Yields:
+        dict: The fakes, keys 'llm', 'fal' and 'tts'
+    """
+    from v0 import clients, streaming
+    from v0.image_store import ImageStore
+
+    llm = FakeLLM(pages, config.llm_latency, config.llm_failure_rate, config.seed, config.llm_tokens_per_second)
+    tts = FakeElevenLabs(config.tts_latency, config.tts_chunk_latency, config.tts_failure_rate, config.seed, config.throttle_rate, config.throttle_retry_after)
+    with (
+        fake_fal(config) as fal,
+        # every model of agents.yaml, whatever its settings
+        patched(clients, 'llm', lambda name, temperature=None, max_tokens=None: llm),
+        clients.override(eleven_labs=tts, image_store=ImageStore(image_store_root)),
+        patched(streaming, 'stream_completion', lambda fake_llm, messages, token_process=None: fake_llm.stream(messages, token_process)),
+    ):
+        yield {'llm': llm, 'fal': fal, 'tts': tts}
@@ -0,0 +1,81 @@
+"""
+Import-time budget of the modules that workers import on their own.
+
+Every module is imported in a fresh interpreter (best of a few runs) and compared with its
+budget. Importing must also not create any shared client, so a worker that only renders or only
+generates images needs neither crewai nor the credentials of the other services.
+
+Usage:
+    python -m v0.bench.import_time
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+
+# module -> maximum import time in seconds
+IMPORT_BUDGETS = {
+    'v0.clients': 0.1,
+    'v0.metrics': 0.1,
+    'v0.render': 0.3,
+    'v0.image_store': 0.5,
+    'v0.image_variants': 0.1,
+    'v0.image_providers': 0.8,
+    'v0.image_batch': 0.8,
+    'v0.rate_limit': 0.1,
+    'v0.audio': 0.5,
+    'v0.pipeline': 0.8,
+    'v0.bundle': 0.8,
+}
+
+# the modules are imported from the repository, wherever the check is run from
+_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+_MEASURE = '''
+import json, sys, time
+start = time.perf_counter()
+__import__(sys.argv[1])
+duration = time.perf_counter() - start
+from v0 import clients
+print(json.dumps({'duration': duration, 'clients': sorted(clients._instances), 'crewai': 'crewai' in sys.modules}))
+'''
+
+
+def measure_import(module: str, runs: int = 3) -> dict:
+    """Import time of `module` in a fresh interpreter (best of `runs`), the clients it created and whether it imported crewai"""
+    best = None
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, '-c', _MEASURE, module], capture_output=True, text=True, check=True, cwd=_ROOT).stdout
+        result = json.loads(output.splitlines()[-1])
+        if best is None or result['duration'] < best['duration']:
+            best = result
+    return best
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Check the import time of the v0 modules against their budget')
+    parser.add_argument('--runs', type=int, default=3, help='Imports per module, the fastest is kept')
+    args = parser.parse_args()
+
+    failures = []
+    for module, budget in IMPORT_BUDGETS.items():
+        result = measure_import(module, args.runs)
+        problems = []
+        if result['duration'] > budget:
+            problems.append(f'over budget ({budget:.2f}s)')
+        if result['clients']:
+            problems.append(f"created clients {result['clients']}")
+        if result['crewai']:
+            problems.append('imported crewai')
+        print(f"{module:<16} {result['duration']:6.3f}s {'FAIL ' + ', '.join(problems) if problems else 'ok'}")
+        if problems:
+            failures.append(module)
+
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
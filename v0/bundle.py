@@ -0,0 +1,314 @@
+"""
+Versioned, content-hashed bundles of finished books, to serve them from a CDN.
+
+A book made by `generate_story_book` is a loose directory whose every page carries the CSS and JS
+of its template inline. `export_book` packages it under a bundle root shared by every book:
+
+    assets/<hash>.css, assets/<hash>.js      CSS and JS of the templates, shared by every page and
+                                             every book made from the same template
+    books/<book_id>/media/<hash>.<ext>       images and narration of the book, shared by its versions
+    books/<book_id>/<version>/               pages, merged books and manifest.json of one version
+    books/<book_id>/current.json             version currently served
+
+Every path but current.json contains the hash of its content (the version is the hash of the
+pages), so those files never change and are served with `Cache-Control: public,
+max-age=31536000, immutable`. Only current.json has to be revalidated. manifest.json lists every
+file of the bundle with its size, hash, content type and cache header, and the byte range of every
+page in the narration, so a player can seek to a page with a `Range` request.
+
+Usage:
+    python -m v0.bundle books/firefighter cdn
+"""
+import argparse
+import hashlib
+import json
+import mimetypes
+import os
+import posixpath
+import re
+import shutil
+import threading
+from urllib.parse import unquote, urlparse
+
+from v0.pipeline import AUDIO_FILE_NAME, PAGE_DEPENDENCIES_FILE
+
+
+BUNDLE_FORMAT = 1
+MANIFEST_FILE = 'manifest.json'
+CURRENT_FILE = 'current.json'
+ASSETS_DIR = 'assets'
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+CURRENT_CACHE_CONTROL = 'public, max-age=60, must-revalidate'
+
+# not known to mimetypes on every platform
+_CONTENT_TYPES = {
+    '.html': 'text/html; charset=utf-8',
+    '.css': 'text/css; charset=utf-8',
+    '.js': 'text/javascript; charset=utf-8',
+    '.json': 'application/json',
+    '.mp3': 'audio/mpeg',
+    '.webp': 'image/webp',
+    '.avif': 'image/avif',
+}
+_STYLE_RE = re.compile(r'<style\b([^>]*)>(.*?)</style>', re.DOTALL | re.IGNORECASE)
+_SCRIPT_RE = re.compile(r'<script\b([^>]*)>(.*?)</script>', re.DOTALL | re.IGNORECASE)
+_REFERENCE_RE = re.compile(r'\b(src|href|poster)=(["\'])(.*?)\2', re.IGNORECASE)
+_SRCSET_RE = re.compile(r'\bsrcset=(["\'])(.*?)\1', re.IGNORECASE)
+_CSS_URL_RE = re.compile(r'url\(\s*(["\']?)([^"\')]+)\1\s*\)', re.IGNORECASE)
+_MEDIA_RE = re.compile(r'\bmedia=(["\'])(.*?)\1', re.IGNORECASE)
+_TYPE_RE = re.compile(r'\btype=(["\'])(.*?)\1', re.IGNORECASE)
+_SRC_RE = re.compile(r'\bsrc=', re.IGNORECASE)
+_JAVASCRIPT_TYPES = ('', 'text/javascript', 'application/javascript', 'module')
+# stands for the version in the paths of the pages while they are rewritten, relative paths
+# from a page to the assets and the media do not depend on it
+_VERSION = 'version'
+
+
+def export_book(output_dir: str, bundle_root: str, book_id: str | None = None) -> dict:
+    """
+    Package a finished book into a new version of its bundle, and make it the current version.
+    Exporting a book that did not change gives the same version again.
+
+    Args:
+        output_dir: Output directory of the book
+        bundle_root: Root of the bundles of every book, e.g. the directory synced to the CDN
+        book_id: Directory of the book in the bundle root, the name of `output_dir` by default
+
+    Returns:
+        dict: The manifest of the version, also saved as `books/<book_id>/<version>/manifest.json`
+
+    Raises:
+        ValueError: If the book did not finish (it has no page dependencies)
+    """
+    dependencies_file = os.path.join(output_dir, PAGE_DEPENDENCIES_FILE)
+    if not os.path.exists(dependencies_file):
+        raise ValueError(f'{output_dir} has no {PAGE_DEPENDENCIES_FILE}, generate (or resume) the whole book first')
+    with open(dependencies_file, 'r', encoding='utf-8') as f:
+        dependencies = json.load(f)
+    book_id = book_id or os.path.basename(os.path.normpath(output_dir))
+
+    bundle = _BookBundle(output_dir, book_id)
+    translations = []
+    for translation, directory in dependencies['translations'].items():
+        pages = [posixpath.join(directory, f'page_{i+1}.html') for i in range(len(dependencies['pages']))]
+        merged_book = posixpath.join(directory, 'merged_book.html')
+        for document in (merged_book, *pages):
+            bundle.add_document(document)
+        translations.append({'task': translation, 'book': merged_book, 'pages': pages})
+    audio_manifest = None
+    if os.path.exists(os.path.join(output_dir, 'audio_manifest.json')):
+        with open(os.path.join(output_dir, 'audio_manifest.json'), 'r', encoding='utf-8') as f:
+            audio_manifest = json.load(f)
+        bundle.add_media(audio_manifest.get('file', AUDIO_FILE_NAME))
+
+    version = bundle.version()
+    version_dir = posixpath.join(bundle.book_dir, version)
+    manifest_path = os.path.join(bundle_root, version_dir, MANIFEST_FILE)
+    if os.path.exists(manifest_path):
+        print(f'{book_id} is already bundled as version {version}')
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    else:
+        manifest = bundle.write(bundle_root, version, translations, audio_manifest)
+    _write_file(os.path.join(bundle_root, bundle.book_dir, CURRENT_FILE), json.dumps({
+        'version': version,
+        'manifest': posixpath.join(version, MANIFEST_FILE),
+    }, indent=4).encode('utf-8'))
+    return manifest
+
+
+class _BookBundle:
+    """The files of one version of a book bundle, collected from the pages before they are written"""
+
+    def __init__(self, output_dir: str, book_id: str):
+        self.output_dir = output_dir
+        self.book_dir = posixpath.join('books', book_id)
+        # path in the bundle root -> content, for the extracted CSS and JS
+        self.assets: dict[str, bytes] = {}
+        # path in output_dir -> path in the bundle root, for the images and audio
+        self.media: dict[str, str] = {}
+        # path in output_dir (and in the version directory) -> rewritten page
+        self.documents: dict[str, str] = {}
+
+    def add_document(self, path: str) -> None:
+        """Add a page, its inline CSS and JS moved into assets and its images and audio into media"""
+        directory = posixpath.dirname(path)
+        target_directory = posixpath.join(self.book_dir, _VERSION, directory)
+        with open(os.path.join(self.output_dir, path), 'r', encoding='utf-8') as f:
+            html = f.read()
+        html = _STYLE_RE.sub(lambda match: self._extract_style(match, directory, target_directory), html)
+        html = _SCRIPT_RE.sub(lambda match: self._extract_script(match, target_directory), html)
+        html = _REFERENCE_RE.sub(lambda match: f'{match.group(1)}={match.group(2)}{self._reference(match.group(3), directory, target_directory)}{match.group(2)}', html)
+        html = _SRCSET_RE.sub(lambda match: f'srcset={match.group(1)}{self._srcset(match.group(2), directory, target_directory)}{match.group(1)}', html)
+        # url() of the style attributes
+        self.documents[path] = self._rewrite_css(html, directory, target_directory)
+
+    def add_media(self, path: str) -> str:
+        """
+        Add an image or audio file of the book, named after the hash of its content.
+
+        Args:
+            path: Path relative to output_dir
+
+        Returns:
+            str: Its path in the bundle root
+        """
+        if path not in self.media:
+            digest = _hash_file(os.path.join(self.output_dir, path))
+            self.media[path] = posixpath.join(self.book_dir, 'media', f'{digest[:16]}{posixpath.splitext(path)[1].lower()}')
+        return self.media[path]
+
+    def version(self) -> str:
+        """Hash of the pages, which name every asset and media file by its hash"""
+        payload = json.dumps({'documents': self.documents, 'media': sorted(self.media.values())}, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:12]
+
+    def write(self, bundle_root: str, version: str, translations: list[dict], audio_manifest: dict | None) -> dict:
+        """Write the files missing from the bundle root, then the manifest of the version"""
+        version_dir = posixpath.join(self.book_dir, version)
+        files = {}
+        for path, data in self.assets.items():
+            _write_file(os.path.join(bundle_root, path), data, overwrite=False)
+            files[path] = _file_entry(path, len(data), hashlib.sha256(data).hexdigest())
+        for source, path in self.media.items():
+            source_path = os.path.join(self.output_dir, source)
+            _link_file(source_path, os.path.join(bundle_root, path))
+            files[path] = _file_entry(path, os.path.getsize(source_path), _hash_file(source_path))
+        for document, html in self.documents.items():
+            path = posixpath.join(version_dir, document)
+            data = html.encode('utf-8')
+            _write_file(os.path.join(bundle_root, path), data)
+            files[path] = _file_entry(path, len(data), hashlib.sha256(data).hexdigest())
+
+        manifest = {
+            'format': BUNDLE_FORMAT,
+            'book_id': posixpath.basename(self.book_dir),
+            'version': version,
+            'current': {'path': posixpath.join(self.book_dir, CURRENT_FILE), 'cache_control': CURRENT_CACHE_CONTROL},
+            'translations': [
+                {
+                    'task': translation['task'],
+                    'book': posixpath.join(version_dir, translation['book']),
+                    'pages': [posixpath.join(version_dir, page) for page in translation['pages']],
+                }
+                for translation in translations
+            ],
+            'audio': self._audio(audio_manifest, files) if audio_manifest else None,
+            'files': files,
+        }
+        _write_file(os.path.join(bundle_root, version_dir, MANIFEST_FILE), json.dumps(manifest, indent=4, ensure_ascii=False).encode('utf-8'))
+        print(f"Bundled {manifest['book_id']} version {version}: {len(files)} files, {len(self.assets)} shared assets")
+        return manifest
+
+    def _audio(self, audio_manifest: dict, files: dict[str, dict]) -> dict:
+        """The narration with the byte range of every page, as the value of a `Range` header"""
+        path = self.media[audio_manifest.get('file', AUDIO_FILE_NAME)]
+        size = files[path]['size']
+        pages = []
+        for page in audio_manifest['pages']:
+            # manifests written before the byte offsets were recorded: constant bitrate
+            byte_start = page.get('byte_start', round(page['start'] / audio_manifest['duration'] * size))
+            byte_end = page.get('byte_end', round(page['end'] / audio_manifest['duration'] * size))
+            pages.append({'page': page['page'], 'start': page['start'], 'end': page['end'], 'range': f'bytes={byte_start}-{min(byte_end, size) - 1}'})
+        return {'path': path, 'duration': audio_manifest['duration'], 'size': size, 'accept_ranges': 'bytes', 'pages': pages}
+
+    def _extract_style(self, match: re.Match, directory: str, target_directory: str) -> str:
+        css = self._rewrite_css(match.group(2), directory, ASSETS_DIR)
+        asset = self._add_asset(css, '.css')
+        media = _MEDIA_RE.search(match.group(1))
+        media_attribute = f' media="{media.group(2)}"' if media else ''
+        return f'<link rel="stylesheet" href="{posixpath.relpath(asset, target_directory)}"{media_attribute}>'
+
+    def _extract_script(self, match: re.Match, target_directory: str) -> str:
+        attributes, script = match.group(1), match.group(2)
+        script_type = _TYPE_RE.search(attributes)
+        # external scripts stay, and data blocks (e.g. JSON-LD) are not scripts
+        if _SRC_RE.search(attributes) or not script.strip() or (script_type.group(2).lower() if script_type else '') not in _JAVASCRIPT_TYPES:
+            return match.group(0)
+        asset = self._add_asset(script, '.js')
+        # an external script without async/defer runs at the same point as the inline one did
+        return f'<script{attributes} src="{posixpath.relpath(asset, target_directory)}"></script>'
+
+    def _add_asset(self, content: str, extension: str) -> str:
+        data = content.encode('utf-8')
+        path = posixpath.join(ASSETS_DIR, f'{hashlib.sha256(data).hexdigest()[:16]}{extension}')
+        self.assets[path] = data
+        return path
+
+    def _rewrite_css(self, css: str, directory: str, target_directory: str) -> str:
+        return _CSS_URL_RE.sub(lambda match: f'url({match.group(1)}{self._reference(match.group(2), directory, target_directory)}{match.group(1)})', css)
+
+    def _srcset(self, value: str, directory: str, target_directory: str) -> str:
+        candidates = []
+        for candidate in value.split(','):
+            url, _, descriptor = candidate.strip().partition(' ')
+            candidates.append(f'{self._reference(url, directory, target_directory)} {descriptor}'.strip())
+        return ', '.join(candidates)
+
+    def _reference(self, value: str, directory: str, target_directory: str) -> str:
+        """A reference of a page to a local image or audio file, pointed at the media of the bundle"""
+        value = value.strip()
+        if not value or urlparse(value).scheme or value.startswith(('#', '/')):
+            return value
+        path = posixpath.normpath(posixpath.join(directory, unquote(value)))
+        # links between the pages stay, their layout is the same in the bundle
+        if path.startswith('..') or path.endswith('.html') or not os.path.isfile(os.path.join(self.output_dir, path)):
+            return value
+        return posixpath.relpath(self.add_media(path), target_directory)
+
+
+def _file_entry(path: str, size: int, sha256: str) -> dict:
+    extension = posixpath.splitext(path)[1].lower()
+    return {
+        'size': size,
+        'sha256': sha256,
+        'content_type': _CONTENT_TYPES.get(extension) or mimetypes.guess_type(path)[0] or 'application/octet-stream',
+        'cache_control': IMMUTABLE_CACHE_CONTROL,
+    }
+
+
+def _hash_file(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _write_file(path: str, data: bytes, overwrite: bool = True) -> None:
+    """Write atomically, other books may be exporting the same shared asset at the same time"""
+    if not overwrite and os.path.exists(path):
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def _link_file(source: str, path: str) -> None:
+    """Hard link (or copy) a media file into the bundle, unless a file with the same hash is already there"""
+    if os.path.exists(path):
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        os.link(source, tmp_path)
+    except OSError:
+        shutil.copyfile(source, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Package finished books into versioned, content-hashed bundles')
+    parser.add_argument('output_dirs', nargs='+', help='Output directories of the books')
+    parser.add_argument('bundle_root', help='Root of the bundles, e.g. the directory synced to the CDN')
+    args = parser.parse_args()
+
+    for output_dir in args.output_dirs:
+        manifest = export_book(output_dir, args.bundle_root)
+        print(f"{output_dir} -> {posixpath.join('books', manifest['book_id'], manifest['version'])}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,189 @@
+"""
+Persistent, content-addressed cache of crew task outputs.
+
+A task output is reused when everything that went into producing it is unchanged: the task
+and agent config from the yaml files, the model and its sampling settings, the kickoff inputs and the
+raw outputs of the upstream context tasks (only their `context_fields` of tasks.yaml, if the task
+declares some). Because the upstream outputs are part of the key, a change early in the pipeline
+invalidates every stage after it, and only those.
+"""
+import hashlib
+import json
+import os
+import threading
+from typing import Any
+
+from crewai import Task
+from crewai.tasks.output_format import OutputFormat
+from crewai.tasks.task_output import TaskOutput
+
+
+DEFAULT_CACHE_DIR = os.path.join('.cache', 'task_outputs')
+DEFAULT_MAX_SIZE_BYTES = 200 * 1024 * 1024
+# eviction makes room for this fraction of the max size, so that the next puts do not scan again
+EVICTION_LOW_WATERMARK = 0.9
+
+
+class TaskOutputCache:
+    """
+    On-disk cache of validated task outputs, one JSON file per key.
+
+    Entries are evicted least-recently-used first once the cache grows over `max_size_bytes`. The
+    size of the cache is scanned once and then tracked from the entries written, the cache is only
+    scanned again when that estimate goes over the max size; the entries written by other processes
+    meanwhile are counted then.
+    Tasks with tools are never cached since their result depends on side effects
+    (e.g. generated image URLs), not only on the prompt.
+    """
+
+    def __init__(self, cache_dir: str = DEFAULT_CACHE_DIR, max_size_bytes: int = DEFAULT_MAX_SIZE_BYTES, enabled: bool = True):
+        """
+        Args:
+            cache_dir: Directory holding the cache entries
+            max_size_bytes: Total size of the entries above which the oldest ones are evicted
+            enabled: If False, the cache is bypassed: nothing is read from or written to disk
+        """
+        self.cache_dir = cache_dir
+        self.max_size_bytes = max_size_bytes
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._size_bytes: int | None = None
+
+    def is_cacheable(self, task: Task) -> bool:
+        return self.enabled and not task.tools
+
+    def key(self, task: Task, inputs: dict[str, Any], context_outputs: list[TaskOutput]) -> str:
+        """Hash everything that determines the output of the task"""
+        agent = task.agent
+        llm = agent.llm
+        output_model = task.output_json or task.output_pydantic
+        payload = {
+            'task': {
+                'name': task.name,
+                'description': task.description,
+                'expected_output': task.expected_output,
+                'output_schema': output_model.model_json_schema() if output_model else None,
+            },
+            'agent': {
+                'role': agent.role,
+                'goal': agent.goal,
+                'backstory': agent.backstory,
+            },
+            'llm': {
+                'model': getattr(llm, 'model', str(llm)),
+                'temperature': getattr(llm, 'temperature', None),
+                'top_p': getattr(llm, 'top_p', None),
+                'max_tokens': getattr(llm, 'max_tokens', None) or getattr(llm, 'max_completion_tokens', None),
+            },
+            'inputs': inputs,
+            'context': [output.raw for output in context_outputs],
+        }
+        return hashlib.sha256(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+    def get(self, key: str, task: Task) -> TaskOutput | None:
+        """Load a cached output, validating it again against the output model of the task"""
+        if not self.enabled:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+            output_model = task.output_json or task.output_pydantic
+            json_dict = entry['json_dict']
+            pydantic_output = None
+            if output_model is not None:
+                model = output_model.model_validate(json_dict)
+                json_dict = model.model_dump()
+                pydantic_output = model if task.output_pydantic else None
+            os.utime(path)  # mark as recently used
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        except Exception as e:
+            print(f'Ignoring unreadable cache entry {path}: {e}')
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return TaskOutput(
+            name=task.name,
+            description=task.description,
+            expected_output=task.expected_output,
+            raw=entry['raw'],
+            pydantic=pydantic_output,
+            json_dict=json_dict,
+            agent=entry['agent'],
+            output_format=OutputFormat(entry['output_format']),
+        )
+
+    def put(self, key: str, output: TaskOutput) -> None:
+        if not self.enabled:
+            return
+        entry = {
+            'name': output.name,
+            'raw': output.raw,
+            'json_dict': output.json_dict if output.json_dict is not None else (
+                output.pydantic.model_dump() if output.pydantic else None
+            ),
+            'agent': output.agent,
+            'output_format': output.output_format.value,
+        }
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{threading.get_ident()}.tmp'
+        data = json.dumps(entry, ensure_ascii=False).encode('utf-8')
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        self._grow(len(data))
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], f'{key}.json')
+
+    def _grow(self, size: int) -> None:
+        """Count an entry written and evict once the cache is over its max size"""
+        with self._lock:
+            if self._size_bytes is None:
+                self._size_bytes = self._scan_size()
+            else:
+                self._size_bytes += size
+            if self._size_bytes > self.max_size_bytes:
+                self._size_bytes = self._evict(int(self.max_size_bytes * EVICTION_LOW_WATERMARK))
+
+    def _entries(self) -> list[tuple[float, int, str]]:
+        """(mtime, size, path) of every entry, skipping the ones removed meanwhile by other processes"""
+        entries = []
+        for root, _, files in os.walk(self.cache_dir):
+            for file in files:
+                if file.endswith('.json'):
+                    path = os.path.join(root, file)
+                    try:
+                        stat = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def _scan_size(self) -> int:
+        return sum(size for _, size, _ in self._entries())
+
+    def _evict(self, target_size: int) -> int:
+        """
+        Remove the least recently used entries until the cache fits in `target_size`.
+
+        Returns:
+            int: The size of the entries left
+        """
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= target_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass  # already evicted by another process
+            total -= size
+        return total
@@ -0,0 +1,123 @@
+"""
+Checkpoints of a book run, saved in `output_dir/checkpoints` as soon as each piece completes.
+
+Task outputs are saved one JSON file per task, and the generated artifacts (images, audio,
+pages) are recorded with a key of the inputs they were made from. A run resumed from the same
+`output_dir` reloads the task outputs and skips every artifact whose key did not change, so a
+failure late in the pipeline does not cost the LLM calls made before it. The task outputs were
+made from the inputs of that run, so it can only be resumed with the same inputs.
+"""
+import json
+import os
+import threading
+
+from crewai.tasks.task_output import TaskOutput
+
+
+CHECKPOINT_DIR = 'checkpoints'
+
+
+class InputsMismatchError(ValueError):
+    """Raised when a run is resumed with other inputs than the ones its checkpoints were made from"""
+
+    def __init__(self, output_dir: str, changed: dict[str, tuple]):
+        self.changed = changed
+        differences = ', '.join(f'{key} {saved!r} -> {requested!r}' for key, (saved, requested) in changed.items())
+        super().__init__(
+            f'Cannot resume {output_dir} with other inputs ({differences}), its task outputs were made '
+            f'from the saved ones. Start a new book instead, the task output cache still reuses the unchanged stages'
+        )
+
+
+class CheckpointStore:
+    """Task outputs and artifact records of one book"""
+
+    def __init__(self, output_dir: str):
+        self.output_dir = output_dir
+        self.checkpoint_dir = os.path.join(output_dir, CHECKPOINT_DIR)
+        self._artifacts_file = os.path.join(self.checkpoint_dir, 'artifacts.json')
+        self._lock = threading.Lock()
+        os.makedirs(self.checkpoint_dir, exist_ok=True)
+
+    def save_inputs(self, inputs: dict) -> None:
+        self._write_json(os.path.join(self.checkpoint_dir, 'inputs.json'), inputs)
+
+    def load_inputs(self) -> dict:
+        with open(os.path.join(self.checkpoint_dir, 'inputs.json'), 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def check_inputs(self, inputs: dict) -> None:
+        """
+        Make sure the checkpoints were made from `inputs` before they are reused.
+
+        Raises:
+            InputsMismatchError: If an input differs from the saved ones
+        """
+        saved = self.load_inputs()
+        # compared as they are saved, e.g. a tuple of languages as a list
+        requested = json.loads(json.dumps(inputs))
+        changed = {key: (saved.get(key), requested.get(key)) for key in sorted(set(saved) | set(requested)) if saved.get(key) != requested.get(key)}
+        if changed:
+            raise InputsMismatchError(self.output_dir, changed)
+
+    def save_task_output(self, output: TaskOutput) -> None:
+        """Stage-completion hook saving the output of a task"""
+        self._write_json(os.path.join(self.checkpoint_dir, f'{output.name}.json'), output.model_dump(exclude={'pydantic'}))
+
+    def load_task_outputs(self) -> dict[str, TaskOutput]:
+        """Task name -> output of every task that completed in a previous run"""
+        outputs = {}
+        for file_name in sorted(os.listdir(self.checkpoint_dir)):
+            if not file_name.endswith('_task.json'):
+                continue
+            with open(os.path.join(self.checkpoint_dir, file_name), 'r', encoding='utf-8') as f:
+                output = TaskOutput.model_validate(json.load(f))
+            outputs[output.name] = output
+        return outputs
+
+    def artifact_done(self, name: str, key: str) -> bool:
+        """True if artifact `name` was produced from inputs with the same `key` and its files still exist"""
+        record = self._load_artifacts().get(name)
+        return (
+            record is not None
+            and record['key'] == key
+            and all(os.path.exists(os.path.join(self.output_dir, file)) for file in record['files'])
+        )
+
+    def artifact_value(self, name: str):
+        return self._load_artifacts()[name].get('value')
+
+    def mark_artifact(self, name: str, key: str, files: list[str], value=None) -> None:
+        """
+        Record that artifact `name` was produced.
+
+        Args:
+            name: Artifact name, e.g. 'audio' or 'page_3'
+            key: Key of the inputs the artifact was made from
+            files: Files of the artifact, relative to output_dir
+            value: Optional JSON-serializable result of the stage to reuse on resume
+        """
+        with self._lock:
+            artifacts = self._load_artifacts()
+            artifacts[name] = {'key': key, 'files': files, 'value': value}
+            self._write_json(self._artifacts_file, artifacts)
+
+    def invalidate_artifacts(self, names: list[str]) -> None:
+        """Forget artifacts, so that the next run makes them again even if their key did not change"""
+        with self._lock:
+            artifacts = self._load_artifacts()
+            for name in names:
+                artifacts.pop(name, None)
+            self._write_json(self._artifacts_file, artifacts)
+
+    def _load_artifacts(self) -> dict:
+        if not os.path.exists(self._artifacts_file):
+            return {}
+        with open(self._artifacts_file, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def _write_json(self, path: str, data) -> None:
+        tmp_path = f'{path}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=4, ensure_ascii=False)
+        os.replace(tmp_path, path)
@@ -0,0 +1,168 @@
+"""
+Process-wide shared clients, created on first use.
+
+Nothing is constructed (and no credential is needed) when a module is imported: the LLMs, the
+ElevenLabs and Hugging Face clients, the image store, the image backend router, the image
+transcoding pool and the worker threads of the async books are built the first time they are asked for, once per process, and `.env` is
+loaded once before the first of them.
+
+    from v0 import clients
+    llm = clients.llm('claude')
+    eleven_labs = clients.eleven_labs()
+
+`override` replaces clients temporarily, e.g. with local fakes in the benchmark.
+"""
+import os
+import threading
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, Any, Callable, Iterator
+
+if TYPE_CHECKING:
+    from concurrent.futures import ThreadPoolExecutor
+
+    from crewai import LLM
+    from elevenlabs.client import ElevenLabs
+    from huggingface_hub import InferenceClient
+
+    from v0.image_providers import ImageRouter
+    from v0.image_store import ImageStore
+    from v0.image_variants import ImageVariantMaker
+    from v0.rate_limit import RateLimiter
+
+
+BEDROCK_CLAUDE = "bedrock/us.anthropic.claude-3-5-sonnet-20241022-v2:0"
+BEDROCK_CLAUDE_HAIKU = "bedrock/us.anthropic.claude-3-5-haiku-20241022-v1:0"
+
+# name -> (model, temperature)
+LLMS = {
+    'claude': (BEDROCK_CLAUDE, 0.8),
+    'claude_low_tmp': (BEDROCK_CLAUDE, 0.1),
+    'claude_haiku': (BEDROCK_CLAUDE_HAIKU, 0.1),
+    'deepseek_r1': ("deepseek/deepseek-reasoner", 0.8),  # TODO 框架不支持
+}
+
+_instances: dict[str, Any] = {}
+_lock = threading.RLock()
+_environment_loaded = False
+
+
+def load_environment() -> None:
+    """Load `.env` into the environment, only the first time it is called"""
+    global _environment_loaded
+    with _lock:
+        if not _environment_loaded:
+            from dotenv import load_dotenv
+            load_dotenv()
+            _environment_loaded = True
+
+
+def get(name: str, factory: Callable[[], Any]) -> Any:
+    """The shared instance called `name`, created with `factory` on first use"""
+    instance = _instances.get(name)
+    if instance is None:
+        with _lock:
+            instance = _instances.get(name)
+            if instance is None:
+                load_environment()
+                instance = _instances[name] = factory()
+    return instance
+
+
+def llm(name: str, temperature: float | None = None, max_tokens: int | None = None) -> 'LLM':
+    """
+    One of the `LLMS` (e.g. 'claude') or any litellm model, optionally with its own temperature
+    (instead of the one of `LLMS`) and max tokens.
+    """
+    model, default_temperature = LLMS.get(name, (name, None))
+    if temperature is None:
+        temperature = default_temperature
+
+    def create() -> 'LLM':
+        from v0.llm import RateLimitedLLM
+        return RateLimitedLLM(model=model, temperature=temperature, max_tokens=max_tokens)
+
+    if temperature == default_temperature and max_tokens is None:
+        return get(f'llm:{name}', create)
+    return get(f'llm:{name}:{temperature}:{max_tokens}', create)
+
+
+def eleven_labs() -> 'ElevenLabs':
+    def create() -> 'ElevenLabs':
+        from elevenlabs.client import ElevenLabs
+        return ElevenLabs(api_key=os.getenv("ELEVENLABS_API_KEY"))
+
+    return get('eleven_labs', create)
+
+
+def hf_inference() -> 'InferenceClient':
+    def create() -> 'InferenceClient':
+        from huggingface_hub import InferenceClient
+        return InferenceClient("black-forest-labs/FLUX.1-dev", token=os.getenv("HF_TOKEN"))
+
+    return get('hf_inference', create)
+
+
+def image_store() -> 'ImageStore':
+    def create() -> 'ImageStore':
+        from v0.image_store import ImageStore
+        return ImageStore()
+
+    return get('image_store', create)
+
+
+def image_router() -> 'ImageRouter':
+    """Routing between the image backends, shared so that their health statistics cover every book"""
+    def create() -> 'ImageRouter':
+        from v0.image_providers import default_router
+        return default_router()
+
+    return get('image_router', create)
+
+
+def image_variants() -> 'ImageVariantMaker':
+    """Process pool transcoding the illustrations, shared so that concurrent books do not multiply its memory"""
+    def create() -> 'ImageVariantMaker':
+        from v0.image_variants import ImageVariantMaker
+        return ImageVariantMaker()
+
+    return get('image_variants', create)
+
+
+def book_executor() -> 'ThreadPoolExecutor':
+    """Worker threads running the books of `v0.async_api`, at most `BOOK_WORKERS` (64 by default) at the same time"""
+    def create() -> 'ThreadPoolExecutor':
+        from concurrent.futures import ThreadPoolExecutor
+        return ThreadPoolExecutor(max_workers=int(os.getenv('BOOK_WORKERS', '64')), thread_name_prefix='book')
+
+    return get('book_executor', create)
+
+
+def rate_limiter(provider: str) -> 'RateLimiter':
+    """
+    Rate limiter of a provider ('bedrock', 'fal', 'hf', 'elevenlabs'...), shared by every book of the
+    process, and by the processes of the host if `RATE_LIMIT_STATE_DIR` is set.
+    """
+    def create() -> 'RateLimiter':
+        from v0.rate_limit import RateLimiter, rate_limit_for
+        return RateLimiter(provider, rate_limit_for(provider), os.getenv('RATE_LIMIT_STATE_DIR'))
+
+    return get(f'rate_limiter:{provider}', create)
+
+
+@contextmanager
+def override(**clients: Any) -> Iterator[None]:
+    """
+    Temporarily replace shared clients, e.g. `override(**{'llm:claude': fake_llm, 'eleven_labs': fake_tts})`.
+    """
+    with _lock:
+        previous = {name: _instances.get(name) for name in clients}
+        _instances.update(clients)
+    try:
+        yield
+    finally:
+        with _lock:
+            for name, instance in previous.items():
+                if instance is None:
+                    _instances.pop(name, None)
+                else:
+                    _instances[name] = instance
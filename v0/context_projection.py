@@ -0,0 +1,70 @@
+"""
+Field-level projection of the context handed to a task.
+
+By default a task receives the whole raw output of every task of its `context=` list. A task can
+declare in tasks.yaml which fields of each upstream output it actually needs,
+
+    create_illustrations_task:
+      context_fields:
+        write_story_content_task: [pages.content]
+        design_art_direction_task: [character_designs, art_style]
+
+and only those reach its prompt. A dotted path goes into nested objects, applied to every item of
+a list on the way (`pages.content` keeps the text of every page). An upstream task listed with no
+field is left out of the prompt, while the task still waits for it. Upstream tasks that are not
+listed, and outputs that are not JSON, are passed whole.
+"""
+import json
+from typing import Any
+
+from crewai.tasks.task_output import TaskOutput
+
+
+# upstream task name -> fields of its output, for one task
+ContextFields = dict[str, list[str]]
+
+
+def field_tree(fields: list[str]) -> dict[str, Any]:
+    """Dotted paths as a tree, e.g. ['pages.content', 'title'] -> {'pages': {'content': {}}, 'title': {}}"""
+    tree: dict[str, Any] = {}
+    for path in fields:
+        node = tree
+        for key in path.split('.'):
+            node = node.setdefault(key, {})
+    return tree
+
+
+def project(value: Any, tree: dict[str, Any]) -> Any:
+    """The parts of `value` selected by a field tree, missing fields are skipped"""
+    if not tree:
+        return value
+    if isinstance(value, list):
+        return [project(item, tree) for item in value]
+    if isinstance(value, dict):
+        return {key: project(value[key], subtree) for key, subtree in tree.items() if key in value}
+    return value
+
+
+def project_context(context_outputs: list[TaskOutput], context_fields: ContextFields | None) -> list[TaskOutput]:
+    """
+    The context outputs reduced to the declared fields, in the same order.
+
+    Args:
+        context_outputs: Outputs of the context tasks
+        context_fields: Upstream task name -> fields of its output to keep, None keeps everything
+
+    Returns:
+        list[TaskOutput]: Copies of the projected outputs (the others as they are), without the
+            upstream tasks declared with no field
+    """
+    if not context_fields:
+        return context_outputs
+    projected = []
+    for output in context_outputs:
+        fields = context_fields.get(output.name)
+        if fields is None or output.json_dict is None:
+            projected.append(output)
+        elif fields:
+            json_dict = project(output.json_dict, field_tree(fields))
+            projected.append(output.model_copy(update={'json_dict': json_dict, 'raw': json.dumps(json_dict, ensure_ascii=False)}))
+    return projected
@@ -0,0 +1,56 @@
+"""
+Output converter of the crew tasks that repairs malformed JSON locally before re-prompting.
+
+crewai hands an answer that does not parse into the task's `output_json` model to a converter,
+which asks the LLM to convert it again. `RepairingConverter` first tries `parse_model` and only
+calls the LLM if the answer cannot be repaired.
+"""
+from typing import ClassVar
+
+from crewai.utilities.converter import Converter
+
+from v0.metrics import MetricsRecorder
+from v0.output_repair import parse_model
+
+
+REPROMPTS_AVOIDED = 'json_reprompts_avoided'
+REPROMPTS = 'json_reprompts'
+
+
+class RepairingConverter(Converter):
+    """Converter trying a local repair of the answer before asking the LLM to convert it"""
+
+    # receives the number of re-prompts avoided and made, see `repairing_converter`
+    metrics: ClassVar[MetricsRecorder | None] = None
+
+    def to_pydantic(self, current_attempt=1):
+        # crewai calls this again with the next attempt number when the LLM conversion fails
+        if current_attempt == 1:
+            repaired = parse_model(self.text, self.model)
+            if repaired is not None:
+                self._count(REPROMPTS_AVOIDED)
+                return repaired
+            self._count(REPROMPTS)
+        return super().to_pydantic(current_attempt)
+
+    def to_json(self, current_attempt=1):
+        if current_attempt == 1:
+            repaired = parse_model(self.text, self.model)
+            if repaired is not None:
+                self._count(REPROMPTS_AVOIDED)
+                return repaired.model_dump_json()
+            self._count(REPROMPTS)
+        return super().to_json(current_attempt)
+
+    def _count(self, counter: str) -> None:
+        if counter == REPROMPTS_AVOIDED:
+            print(f'Repaired the malformed {self.model.__name__} output locally')
+        else:
+            print(f'Could not repair the {self.model.__name__} output, asking the LLM to convert it')
+        if self.metrics is not None:
+            self.metrics.increment(counter)
+
+
+def repairing_converter(metrics: MetricsRecorder | None) -> type[RepairingConverter]:
+    """A `RepairingConverter` counting into `metrics`, to pass as `converter_cls` of a task"""
+    return type('RepairingConverter', (RepairingConverter,), {'metrics': metrics})
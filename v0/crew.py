@@ -1,41 +1,326 @@
 import datetime
 import json
 import os
+import threading
+from concurrent.futures import Future
+from typing import Callable
+
 from crewai import LLM, Agent, Crew, Process, Task
+from crewai.agents.agent_builder.utilities.base_token_process import TokenProcess
 from crewai.project import CrewBase, agent, crew, task
-from dotenv import load_dotenv
-from jinja2 import Template
-from elevenlabs.client import ElevenLabs
-
-
-from v0.pydantic_models import ArtDirection, IllustrationPrompts, Illustrations, PageContent, PageContents, ResearchResult, StoryOutline, TranslatedContents
+from crewai.tasks.task_output import TaskOutput
+from crewai.utilities.formatter import aggregate_raw_outputs_from_task_outputs
+from crewai.utilities.token_counter_callback import TokenCalcHandler
+from pydantic import BaseModel
+
+
+from v0 import clients, streaming
+from v0.audio import generate_book_audio
+from v0.cache import TaskOutputCache
+from v0.checkpoint import CheckpointStore
+from v0.context_projection import ContextFields, project_context
+from v0.converter import repairing_converter
+from v0.image_batch import CACHED_BACKEND, BatchImageGenerationError, BatchImageGenerator, build_prompt
+from v0.metrics import MetricsRecorder
+from v0.pipeline import TRANSLATE_CONTENT_TASK, BookPostProcessor, language_directory, translation_task_name
+from v0.output_repair import parse_model
+from v0.pydantic_models import ArtDirection, IllustrationPrompt, IllustrationPrompts, Illustrations, PageContent, PageContents, ResearchResult, StoryOutline, TranslatedContents
+from v0.render import clean_template
+from v0.run_control import BookCancelled, RunControl
+from v0.scheduler import DirectStage, ParallelTaskScheduler, build_task_output
+from v0.streaming import ArrayItemParser, PageJobs, json_messages
+from v0.template_store import TemplateStore
 from v0.tools.image_generation import BatchImageGenerationTool
 
 
-load_dotenv()
-
-
-claude = LLM(model="bedrock/us.anthropic.claude-3-5-sonnet-20241022-v2:0", temperature=0.8)
-claude_low_tmp = LLM(model="bedrock/us.anthropic.claude-3-5-sonnet-20241022-v2:0", temperature=0.1)
-deepseek_r1 = LLM(model="deepseek/deepseek-reasoner", temperature=0.8)  # TODO 框架不支持
-ELEVENLABS_API_KEY = os.getenv("ELEVENLABS_API_KEY")
-eleven_labs_client = ElevenLabs(api_key=ELEVENLABS_API_KEY)
-
-
-
 @CrewBase
 class StoryBookCrew():
     """Story book creation crew"""
     agents_config = 'config/agents.yaml'
     tasks_config = 'config/tasks.yaml'
 
+    def __init__(self, metrics: MetricsRecorder | None = None, max_concurrency: int = 4, template_store: TemplateStore | None = None, streaming: bool = False, on_page_image: Callable[[int, str], None] | None = None, target_languages: list[str] | None = None, run_control: RunControl | None = None):
+        # recorder and maximum number in flight of the fal jobs made by the image tools
+        self.metrics = metrics
+        # progress and cancellation of the book, checked by the image generation and the streamed answers
+        self.run_control = run_control
+        self.max_concurrency = max_concurrency
+        # stored page templates, reused instead of asking the page_designer agent
+        self.template_store = template_store
+        # repairs malformed JSON answers locally before re-prompting, counted in the metrics
+        self.converter_cls = repairing_converter(metrics)
+        # streaming mode: the story and the illustration prompts are streamed, and the translation
+        # and the image of every page start as soon as the page is complete
+        self.streaming = streaming
+        self.on_page_image = on_page_image
+        # translate_content_task translates into the first language (the target_language input),
+        # a copy of it into each of the others, everything else is shared by the languages
+        self.target_languages = target_languages or []
+        self.translation_tasks: dict[str, Task] = {}
+        # task name -> model of its agent, for the tasks routed to a fast model
+        self.fallback_llms: dict[str, LLM] = {}
+        # translation task name -> usage of its page translations, moved to its translator once the task runs
+        self._translation_usage: dict[str, TokenProcess] = {}
+        if streaming:
+            self._translations = PageJobs(max_concurrency, 'translate-page')
+            self._images = PageJobs(max_concurrency, 'image-page')
+            self._page_image_generator = self.image_generator()
+            # page index -> prompt of its image, the images of prompts discarded since are not reported
+            self._page_prompts: dict[int, str] = {}
+            self._page_prompts_lock = threading.Lock()
+
+    def close(self) -> None:
+        """Wait for the page jobs of the streaming mode"""
+        if self.streaming:
+            self._translations.shutdown()
+            self._images.shutdown()
+
+    def image_generator(self) -> BatchImageGenerator:
+        return BatchImageGenerator(image_store=clients.image_store(), metrics=self.metrics, max_concurrency=self.max_concurrency, run_control=self.run_control)
+
+    def direct_stages(self, inputs: dict[str, str]) -> dict[str, DirectStage]:
+        """Tasks run by the scheduler without their agent (or before it)"""
+        stages = {
+            'generate_illustrations_task': self.generate_illustrations,
+            'generate_html_pages_task': lambda task, context_outputs: self.reuse_template(task, inputs['age_range']),
+        }
+        if self.streaming:
+            stages.update({
+                'write_story_content_task': self.stream_story_content,
+                'create_illustrations_task': self.stream_illustration_prompts,
+            })
+            stages.update({name: self.collect_translations for name in self.translation_tasks})
+        return stages
+
+    def art_style(self) -> str:
+        return self.design_art_direction_task().output.json_dict['art_style']
+
+    def generate_illustrations(self, task: Task, context_outputs: list[TaskOutput]) -> TaskOutput:
+        """
+        Direct stage of generate_illustrations_task: the validated prompts and art direction go
+        straight into the image generator, instead of an LLM copying them into a tool call.
+        The images keep the order of the prompts.
+        """
+        outputs = {output.name: output for output in context_outputs}
+        art_direction = ArtDirection.model_validate(outputs['design_art_direction_task'].json_dict)
+        illustration_prompts = IllustrationPrompts.model_validate(outputs['create_illustrations_task'].json_dict)
+        character_designs = [character_design.model_dump() for character_design in art_direction.character_designs]
+        prompts = [
+            build_prompt(illustration_prompt.model_dump(), character_designs, art_direction.color_palette, art_direction.art_style)
+            for illustration_prompt in illustration_prompts.illustration_prompts
+        ]
+        if self.streaming:
+            # the images of the streamed prompts are already generating
+            generator = self._page_image_generator
+            illustration_paths = self.collect_images(prompts)
+        else:
+            generator = self.image_generator()
+            illustration_paths = generator.generate_batch(prompts)
+        illustrations = Illustrations(
+            image_size=f"{generator.image_size['width']}x{generator.image_size['height']}",
+            illustration_paths=illustration_paths,
+            backends=[generator.backends.get(prompt, CACHED_BACKEND) for prompt in prompts],
+        )
+        return build_task_output(task, illustrations)
+
+    def stream_pages(self, task: Task, context_outputs: list[TaskOutput], model: type[BaseModel], field: str, item_model: type[BaseModel], on_item: Callable[[int, BaseModel], None]) -> TaskOutput | None:
+        """
+        Stream the answer of the agent of `task` and call `on_item` with every object of its `field`
+        list as soon as it is complete. None (the agent runs the task) if the answer does not parse.
+        """
+        context = project_context(context_outputs, self.context_fields().get(task.name))
+        messages = json_messages(task, aggregate_raw_outputs_from_task_outputs(context), model)
+        parser = ArrayItemParser(field, item_model)
+        emitted = 0
+        for chunk in streaming.stream_completion(task.agent.llm, messages, task.agent._token_process):
+            if self.run_control is not None:
+                self.run_control.raise_if_cancelled()
+            for item in parser.feed(chunk):
+                on_item(emitted, item)
+                emitted += 1
+        result = parse_model(parser.text, model)
+        if result is None:
+            print(f'Could not parse the streamed answer of {task.name}, asking the agent instead')
+            return None
+        for i, item in enumerate(getattr(result, field)[emitted:], start=emitted):
+            on_item(i, item)
+        return build_task_output(task, result)
+
+    def stream_story_content(self, task: Task, context_outputs: list[TaskOutput]) -> TaskOutput | None:
+        """Streaming stage of write_story_content_task: every page is sent to translation (into every language) as soon as it is written"""
+        pages: list[PageContent] = []
+
+        def on_page(page_index: int, page: PageContent) -> None:
+            for translation_task in self.translation_tasks.values():
+                self.start_translation(translation_task, page_index, page, pages[:page_index])
+            pages.append(page)
+
+        return self.stream_pages(task, context_outputs, PageContents, 'pages', PageContent, on_page)
+
+    def start_translation(self, task: Task, page_index: int, page: PageContent, previous_pages: list[PageContent]) -> Future:
+        return self._translations.submit(f'{task.name}:{page.model_dump_json()}', self.translate_page, task, page_index, page, previous_pages)
+
+    def translate_page(self, task: Task, page_index: int, page: PageContent, previous_pages: list[PageContent]) -> PageContent:
+        """Translate a single page with the translator of `task`, the previous pages given as context for a consistent tone and names"""
+        if self.run_control is not None:
+            self.run_control.raise_if_cancelled()
+        story_so_far = '\n'.join(previous_page.content for previous_page in previous_pages)
+        messages = json_messages(task, story_so_far, PageContent, instructions=f'Translate only page {page_index+1} of the story: {page.model_dump_json()}')
+        usage = self._translation_usage.setdefault(task.name, TokenProcess())
+        answer = task.agent.llm.call(messages, callbacks=[TokenCalcHandler(usage)])
+        translated_page = parse_model(answer, PageContent)
+        if translated_page is None:
+            raise ValueError(f'Could not parse the translation of page {page_index+1}: {answer[:200]}')
+        return translated_page
+
+    def collect_translations(self, task: Task, context_outputs: list[TaskOutput]) -> TaskOutput | None:
+        """
+        Streaming stage of the translation tasks: the translations of the pages, started while the
+        story was streamed (the missing ones are started now). None (the agent translates the whole
+        story) if a page could not be translated.
+        """
+        story = PageContents.model_validate(context_outputs[0].json_dict)
+        futures = [self.start_translation(task, i, page, story.pages[:i]) for i, page in enumerate(story.pages)]
+        try:
+            translated_pages = [future.result() for future in futures]
+        except Exception as e:
+            print(f'Page translation failed ({e}), asking the agent to translate the whole story instead')
+            return None
+        finally:
+            _move_usage(self._translation_usage.setdefault(task.name, TokenProcess()), task.agent._token_process)
+        return build_task_output(task, TranslatedContents(pages=translated_pages))
+
+    def stream_illustration_prompts(self, task: Task, context_outputs: list[TaskOutput]) -> TaskOutput | None:
+        """Streaming stage of create_illustrations_task: the image of every page starts as soon as its prompt is written"""
+        outputs = {output.name: output for output in context_outputs}
+        art_direction = ArtDirection.model_validate(outputs['design_art_direction_task'].json_dict)
+        character_designs = [character_design.model_dump() for character_design in art_direction.character_designs]
+
+        streamed_prompts = []
+
+        def on_prompt(page_index: int, illustration_prompt: IllustrationPrompt) -> None:
+            prompt = build_prompt(illustration_prompt.model_dump(), character_designs, art_direction.color_palette, art_direction.art_style)
+            streamed_prompts.append(prompt)
+            self.start_image(page_index, prompt)
+
+        output = self.stream_pages(task, context_outputs, IllustrationPrompts, 'illustration_prompts', IllustrationPrompt, on_prompt)
+        if output is None:
+            # the agent writes the prompts again: the images of the streamed ones are dropped,
+            # and cancelled if they did not start
+            with self._page_prompts_lock:
+                self._page_prompts.clear()
+            for prompt in streamed_prompts:
+                self._images.cancel(prompt)
+        return output
+
+    def start_image(self, page_index: int, prompt: str) -> Future:
+        with self._page_prompts_lock:
+            self._page_prompts[page_index] = prompt
+        future = self._images.submit(prompt, self._page_image_generator.generate_page, prompt, page_index)
+        if self.on_page_image is not None:
+            future.add_done_callback(lambda done: not done.cancelled() and done.exception() is None and self._report_page_image(page_index, prompt, done.result()))
+        return future
+
+    def _report_page_image(self, page_index: int, prompt: str, path: str) -> None:
+        with self._page_prompts_lock:
+            # unless the prompt was discarded with a streamed answer that did not parse
+            if self._page_prompts.get(page_index) == prompt:
+                self.on_page_image(page_index, path)
+
+    def collect_images(self, prompts: list[str]) -> list[str]:
+        """
+        The images of the pages, started while the prompts were streamed (the missing ones are started now).
+
+        Raises:
+            BatchImageGenerationError: If some pages failed after all retries
+        """
+        futures = [self.start_image(i, prompt) for i, prompt in enumerate(prompts)]
+        results: list[str | None] = []
+        failed_indexes = []
+        for i, future in enumerate(futures):
+            try:
+                results.append(future.result())
+            except Exception as e:
+                print(f"Page {i} failed: {e}")
+                results.append(None)
+                failed_indexes.append(i)
+        if failed_indexes:
+            raise BatchImageGenerationError(failed_indexes, results)
+        return results
+
+    def reuse_template(self, task: Task, age_range: str) -> TaskOutput | None:
+        """
+        Direct stage of generate_html_pages_task: a stored template matching the age range and art
+        style of the book skips the page_designer agent. None (the agent runs) if there is none.
+        """
+        if self.template_store is None:
+            return None
+        html_template = self.template_store.lookup(age_range, self.art_style())
+        if html_template is None:
+            return None
+        print(f'Reusing a stored page template for {age_range} / {self.art_style()}')
+        return build_task_output(task, html_template)
+
+    def save_template(self, output: TaskOutput, age_range: str) -> None:
+        """Add the template of the page_designer agent to the template store, if it is valid"""
+        if self.template_store is not None:
+            self.template_store.save(clean_template(output.raw), age_range, self.art_style())
+
+    def agent_llm(self, agent_name: str, fast: bool = False) -> LLM | None:
+        """
+        LLM of an agent according to the `llm_config` of agents.yaml, or with `fast` its `fast_model`
+        (None if it has none).
+        """
+        llm_config = self.agents_config[agent_name].get('llm_config', {})
+        model = llm_config.get('fast_model') if fast else llm_config.get('model', 'claude')
+        if model is None:
+            return None
+        return clients.llm(model, llm_config.get('temperature'), llm_config.get('max_tokens'))
+
+    def context_fields(self) -> dict[str, ContextFields]:
+        """
+        Task name -> fields of its context outputs that reach its prompt, according to the
+        `context_fields` of tasks.yaml, for the upstream tasks in its context (in this mode).
+        """
+        projections = {}
+        for declared_task in self.tasks:
+            context_fields = self.tasks_config.get(declared_task.name, {}).get('context_fields')
+            if context_fields:
+                context_names = {context_task.name for context_task in declared_task.context or []}
+                projections[declared_task.name] = {name: fields for name, fields in context_fields.items() if name in context_names}
+        return projections
+
+    def route_to_fast_models(self, tasks: list[Task]) -> list[Agent]:
+        """
+        Run the tasks marked `complexity: low` in tasks.yaml on a copy of their agent using its fast
+        model, their agent's own model becomes their fallback (see `fallback_llms`).
+
+        Returns:
+            list[Agent]: The copies of the agents, to add to the crew
+        """
+        agent_names = {config['role']: name for name, config in self.agents_config.items()}
+        routed_agents = []
+        for routed_task in tasks:
+            # the copies of translate_content_task for the other languages have its config
+            task_name = TRANSLATE_CONTENT_TASK if routed_task.name in self.translation_tasks else routed_task.name
+            if self.tasks_config[task_name].get('complexity') != 'low' or routed_task.agent is None:
+                continue
+            fast_llm = self.agent_llm(agent_names[routed_task.agent.role], fast=True)
+            if fast_llm is None:
+                continue
+            self.fallback_llms[routed_task.name] = routed_task.agent.llm
+            routed_task.agent = routed_task.agent.copy()
+            routed_task.agent.llm = fast_llm
+            routed_agents.append(routed_task.agent)
+        return routed_agents
+
     @agent
     def researcher(self) -> Agent:
         return Agent(
             config=self.agents_config['researcher'],
             verbose=True,
             memory=False,
-            llm=claude,
+            llm=self.agent_llm('researcher'),
         )
     
     @agent
@@ -44,7 +329,7 @@ class StoryBookCrew():
             config=self.agents_config['story_outline_planner'],
             verbose=True,
             memory=False,
-            llm=claude,
+            llm=self.agent_llm('story_outline_planner'),
         )
     
     @agent
@@ -53,7 +338,7 @@ class StoryBookCrew():
             config=self.agents_config['childrens_book_writer'],
             verbose=True,
             memory=False,
-            llm=claude,
+            llm=self.agent_llm('childrens_book_writer'),
         )
 
     @agent
@@ -62,7 +347,7 @@ class StoryBookCrew():
             config=self.agents_config['art_director'],
             verbose=True,
             memory=False,
-            llm=claude,
+            llm=self.agent_llm('art_director'),
         )
 
     @agent
@@ -71,8 +356,8 @@ class StoryBookCrew():
             config=self.agents_config['illustrator'],
             verbose=True,
             memory=False,
-            llm=claude_low_tmp,
-            tools=[BatchImageGenerationTool()]
+            llm=self.agent_llm('illustrator'),
+            tools=[BatchImageGenerationTool(generator=self.image_generator())]
         )
 
     @agent
@@ -81,7 +366,7 @@ class StoryBookCrew():
             config=self.agents_config['translator'],
             verbose=True,
             memory=False,
-            llm=claude_low_tmp,
+            llm=self.agent_llm('translator'),
         )
     
     @agent
@@ -90,7 +375,7 @@ class StoryBookCrew():
             config=self.agents_config['page_designer'],
             verbose=True,
             memory=False,
-            llm=claude,
+            llm=self.agent_llm('page_designer'),
         )
 
     @task
@@ -98,7 +383,8 @@ class StoryBookCrew():
         return Task(
             config=self.tasks_config['research_story_theme_task'],
             agent=self.researcher(),
-            output_json=ResearchResult
+            output_json=ResearchResult,
+            converter_cls=self.converter_cls,
         )
 
     @task
@@ -107,7 +393,8 @@ class StoryBookCrew():
             config=self.tasks_config['develop_story_outline_task'],
             agent=self.story_outline_planner(),
             context=[self.research_story_theme_task()],
-            output_json=StoryOutline
+            output_json=StoryOutline,
+            converter_cls=self.converter_cls,
         )
 
     @task
@@ -116,7 +403,8 @@ class StoryBookCrew():
             config=self.tasks_config['write_story_content_task'],
             agent=self.childrens_book_writer(),
             context=[self.develop_story_outline_task()],
-            output_json=PageContents
+            output_json=PageContents,
+            converter_cls=self.converter_cls,
         )
 
     @task
@@ -124,8 +412,11 @@ class StoryBookCrew():
         return Task(
             config=self.tasks_config['design_art_direction_task'],
             agent=self.art_director(),
-            context=[self.develop_story_outline_task(), self.write_story_content_task()],
-            output_json=ArtDirection
+            # streaming: the art direction only needs the characters of the outline, so it runs
+            # while the story is written and the prompts can start right after the last page
+            context=[self.develop_story_outline_task()] if self.streaming else [self.develop_story_outline_task(), self.write_story_content_task()],
+            output_json=ArtDirection,
+            converter_cls=self.converter_cls,
         )
 
     @task
@@ -140,6 +431,7 @@ class StoryBookCrew():
             ],
             tools=[],
             output_json=IllustrationPrompts,
+            converter_cls=self.converter_cls,
         )
     
     @task
@@ -152,7 +444,8 @@ class StoryBookCrew():
                 self.create_illustrations_task()
                 ],
             output_json=Illustrations,
-            tools=[BatchImageGenerationTool()]
+            converter_cls=self.converter_cls,
+            tools=[BatchImageGenerationTool(generator=self.image_generator())]
         )
 
     @task
@@ -161,47 +454,69 @@ class StoryBookCrew():
             config=self.tasks_config['translate_content_task'],
             agent=self.translator(),
             context=[self.write_story_content_task()],
-            output_json=TranslatedContents
+            output_json=TranslatedContents,
+            converter_cls=self.converter_cls,
         )
     
+    def translate_content_task_for(self, language: str) -> Task:
+        """
+        Copy of translate_content_task translating into `language` instead of the target_language
+        input, with its own copy of the translator so the languages run (and count tokens) side by side.
+        """
+        config = {key: value.replace('{target_language}', language) for key, value in self.tasks_config['translate_content_task'].items()}
+        return Task(
+            config=config,
+            name=translation_task_name(language),
+            agent=self.translator().copy(),
+            context=[self.write_story_content_task()],
+            output_json=TranslatedContents,
+            converter_cls=self.converter_cls,
+        )
+
     @task
     def generate_html_pages_task(self) -> Task:
         return Task(
             config=self.tasks_config['generate_html_pages_task'],
             agent=self.page_designer(),
+            # streaming: the template does not wait for the images, so every page renders as soon as its image exists
             context=[
                 self.write_story_content_task(),
                 self.translate_content_task(),
-                self.generate_illustrations_task()
+                self.design_art_direction_task() if self.streaming else self.generate_illustrations_task()
             ],
         )
 
     @crew
     def crew(self) -> Crew:
         """Creates the StoryBook crew"""
+        self.translation_tasks = {TRANSLATE_CONTENT_TASK: self.translate_content_task()}
+        for language in self.target_languages[1:]:
+            translation_task = self.translate_content_task_for(language)
+            self.translation_tasks[translation_task.name] = translation_task
+        # the copies for the other languages go right after translate_content_task, the last task stays the final output
+        tasks = list(self.tasks)
+        position = next(i for i, declared_task in enumerate(tasks) if declared_task.name == TRANSLATE_CONTENT_TASK) + 1
+        extra_translation_tasks = list(self.translation_tasks.values())[1:]
+        tasks[position:position] = extra_translation_tasks
+        extra_agents = [translation_task.agent for translation_task in extra_translation_tasks]
+        extra_agents += self.route_to_fast_models(tasks)
         return Crew(
-            agents=self.agents,
-            tasks=self.tasks,
+            agents=self.agents + extra_agents,
+            tasks=tasks,
             process=Process.sequential,
             verbose=True,
             output_handler=lambda x: [task.output for task in x.tasks if task.output]
         )
     
 
-def generate_audio(text: str, output_dir: str, file_name: str) -> str:
-    response = eleven_labs_client.text_to_speech.convert(
-        text=text,
-        voice_id="XfNU2rGpBa01ckF309OY",
-        model_id="eleven_multilingual_v2",
-        output_format="mp3_44100_192",
-    )
-    # save to file
-    output_file = os.path.join(output_dir, file_name)
-    with open(output_file, 'wb') as f:
-        for chunk in response:
-            if chunk:
-                f.write(chunk)
-    return output_file
+def _move_usage(source: TokenProcess, target: TokenProcess) -> None:
+    """Add the counters of `source` to `target` and reset them"""
+    target.sum_prompt_tokens(source.prompt_tokens)
+    target.sum_completion_tokens(source.completion_tokens)
+    target.sum_cached_prompt_tokens(source.cached_prompt_tokens)
+    target.sum_successful_requests(source.successful_requests)
+    source.total_tokens = source.prompt_tokens = source.completion_tokens = source.cached_prompt_tokens = source.successful_requests = 0
+
 
 def generate_html_pages(result: dict, output_dir: str) -> None:
     """
@@ -211,150 +526,147 @@ def generate_html_pages(result: dict, output_dir: str) -> None:
         result: The result dictionary from crew.kickoff()
         output_dir: Directory to save the generated HTML files
     """
-    # Get the template and data from results
-    html_template: str = result['raw']
-
-    # Remove markdown code block if present
-    if html_template.startswith('```html'):
-        html_template = html_template[7:]
-    if html_template.endswith('```'):
-        html_template = html_template[:-3]
-
-    html_template = html_template.strip()
-
-    illustrations: list[str] = result['tasks_output'][-3]['json_dict']['illustration_paths']
-    english_pages: list[PageContent] = result['tasks_output'][-6]['json_dict']['pages']
-    translated_pages: list[PageContent] = result['tasks_output'][-2]['json_dict']['pages']
+    post_processor = BookPostProcessor(output_dir, clients.eleven_labs(), clients.image_store())
+    for task_output in result['tasks_output']:
+        post_processor.on_task_complete(TaskOutput.model_validate(task_output))
+    post_processor.finish()
 
 
-    english_pages_text = '\n'.join([page['content'] for page in english_pages])
-    # for eleven labs
-    audio_file_name = 'audio.mp3'
-    generate_audio(english_pages_text, output_dir, audio_file_name)
-
-    # Save the template
-    template_file = os.path.join(output_dir, 'template.html')
-    with open(template_file, 'w+', encoding='utf-8') as f:
-        f.write(html_template)
-    
-    page_htmls = []
-    # For each page, create an HTML file with the content
-    for i in range(len(illustrations)):
-        page_data = {
-            'illustration_path': illustrations[i],
-            'english_text': english_pages[i]['content'],
-            'translated_text': translated_pages[i]['content'],
-            'english_highlight_vocabulary_word': english_pages[i]['core_vocabulary_word'],
-            'translated_highlight_vocabulary_word': translated_pages[i]['core_vocabulary_word']
-        }
-        
-        # Render the template with the page data
-        # Only format the keys that exist in page_data
-        page_html = html_template
-        
-        # Create template object and render with page data
-        template = Template(page_html)
-        page_html = template.render(**page_data)
-        
-        # Save to a file
-        output_file = os.path.join(output_dir, f'page_{i+1}.html')
-        with open(output_file, 'w+', encoding='utf-8') as f:
-            f.write(page_html)
-        page_htmls.append(page_html)
-
-    # Create a merged HTML file combining all pages horizontally
-    merged_html = f"""
-<!DOCTYPE html>
-<html>
-<head>
-    <meta charset="utf-8">
-    <style>
-        body {{
-            margin: 0;
-            padding: 20px;
-            display: flex;
-            overflow-x: auto;
-            min-height: 100vh;
-        }}
-        .page-container {{
-            display: flex;
-            gap: 20px;
-        }}
-        .page {{
-            flex: 0 0 auto;
-            width: 21cm; /* A4 width */
-            height: 29.7cm; /* A4 height */
-            margin-right: 20px;
-        }}
-        iframe {{
-            width: 100%;
-            height: 120%;
-            border: 1px solid #ccc;
-            box-shadow: 0 0 10px rgba(0,0,0,0.1);
-        }}
-        #audio-player {{
-            position: fixed;
-            top: 20px; /* Hide below viewport */
-            right: 20px;
-            z-index: 1000;
-        }}
-    </style>
-</head>
-<body>
-    <audio id="audio-player" controls autoplay>
-        <source src="{audio_file_name}" type="audio/mpeg">
-        Your browser does not support the audio element.
-    </audio>
-    <div class="page-container">
-        {"".join([f'<div class="page"><iframe src="page_{i+1}.html" frameborder="0"></iframe></div>' for i in range(len(page_htmls))])}
-    </div>
-</body>
-</html>
-"""
-
-    # Save the merged file
-    merged_file = os.path.join(output_dir, 'merged_book.html')
-    with open(merged_file, 'w+', encoding='utf-8') as f:
-        f.write(merged_html)
-
-
-def generate_story_book(story_theme: str, age_range: str, target_language: str, output_dir: str | None = None) -> dict:
+def generate_story_book(story_theme: str | None = None, age_range: str | None = None, target_language: str | list[str] | None = None, output_dir: str | None = None, parallel: bool = True, use_cache: bool = True, resume: str | None = None, max_concurrency: int = 4, template_reuse_rate: float = 0.8, streaming: bool = False, image_format: str | None = 'webp', run_control: RunControl | None = None) -> dict:
     """
     Generate a complete story book with illustrations and translations.
+
+    Every task output and artifact is checkpointed into `output_dir/checkpoints` as it completes,
+    and the latency, tokens and cost of every stage are written to `output_dir/metrics.json`.
+
+    With several target languages, the research, story, illustrations, narration and template
+    are produced once, and only the translation and the pages fan out per language: the pages
+    and merged book of each language go into `output_dir/<language>/` and use the images and
+    audio of `output_dir`.
     
     Args:
         story_theme: Theme/topic of the story
         age_range: Target age range (e.g. '1-6')
-        target_language: Language to translate the story into
+        target_language: Language to translate the story into, or a list of languages to make
+            the same book in each of them
         output_dir: Optional directory to save HTML output files. If None, uses timestamped directory.
+        parallel: Run independent tasks at the same time following their declared context
+            (the critical path is written to schedule.json). If False, tasks run one at a time in
+            declaration order.
+        use_cache: Reuse the outputs of LLM tasks whose config, model, inputs and upstream outputs
+            did not change since a previous run. Set to False to bypass the cache.
+        resume: Output directory of a run that failed midway. Its checkpoints are reloaded and only
+            the missing tasks and artifacts are produced again. The inputs default to the ones of
+            that run, and must be the same if given.
+        max_concurrency: Maximum number of image generation and TTS requests in flight.
+        template_reuse_rate: Probability of reusing a stored page template of the same age range and
+            art style instead of asking the page_designer agent for a new one. 0 always generates.
+        streaming: Stream the story and the illustration prompts, and start the translation and the
+            image of every page as soon as it is written instead of after the whole list. The art
+            direction and the page template then no longer wait for the story text and the images.
+        image_format: Transcode every illustration to 'webp' or 'avif' (WebP if this Pillow cannot
+            encode AVIF) in print, screen and thumbnail sizes, and let the pages pick one with a
+            `srcset`. None keeps the original images. The transcoding runs in spawned worker
+            processes, so a script calling this must do so under `if __name__ == '__main__':`
+            (otherwise the images are transcoded in the threads of the book).
+        run_control: Receives the progress of every task and page, and stops the book when
+            cancelled (see `v0.run_control`, and `v0.async_api` to await it from asyncio)
         
     Returns:
         dict: The complete result dictionary containing all story content
-    """
-    load_dotenv()
 
-    crew = StoryBookCrew().crew()
-    
-    result = crew.kickoff({
+    Raises:
+        BookCancelled: If `run_control` was cancelled
+        InputsMismatchError: If `resume` is given with other inputs than the ones of that run
+    """
+    if resume is not None:
+        output_dir = resume
+        saved_inputs = CheckpointStore(output_dir).load_inputs()
+        story_theme = story_theme or saved_inputs['story_theme']
+        age_range = age_range or saved_inputs['age_range']
+        target_language = target_language or saved_inputs['target_language']
+    if story_theme is None or age_range is None or target_language is None:
+        raise ValueError('story_theme, age_range and target_language are required unless resuming a run')
+
+    languages = [target_language] if isinstance(target_language, str) else list(dict.fromkeys(target_language))
+    if not languages:
+        raise ValueError('target_language needs at least one language')
+
+    metrics = MetricsRecorder()
+    inputs = {
         'story_theme': story_theme,
         'age_range': age_range, 
-        'target_language': target_language
-    })
+        'target_language': languages[0]
+    }
 
     # Generate HTML pages if output_dir specified
     if output_dir is None:
         timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
         output_dir = f'output_htmls_{timestamp}'
-
-    # Convert to dict and save result
-    result_dict = result.model_dump()
     os.makedirs(output_dir, exist_ok=True)
-    result_json_path = os.path.join(output_dir, 'result.json')
-    with open(result_json_path, 'w+', encoding='utf-8') as f:
-        json.dump(result_dict, f, indent=4, ensure_ascii=False)
-    
-    generate_html_pages(result_dict, output_dir)
-    
+    checkpoint = CheckpointStore(output_dir)
+    completed = {}
+    if resume is not None:
+        checkpoint.check_inputs({**inputs, 'target_language': target_language})
+        completed = checkpoint.load_task_outputs()
+    checkpoint.save_inputs({**inputs, 'target_language': target_language})
+
+    # translation task -> directory of its pages, a single language keeps its pages in output_dir
+    if isinstance(target_language, str):
+        translations = {TRANSLATE_CONTENT_TASK: ''}
+    else:
+        translations = {TRANSLATE_CONTENT_TASK: language_directory(languages[0])}
+        translations.update({translation_task_name(language): language_directory(language) for language in languages[1:]})
+
+    # audio, images, template and pages start as soon as the tasks they need complete
+    post_processor = BookPostProcessor(
+        output_dir, clients.eleven_labs(), clients.image_store(), checkpoint=checkpoint, metrics=metrics,
+        tts_concurrency=max_concurrency, translations=translations,
+        image_variants=clients.image_variants() if image_format else None, image_format=image_format or 'webp',
+        run_control=run_control,
+    )
+    story_book_crew = StoryBookCrew(
+        metrics=metrics, max_concurrency=max_concurrency, template_store=TemplateStore(reuse_rate=template_reuse_rate),
+        streaming=streaming, on_page_image=post_processor.on_page_image, target_languages=languages, run_control=run_control,
+    )
+    crew = story_book_crew.crew()
+
+    def on_task_complete(output: TaskOutput) -> None:
+        checkpoint.save_task_output(output)
+        if output.name == 'generate_html_pages_task':
+            story_book_crew.save_template(output, age_range)
+        post_processor.on_task_complete(output)
+
+    try:
+        # the scheduler skips the completed tasks of a resumed run and runs the direct stages
+        # (e.g. the image generation) without an LLM round-trip
+        scheduler = ParallelTaskScheduler(
+            crew, max_workers=4 if parallel else 1, on_task_complete=on_task_complete,
+            cache=TaskOutputCache(enabled=use_cache), metrics=metrics, direct_stages=story_book_crew.direct_stages(inputs),
+            fallback_llms=story_book_crew.fallback_llms, run_control=run_control, context_fields=story_book_crew.context_fields(),
+        )
+        result = scheduler.kickoff(inputs, completed=completed)
+        print(scheduler.report.summary())
+
+        # Convert to dict and save result
+        result_dict = result.model_dump()
+        result_json_path = os.path.join(output_dir, 'result.json')
+        with open(result_json_path, 'w+', encoding='utf-8') as f:
+            json.dump(result_dict, f, indent=4, ensure_ascii=False)
+        with open(os.path.join(output_dir, 'schedule.json'), 'w+', encoding='utf-8') as f:
+            json.dump(scheduler.report.to_dict(), f, indent=4)
+
+        post_processor.finish()
+    except Exception as e:
+        # whatever step noticed the cancellation first, e.g. an image job failing once cancelled on fal
+        if run_control is not None and run_control.cancelled and not isinstance(e, BookCancelled):
+            raise BookCancelled('The book was cancelled') from e
+        raise
+    finally:
+        story_book_crew.close()
+        # also saved for failed runs, to see where the time went
+        metrics.save(output_dir)
+
     return result_dict
 
 
@@ -365,5 +677,4 @@ if __name__ == "__main__":
         story_theme='Little firefighter James put out the fire and saved everyone',
         age_range='1-6',
         target_language='Chinese'
-    )
-    # generate_audio("test it!", '', 'test.mp3')
\ No newline at end of file
+    )
\ No newline at end of file
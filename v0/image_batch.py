@@ -0,0 +1,222 @@
+"""
+Batch image generation with fal.
+
+`BatchImageGenerator` keeps several image jobs in flight, retries failed pages with exponential
+backoff and, with an image store, reuses and downloads the images locally. Every job goes
+through an `ImageRouter` (hedged requests and fallback across backends, see
+`v0.image_providers`). It does not depend on crewai, so workers that only generate images do
+not pay for importing it; the crewai tool in `v0.tools.image_generation` wraps it for the
+illustrator agent.
+"""
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from v0 import clients
+from v0.image_providers import FAL_DEV, FalProvider, ImageRouter
+from v0.image_store import ImageStore
+from v0.metrics import IMAGE, MetricsRecorder
+from v0.run_control import BookCancelled, RunControl
+
+
+# backend of the images found in the image store
+CACHED_BACKEND = 'cache'
+
+
+class BatchImageGenerationError(Exception):
+    """Raised when some pages of a batch could not be generated after all retries"""
+
+    def __init__(self, failed_indexes: list[int], results: list[str | None]):
+        self.failed_indexes = failed_indexes
+        self.results = results
+        super().__init__(
+            f"Failed to generate images for page indexes {failed_indexes} "
+            f"(the other {len(results) - len(failed_indexes)} pages succeeded and are kept, "
+            f"call the tool again with the same arguments to retry only the failed pages)"
+        )
+
+
+class BatchImageGenerator:
+    """Generates the images of a book, several pages at a time"""
+
+    def __init__(
+        self,
+        model_name: str = FAL_DEV,
+        router: ImageRouter | None = None,
+        max_concurrency: int = 4,
+        max_retries: int = 2,
+        retry_delay: float = 2.0,
+        image_size: dict[str, int] | None = None,
+        image_store: ImageStore | None = None,
+        metrics: MetricsRecorder | None = None,
+        run_control: RunControl | None = None,
+    ):
+        """
+        Args:
+            model_name: Model of the images, also part of the image store key. The default model
+                goes through the shared `clients.image_router()` (fal dev hedged on Hugging Face,
+                falling back to fal schnell), any other fal model is used alone
+            router: Routing between the image backends, overrides the one chosen by `model_name`
+            max_concurrency: Image jobs kept in flight at the same time, 1 = sequential
+            max_retries: Extra attempts per page before it is reported as failed
+            retry_delay: Seconds before the first retry, doubled after every failed attempt
+            image_size: Size of the images, 720x1280 by default
+            image_store: If set, images are looked up / saved locally by prompt hash and local
+                paths are returned instead of URLs
+            metrics: If set, every request to a backend records a span with its backend, queue wait and inference time
+            run_control: If set, no page starts (or is retried) once the book is cancelled, and the
+                jobs in flight are cancelled
+        """
+        self.model_name = model_name
+        self._router = router
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.image_size = image_size or {"width": 720, "height": 1280}  # FIXME fixed for now
+        self.image_store = image_store
+        self.metrics = metrics
+        self.run_control = run_control
+        # prompt -> url (or local path) of pages that already succeeded, so a retried batch only regenerates the failed pages
+        self._completed: dict[str, str] = {}
+        # prompt -> backend that produced its image
+        self.backends: dict[str, str] = {}
+        # prompt -> model of the images made by the fallback backend, stored under their own key
+        self._fallback_models: dict[str, str] = {}
+
+    @property
+    def router(self) -> ImageRouter:
+        if self._router is None:
+            self._router = clients.image_router() if self.model_name == FAL_DEV else ImageRouter(FalProvider(self.model_name))
+        return self._router
+
+    def generate_batch(self, prompts: list[str]) -> list[str]:
+        """
+        Generate one image per prompt with at most `max_concurrency` fal jobs in flight, the
+        pages with the same prompt share its image.
+
+        Args:
+            prompts (list[str]): Fully assembled prompts, one per page
+
+        Returns:
+            list[str]: URLs of the generated images (local paths if `image_store` is set), in the same order as `prompts`
+
+        Raises:
+            BatchImageGenerationError: If some pages still fail after `max_retries` retries
+        """
+        clients.load_environment()  # FAL_KEY
+        results: list[str | None] = [self._completed.get(prompt) for prompt in prompts]
+        if self.image_store is not None:
+            for i, prompt in enumerate(prompts):
+                if results[i] is None:
+                    results[i] = self.image_store.get(self._store_key(prompt))
+                    if results[i] is not None:
+                        self.backends.setdefault(prompt, CACHED_BACKEND)
+                        if self.metrics is not None:
+                            now = time.perf_counter()
+                            self.metrics.add_span(IMAGE, f'page_{i+1}', now, now, cached=True, images=0)
+        # identical prompts of the batch are generated once, by their first page
+        first_pages: dict[str, int] = {}
+        for i, url in enumerate(results):
+            if url is None:
+                first_pages.setdefault(prompts[i], i)
+        pending = list(first_pages.values())
+        failed_indexes = []
+        downloads = {}
+
+        if pending:
+            with ThreadPoolExecutor(max_workers=max(1, min(self.max_concurrency, len(pending)))) as executor:
+                futures = {executor.submit(self._generate_with_retry, prompts[i], i): i for i in pending}
+                for future in as_completed(futures):
+                    i = futures[future]
+                    try:
+                        results[i] = future.result()
+                        self._completed[prompts[i]] = results[i]
+                    except Exception as e:
+                        if not isinstance(e, BookCancelled):
+                            print(f"Page {i} failed after {self.max_retries + 1} attempts: {e}")
+                        failed_indexes.append(i)
+                        continue
+                    if self.image_store is not None:
+                        # start downloading right away, while the other pages are still generating
+                        downloads[i] = self.image_store.download_async(self._store_key(prompts[i]), results[i])
+
+        for i, download in downloads.items():
+            try:
+                results[i] = download.result()
+                self._completed[prompts[i]] = results[i]
+            except Exception as e:
+                print(f"Page {i} could not be downloaded, keeping the remote URL: {e}")
+
+        for i, prompt in enumerate(prompts):
+            if results[i] is None and first_pages.get(prompt, i) != i:
+                results[i] = results[first_pages[prompt]]
+                if first_pages[prompt] in failed_indexes:
+                    failed_indexes.append(i)
+
+        if failed_indexes:
+            raise BatchImageGenerationError(sorted(failed_indexes), results)
+        return results
+
+    def generate_page(self, prompt: str, page_index: int) -> str:
+        """
+        Generate the image of a single page, e.g. as soon as its prompt is streamed while the
+        prompts of the other pages are still being written. Same caching, retries and download as
+        `generate_batch`.
+
+        Returns:
+            str: URL of the generated image (local path if `image_store` is set)
+        """
+        clients.load_environment()  # FAL_KEY
+        if prompt in self._completed:
+            return self._completed[prompt]
+        if self.image_store is not None:
+            path = self.image_store.get(self._store_key(prompt))
+            if path is not None:
+                if self.metrics is not None:
+                    now = time.perf_counter()
+                    self.metrics.add_span(IMAGE, f'page_{page_index+1}', now, now, cached=True, images=0)
+                self.backends.setdefault(prompt, CACHED_BACKEND)
+                self._completed[prompt] = path
+                return path
+        url = self._completed[prompt] = self._generate_with_retry(prompt, page_index)
+        if self.image_store is not None:
+            try:
+                url = self._completed[prompt] = self.image_store.download(self._store_key(prompt), url)
+            except Exception as e:
+                print(f"Page {page_index} could not be downloaded, keeping the remote URL: {e}")
+        return url
+
+    def _generate_with_retry(self, prompt: str, page_index: int) -> str:
+        delay = self.retry_delay
+        for attempt in range(self.max_retries + 1):
+            if self.run_control is not None:
+                self.run_control.raise_if_cancelled()
+            try:
+                return self._generate_one(prompt, page_index)
+            except BookCancelled:
+                raise
+            except Exception as e:
+                if attempt == self.max_retries:
+                    raise
+                print(f"Page {page_index} attempt {attempt + 1} failed ({e}), retrying in {delay:.1f}s")
+                time.sleep(delay)
+                delay *= 2
+
+    def _generate_one(self, prompt: str, page_index: int = 0) -> str:
+        url, provider = self.router.generate(prompt, self.image_size, page_index, self.metrics, self.run_control)
+        self.backends[prompt] = provider.name
+        if provider is self.router.fallback:
+            # another model, not to be reused as an image of `model_name` by the next runs
+            self._fallback_models[prompt] = provider.model_name
+        return url
+
+    def _store_key(self, prompt: str) -> str:
+        return ImageStore.key(prompt, self._fallback_models.get(prompt, self.model_name), self.image_size)
+
+
+def build_prompt(ill_prompt: dict[str, str | list[str]], character_designs: list[dict[str, str]], color_palette: str, art_style: str) -> str:
+    """Assemble the full image prompt of a page from its scene prompt and the shared art direction"""
+    needed_character_designs = [
+        f'{character_design["name"]}: {character_design["design"]}' for character_design in character_designs 
+        if character_design["name"] in ill_prompt['character_names']
+        ]
+    return f'{ill_prompt["prompt"]}\ncolor palette: {color_palette}, art style: {art_style}\n' + "\n".join(needed_character_designs)
@@ -0,0 +1,387 @@
+"""
+Image backends and the routing between them.
+
+A single fal queue has a long tail: when it backs up, one page can wait minutes while the other
+pages are done. `ImageRouter` sends every page to a primary backend (fal FLUX.1 dev), sends a
+hedged request for the same model to a second backend (the Hugging Face inference API) if the
+primary is still busy after `hedge_after` seconds, keeps the first image that comes back, and
+falls back to the faster fal FLUX.1 schnell when neither dev request finished within `timeout`.
+The requests given up on are cancelled on fal, so they are neither paid for nor holding a worker.
+
+Every backend keeps health statistics (latency percentiles, failures, timeouts, wins); a backend
+failing several times in a row is put behind the other one for a cool-down period.
+"""
+import io
+import statistics
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any
+
+import fal_client
+
+from v0 import clients
+from v0.image_store import ImageStore
+from v0.metrics import IMAGE, MetricsRecorder
+from v0.run_control import RunControl
+
+
+FAL_DEV = 'fal-ai/flux/dev'
+FAL_SCHNELL = 'fal-ai/flux/schnell'
+HF_FLUX_DEV = 'black-forest-labs/FLUX.1-dev'
+
+# seconds between two checks of the cancellation of a book while its image is generating
+_CANCELLATION_POLL = 0.5
+
+
+def on_queue_update(update):
+    if isinstance(update, fal_client.InProgress):
+        for log in update.logs:
+           print(log["message"])
+
+
+class ImageProvider:
+    """A backend turning a prompt into an image"""
+
+    def __init__(self, name: str, model_name: str):
+        """
+        Args:
+            name: Name of the backend in the statistics and in `Illustrations.backends`
+            model_name: Model of the backend
+        """
+        self.name = name
+        self.model_name = model_name
+
+    def generate(self, prompt: str, image_size: dict[str, int], attributes: dict[str, Any], run_control: RunControl | None = None) -> str:
+        """
+        Generate one image.
+
+        Args:
+            attributes: Attributes of the metrics span of the request, the backend can add to them
+            run_control: Control of the book, a backend that can abort its jobs does so when the book is cancelled
+
+        Returns:
+            str: URL or local path of the image
+        """
+        raise NotImplementedError
+
+
+class FalProvider(ImageProvider):
+    """A fal model, the queue wait and the inference time are measured separately, and its jobs are cancelled with their book"""
+
+    def __init__(self, model_name: str = FAL_DEV, name: str | None = None):
+        super().__init__(name or model_name, model_name)
+
+    def generate(self, prompt: str, image_size: dict[str, int], attributes: dict[str, Any], run_control: RunControl | None = None) -> str:
+        submitted = time.perf_counter()
+        started = None
+        request_ids = []
+
+        def on_enqueue(request_id: str) -> None:
+            request_ids.append(request_id)
+            if run_control is not None:
+                run_control.track_fal_job(self.model_name, request_id)
+
+        def on_update(update):
+            nonlocal started
+            if started is None and isinstance(update, (fal_client.InProgress, fal_client.Completed)):
+                started = time.perf_counter()
+            on_queue_update(update)
+
+        try:
+            result = clients.rate_limiter('fal').call(
+                fal_client.subscribe,
+                self.model_name,
+                arguments={
+                    "prompt": prompt,
+                    "image_size": image_size,
+                },
+                with_logs=True,
+                on_enqueue=on_enqueue,
+                on_queue_update=on_update,
+            )
+            attributes['images'] = len(result['images'])
+            return result['images'][0]['url']
+        finally:
+            if run_control is not None:
+                for request_id in request_ids:
+                    run_control.untrack_fal_job(request_id)
+            finished = time.perf_counter()
+            # without queue updates the whole call counts as inference
+            started = started or submitted
+            attributes['queue_wait'] = round(started - submitted, 4)
+            attributes['inference'] = round(finished - started, 4)
+
+
+class HFInferenceProvider(ImageProvider):
+    """The Hugging Face inference API (`clients.hf_inference`), its images are saved in the image store"""
+
+    def __init__(self, model_name: str = HF_FLUX_DEV, name: str = 'hf-inference'):
+        super().__init__(name, model_name)
+
+    def generate(self, prompt: str, image_size: dict[str, int], attributes: dict[str, Any], run_control: RunControl | None = None) -> str:
+        image = clients.rate_limiter('hf').call(
+            clients.hf_inference().text_to_image,
+            prompt, model=self.model_name, width=image_size['width'], height=image_size['height'],
+        )
+        attributes['images'] = 1
+        buffer = io.BytesIO()
+        image.save(buffer, format='PNG')
+        return clients.image_store().put_bytes(ImageStore.key(prompt, self.model_name, image_size), buffer.getvalue(), '.png')
+
+
+class ProviderStats:
+    """Thread-safe health statistics of one backend"""
+
+    def __init__(self, failure_threshold: int = 3, cooldown: float = 60.0, window: int = 100):
+        """
+        Args:
+            failure_threshold: Failures (or timeouts) in a row after which the backend is unhealthy
+            cooldown: Seconds an unhealthy backend stays behind the others
+            window: Number of recent latencies kept for the percentiles
+        """
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.requests = 0
+        self.successes = 0
+        self.failures = 0
+        self.timeouts = 0
+        self.wins = 0
+        self._latencies: deque[float] = deque(maxlen=window)
+        self._failures_in_a_row = 0
+        self._unhealthy_until = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def healthy(self) -> bool:
+        with self._lock:
+            return time.monotonic() >= self._unhealthy_until
+
+    def record_request(self) -> None:
+        with self._lock:
+            self.requests += 1
+
+    def record_success(self, latency: float) -> None:
+        with self._lock:
+            self.successes += 1
+            self._latencies.append(latency)
+            self._failures_in_a_row = 0
+
+    def record_failure(self, timed_out: bool = False) -> None:
+        with self._lock:
+            if timed_out:
+                self.timeouts += 1
+            else:
+                self.failures += 1
+            self._failures_in_a_row += 1
+            if self._failures_in_a_row >= self.failure_threshold:
+                self._unhealthy_until = time.monotonic() + self.cooldown
+
+    def record_win(self) -> None:
+        with self._lock:
+            self.wins += 1
+
+    def to_dict(self) -> dict[str, Any]:
+        with self._lock:
+            latencies = sorted(self._latencies)
+            stats = {
+                'requests': self.requests,
+                'successes': self.successes,
+                'failures': self.failures,
+                'timeouts': self.timeouts,
+                'wins': self.wins,
+                'healthy': time.monotonic() >= self._unhealthy_until,
+            }
+        if latencies:
+            stats['p50'] = round(statistics.median(latencies), 4)
+            stats['p95'] = round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))], 4)
+        return stats
+
+
+class ImageRouter:
+    """
+    Hedged requests and fallback across image backends, shared by the books of the process
+    (see `v0.clients.image_router`) so that the health statistics outlive a single book.
+    """
+
+    def __init__(self, primary: ImageProvider, hedge: ImageProvider | None = None, fallback: ImageProvider | None = None, hedge_after: float = 30.0, timeout: float = 120.0, max_workers: int = 32):
+        """
+        Args:
+            primary: Backend of every request
+            hedge: Second backend of the same model, sent the same request when the primary did
+                not answer within `hedge_after` seconds (or failed). The first image wins
+            fallback: Backend used when neither the primary nor the hedge produced an image
+                within `timeout` seconds, usually a faster model
+            hedge_after: Seconds before the hedged request
+            timeout: Seconds after which the primary and hedged requests are abandoned
+            max_workers: Requests in flight at the same time. The fal requests given up on are
+                cancelled, the Hugging Face ones keep their worker until they end
+        """
+        self.primary = primary
+        self.hedge = hedge
+        self.fallback = fallback
+        self.hedge_after = hedge_after
+        self.timeout = timeout
+        self.stats = {provider.name: ProviderStats() for provider in (primary, hedge, fallback) if provider is not None}
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='image-provider')
+
+    def generate(self, prompt: str, image_size: dict[str, int], page_index: int = 0, metrics: MetricsRecorder | None = None, run_control: RunControl | None = None) -> tuple[str, ImageProvider]:
+        """
+        Generate one image on the first backend that answers. The requests given up on (the loser
+        of a hedge, the ones past `timeout`) are cancelled, and their late answers are ignored.
+
+        Args:
+            run_control: Control of the book, its cancellation aborts the requests in flight
+
+        Returns:
+            tuple: URL or local path of the image, and the backend that produced it
+
+        Raises:
+            TimeoutError: If every backend timed out
+            BookCancelled: If the book was cancelled
+            Exception: The last error if every backend failed
+        """
+        first, second = self.primary, self.hedge
+        if second is not None and not self.stats[first.name].healthy and self.stats[second.name].healthy:
+            first, second = second, first
+
+        start = time.perf_counter()
+        attempts: dict[Future, _Attempt] = {}
+        try:
+            self._submit(attempts, first, 'primary', prompt, image_size, page_index, metrics, run_control)
+            hedged = second is None
+            error: Exception = TimeoutError(f'No image from {first.name} within {self.timeout:g}s')
+            while attempts:
+                elapsed = time.perf_counter() - start
+                if elapsed >= self.timeout:
+                    break
+                wait_for = self.timeout - elapsed if hedged else min(self.timeout, self.hedge_after) - elapsed
+                for attempt in self._wait(attempts, wait_for, run_control):
+                    try:
+                        url = attempt.future.result()
+                    except Exception as e:
+                        error = e
+                        continue
+                    self.stats[attempt.provider.name].record_win()
+                    return url, attempt.provider
+                if not hedged and (not attempts or time.perf_counter() - start >= self.hedge_after):
+                    print(f"Page {page_index} hedged on {second.name} after {time.perf_counter() - start:.1f}s")
+                    self._submit(attempts, second, 'hedge', prompt, image_size, page_index, metrics, run_control)
+                    hedged = True
+
+            if run_control is not None:
+                run_control.raise_if_cancelled()
+            for attempt in attempts.values():
+                # unless it answered in the meantime
+                if attempt.settle():
+                    self.stats[attempt.provider.name].record_failure(timed_out=True)
+                error = TimeoutError(f'No image from {attempt.provider.name} within {self.timeout:g}s')
+            self._abandon(attempts)
+            if self.fallback is None:
+                raise error
+            print(f"Page {page_index} falling back to {self.fallback.name} ({error})")
+            self._submit(attempts, self.fallback, 'fallback', prompt, image_size, page_index, metrics, run_control)
+            for attempt in self._wait(attempts, self.timeout, run_control):
+                url = attempt.future.result()
+                self.stats[self.fallback.name].record_win()
+                return url, self.fallback
+            for attempt in attempts.values():
+                if attempt.settle():
+                    self.stats[self.fallback.name].record_failure(timed_out=True)
+            raise TimeoutError(f'No image from {self.fallback.name} within {self.timeout:g}s')
+        finally:
+            self._abandon(attempts)
+
+    def health(self) -> dict[str, dict[str, Any]]:
+        """Statistics of every backend, e.g. {'fal-ai/flux/dev': {'requests': ..., 'p95': ..., 'healthy': True}}"""
+        return {name: stats.to_dict() for name, stats in self.stats.items()}
+
+    @staticmethod
+    def _wait(attempts: dict[Future, '_Attempt'], timeout: float, run_control: RunControl | None) -> list['_Attempt']:
+        """
+        Wait up to `timeout` seconds for the first attempts to finish, and remove them from `attempts`.
+
+        Raises:
+            BookCancelled: If the book is cancelled while waiting
+        """
+        deadline = time.perf_counter() + timeout
+        while True:
+            if run_control is not None:
+                run_control.raise_if_cancelled()
+            remaining = max(0.0, deadline - time.perf_counter())
+            # wake up regularly to notice a cancellation
+            wait_for = min(remaining, _CANCELLATION_POLL) if run_control is not None else remaining
+            done, _ = wait(attempts, timeout=wait_for, return_when=FIRST_COMPLETED)
+            # a job cancelled with the book fails with the error of its backend
+            if run_control is not None:
+                run_control.raise_if_cancelled()
+            if done or time.perf_counter() >= deadline:
+                return [attempts.pop(future) for future in done]
+
+    @staticmethod
+    def _abandon(attempts: dict[Future, '_Attempt']) -> None:
+        for attempt in attempts.values():
+            attempt.abandon()
+        attempts.clear()
+
+    def _submit(self, attempts: dict[Future, '_Attempt'], provider: ImageProvider, role: str, prompt: str, image_size: dict[str, int], page_index: int, metrics: MetricsRecorder | None, run_control: RunControl | None) -> None:
+        attempt = _Attempt(provider, run_control)
+        attempt.future = self._executor.submit(self._request, attempt, role, prompt, image_size, page_index, metrics)
+        attempts[attempt.future] = attempt
+
+    def _request(self, attempt: '_Attempt', role: str, prompt: str, image_size: dict[str, int], page_index: int, metrics: MetricsRecorder | None) -> str:
+        provider = attempt.provider
+        stats = self.stats[provider.name]
+        stats.record_request()
+        attributes = {'model': provider.model_name, 'provider': provider.name, 'role': role, 'cached': False, 'images': 0}
+        start = time.perf_counter()
+        try:
+            attempt.run_control.raise_if_cancelled()
+            url = provider.generate(prompt, image_size, attributes, attempt.run_control)
+        except Exception as e:
+            attributes['error'] = f'{type(e).__name__}: {e}'
+            # neither a cancelled book nor a request given up on says anything about the health of the backend
+            if attempt.settle() and not attempt.run_control.cancelled:
+                stats.record_failure()
+            raise
+        finally:
+            finished = time.perf_counter()
+            if metrics is not None:
+                metrics.add_span(IMAGE, f'page_{page_index+1}', start, finished, **attributes)
+        if attempt.settle():
+            stats.record_success(finished - start)
+        return url
+
+
+class _Attempt:
+    """
+    One request of the router to a backend. Its control is a child of the one of the book, so
+    that the router can give up on it alone and cancel its fal jobs (a Hugging Face request runs
+    to its end, its answer is ignored). Its outcome counts once in the statistics of the backend:
+    the request reports it, unless the router already gave up on it.
+    """
+
+    def __init__(self, provider: ImageProvider, run_control: RunControl | None):
+        self.provider = provider
+        self.run_control = RunControl(parent=run_control)
+        self.future: Future | None = None
+        self._settled = False
+        self._lock = threading.Lock()
+
+    def settle(self) -> bool:
+        """Whether the caller is the first to settle the outcome of the attempt"""
+        with self._lock:
+            settled, self._settled = self._settled, True
+        return not settled
+
+    def abandon(self) -> None:
+        """Give up on the attempt: its outcome no longer counts, and it is cancelled if it started"""
+        self.settle()
+        if not self.future.cancel():
+            self.run_control.cancel()
+
+
+def default_router(hedge_after: float = 30.0, timeout: float = 120.0) -> ImageRouter:
+    """fal FLUX.1 dev, hedged on the Hugging Face inference API, falling back to fal FLUX.1 schnell"""
+    return ImageRouter(FalProvider(FAL_DEV), HFInferenceProvider(), FalProvider(FAL_SCHNELL), hedge_after=hedge_after, timeout=timeout)
@@ -0,0 +1,126 @@
+"""
+Local content-addressed store for generated illustrations.
+
+Images are keyed by everything that determines them (the fully assembled prompt, the model
+and the image size), so an identical prompt is never paid for twice, and books keep working
+after the temporary fal CDN URLs expire.
+"""
+import glob
+import hashlib
+import json
+import mimetypes
+import os
+import shutil
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+DEFAULT_STORE_DIR = os.path.join('.cache', 'images')
+
+
+class ImageStore:
+    """
+    Content-addressed image files under `root`, plus a pooled HTTP session to download them.
+
+    Downloads run on a small thread pool so they overlap with the generation of the other pages.
+    """
+
+    def __init__(self, root: str = DEFAULT_STORE_DIR, pool_size: int = 8):
+        """
+        Args:
+            root: Directory holding the images
+            pool_size: Number of concurrent downloads and of kept-alive HTTP connections
+        """
+        self.root = root
+        self.pool_size = pool_size
+        self._session: requests.Session | None = None
+        self._executor: ThreadPoolExecutor | None = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(prompt: str, model_name: str, image_size: dict[str, int]) -> str:
+        payload = json.dumps({'prompt': prompt, 'model': model_name, 'image_size': image_size}, sort_keys=True)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def url_key(url: str) -> str:
+        return hashlib.sha256(url.encode('utf-8')).hexdigest()
+
+    @property
+    def session(self) -> requests.Session:
+        with self._lock:
+            if self._session is None:
+                retry = Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504])
+                adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size, max_retries=retry)
+                session = requests.Session()
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                self._session = session
+            return self._session
+
+    def get(self, key: str) -> str | None:
+        """Path of the stored image for `key`, or None if it was never stored"""
+        matches = glob.glob(os.path.join(self.root, key[:2], f'{key}.*'))
+        return matches[0] if matches else None
+
+    def put_bytes(self, key: str, data: bytes, extension: str = '.png') -> str:
+        path = os.path.join(self.root, key[:2], f'{key}{extension}')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = os.path.join(os.path.dirname(path), f'.{key}.{threading.get_ident()}.tmp')  # not matched by get()
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        return path
+
+    def download(self, key: str, url: str) -> str:
+        """Download `url` (or copy a local file, e.g. from the Hugging Face backend) into the store under `key` and return the local path"""
+        existing = self.get(key)
+        if existing:
+            return existing
+        if urlparse(url).scheme not in ('http', 'https'):
+            with open(url, 'rb') as f:
+                return self.put_bytes(key, f.read(), os.path.splitext(url)[1] or '.png')
+        response = self.session.get(url, timeout=60)
+        response.raise_for_status()
+        extension = os.path.splitext(urlparse(url).path)[1] or mimetypes.guess_extension(
+            response.headers.get('Content-Type', '').split(';')[0].strip()
+        ) or '.png'
+        return self.put_bytes(key, response.content, extension)
+
+    def download_async(self, key: str, url: str) -> Future:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.pool_size, thread_name_prefix='image-download')
+        return self._executor.submit(self.download, key, url)
+
+    def localize(self, path_or_url: str, output_dir: str, file_name: str) -> str:
+        """
+        Put an illustration into `output_dir/images`, downloading it first if it is a remote URL.
+
+        Args:
+            path_or_url: Local path in the store (or anywhere on disk) or a remote URL
+            output_dir: Book output directory
+            file_name: File name without extension, e.g. 'page_1'
+
+        Returns:
+            str: Path of the image relative to `output_dir`, to be used in the HTML
+        """
+        if urlparse(path_or_url).scheme in ('http', 'https'):
+            source = self.download(self.url_key(path_or_url), path_or_url)
+        else:
+            source = path_or_url
+        relative_path = os.path.join('images', file_name + os.path.splitext(source)[1])
+        target = os.path.join(output_dir, relative_path)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if os.path.exists(target):
+            os.remove(target)
+        try:
+            os.link(source, target)
+        except OSError:
+            shutil.copyfile(source, target)
+        return relative_path.replace(os.sep, '/')
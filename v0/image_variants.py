@@ -0,0 +1,162 @@
+"""
+Responsive variants of the illustrations.
+
+fal returns a full-size PNG for every page, too heavy for a phone reading the book. Every
+illustration is transcoded to WebP (or AVIF) in three sizes: `print` (full resolution),
+`screen` and `thumb`, and the pages list them in a `srcset` so the browser downloads the
+smallest one that looks sharp.
+
+Transcoding runs in a process pool, so it does not compete with the crew and the download
+threads for the GIL. Memory stays bounded: each worker holds a single decoded image at a time,
+and workers are replaced after `max_tasks_per_child` images.
+
+The workers are spawned, so they import the main module of the process again: a script making
+books must start them under `if __name__ == '__main__':`. Otherwise every worker runs the script
+and dies, and the images are transcoded in the threads of the book instead, with the GIL.
+"""
+import multiprocessing
+import os
+import posixpath
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+
+# variant -> (maximum width, quality); None keeps the original width
+VARIANTS = {
+    'thumb': (180, 70),
+    'screen': (480, 80),
+    'print': (None, 90),
+}
+IMAGE_FORMATS = ('webp', 'avif')
+
+
+def make_variants(source: str, output_dir: str, name: str, image_format: str = 'webp') -> dict[str, dict]:
+    """
+    Transcode one image into every variant, saved as `images/{name}.{variant}.{image_format}`.
+
+    Returns:
+        dict: Variant -> {'path': path relative to output_dir, 'width': ..., 'height': ...}
+    """
+    from PIL import Image
+
+    variants = {}
+    with Image.open(os.path.join(output_dir, source)) as image:
+        image = image.convert('RGBA' if image.mode in ('RGBA', 'LA', 'P') else 'RGB')
+        for variant, (max_width, quality) in VARIANTS.items():
+            resized = image
+            if max_width is not None and image.width > max_width:
+                resized = image.resize((max_width, round(image.height * max_width / image.width)), Image.LANCZOS)
+            relative_path = f'images/{name}.{variant}.{image_format}'
+            path = os.path.join(output_dir, relative_path)
+            tmp_path = f'{path}.{os.getpid()}.tmp'
+            resized.save(tmp_path, format=image_format.upper(), quality=quality)
+            os.replace(tmp_path, path)
+            variants[variant] = {'path': relative_path, 'width': resized.width, 'height': resized.height}
+    return variants
+
+
+def srcset(variants: dict[str, dict], relative_to: str = '') -> str:
+    """
+    `srcset` attribute value of the variants, e.g. 'images/page_1.thumb.webp 180w, ...'
+
+    Args:
+        variants: Result of `make_variants`
+        relative_to: Directory of the page (relative to output_dir) the paths should be relative to
+    """
+    return ', '.join(
+        f"{posixpath.relpath(variant['path'], relative_to) if relative_to else variant['path']} {variant['width']}w"
+        for variant in sorted(variants.values(), key=lambda variant: variant['width'])
+    )
+
+
+class ImageVariantMaker:
+    """
+    Process pool making the variants of the illustrations, shared by the books of the process
+    (see `v0.clients.image_variants`).
+    """
+
+    def __init__(self, max_workers: int = 2, max_tasks_per_child: int = 50):
+        """
+        Args:
+            max_workers: Worker processes, i.e. images decoded in memory at the same time
+            max_tasks_per_child: Images transcoded by a worker before it is replaced, so that
+                fragmented memory is given back to the system
+        """
+        self.max_workers = max_workers
+        self.max_tasks_per_child = max_tasks_per_child
+        self._executor: ProcessPoolExecutor | None = None
+        self._lock = threading.Lock()
+        # set once the workers died, e.g. an unguarded main module, the images are then transcoded in the calling thread
+        self.broken = False
+
+    @staticmethod
+    def supported_format(image_format: str) -> str:
+        """`image_format` if this Pillow can encode it, otherwise webp"""
+        from PIL import features
+
+        if image_format not in IMAGE_FORMATS:
+            raise ValueError(f'Unsupported image format {image_format}, expected one of {IMAGE_FORMATS}')
+        if image_format == 'avif' and not features.check('avif'):
+            print('This Pillow build cannot encode AVIF, making WebP variants instead')
+            return 'webp'
+        return image_format
+
+    def start(self, wait: bool = False) -> None:
+        """
+        Start the worker processes ahead of the first image.
+
+        A spawned worker imports the main module of the process again (i.e. crewai, several
+        seconds), call this when a book starts so that it overlaps the LLM stages.
+        """
+        if self.broken:
+            return
+        try:
+            futures = [self._get_executor().submit(os.getpid) for _ in range(self.max_workers)]
+            if wait:
+                for future in futures:
+                    future.result()
+        except BrokenProcessPool as e:
+            self._pool_broken(e)
+
+    def make(self, source: str, output_dir: str, name: str, image_format: str = 'webp') -> dict[str, dict]:
+        """
+        Make the variants of `output_dir/source` in a worker process, or in the calling thread if
+        the pool is broken, see `make_variants`.
+        """
+        if not self.broken:
+            try:
+                return self._get_executor().submit(make_variants, source, output_dir, name, image_format).result()
+            except BrokenProcessPool as e:
+                self._pool_broken(e)
+        return make_variants(source, output_dir, name, image_format)
+
+    def _pool_broken(self, error: BrokenProcessPool) -> None:
+        with self._lock:
+            if self.broken:
+                return
+            self.broken = True
+            executor, self._executor = self._executor, None
+        print(
+            f'The image variant workers died ({error}), transcoding in the book threads instead. '
+            "A script making books must start them under `if __name__ == '__main__':`"
+        )
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                # spawn: forking a process running the crew threads could copy a held lock
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.max_workers,
+                    mp_context=multiprocessing.get_context('spawn'),
+                    max_tasks_per_child=self.max_tasks_per_child,
+                )
+            return self._executor
+
+    def shutdown(self) -> None:
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+                self._executor = None
@@ -0,0 +1,19 @@
+"""
+crewai LLM whose calls go through the rate limiter of their provider.
+
+`clients.llm` builds every agent LLM as a `RateLimitedLLM`, so the agents of all the books of
+the process share one request and token budget per provider, and a throttled call is retried
+after its backoff instead of failing the task.
+"""
+from typing import Any
+
+from crewai import LLM
+
+from v0 import clients
+from v0.rate_limit import estimate_tokens, provider_of
+
+
+class RateLimitedLLM(LLM):
+    def call(self, messages: list[dict[str, str]], *args: Any, **kwargs: Any) -> str:
+        limiter = clients.rate_limiter(provider_of(self.model))
+        return limiter.call(super().call, messages, *args, tokens=estimate_tokens(messages, self.max_tokens or 1000), **kwargs)
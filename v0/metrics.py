@@ -0,0 +1,206 @@
+"""
+Per-stage latency, token and cost instrumentation of a book run.
+
+Every crew task, image job, TTS call and render step records a span with its wall-clock
+timing and counters (tokens, images, TTS characters). The spans of a book are written to
+`metrics.json` next to `result.json`, and `StageDurations` aggregates the spans of many books
+(in bounded memory) into p50/p95 summaries for the Prometheus node-exporter textfile collector.
+"""
+import json
+import os
+import posixpath
+import random
+import re
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from typing import Any, Iterable, Iterator
+
+
+# span kinds
+TASK = 'task'
+IMAGE = 'image'
+TTS = 'tts'
+RENDER = 'render'
+
+_NUMBER_RE = re.compile(r'\d+')
+
+
+@dataclass
+class Span:
+    """One timed unit of work, e.g. a crew task or a single fal job"""
+    kind: str
+    name: str
+    start: float
+    end: float
+    attributes: dict[str, Any] = field(default_factory=dict)
+
+    @property
+    def duration(self) -> float:
+        return self.end - self.start
+
+
+class MetricsRecorder:
+    """Thread-safe collection of the spans of one book"""
+
+    def __init__(self):
+        self.spans: list[Span] = []
+        self.counters: dict[str, int] = {}
+        self._origin = time.perf_counter()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, kind: str, name: str, **attributes) -> Iterator[dict[str, Any]]:
+        """
+        Time the body of the `with` block as a span.
+
+        Yields:
+            dict: The attributes of the span, the body can add counters to it
+        """
+        start = time.perf_counter()
+        try:
+            yield attributes
+        except Exception as e:
+            attributes['error'] = f'{type(e).__name__}: {e}'
+            raise
+        finally:
+            self.add_span(kind, name, start, time.perf_counter(), **attributes)
+
+    def add_span(self, kind: str, name: str, start: float, end: float, **attributes) -> None:
+        """Record a span from `time.perf_counter()` timestamps"""
+        span = Span(kind, name, round(start - self._origin, 4), round(end - self._origin, 4), attributes)
+        with self._lock:
+            self.spans.append(span)
+
+    def increment(self, counter: str, amount: int = 1) -> None:
+        """Count an event that is not a span, e.g. a malformed LLM answer repaired locally"""
+        with self._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + amount
+
+    def to_dict(self) -> dict[str, Any]:
+        with self._lock:
+            spans = sorted(self.spans, key=lambda span: span.start)
+            counters = dict(self.counters)
+        totals: dict[str, dict[str, float]] = {}
+        for span in spans:
+            kind_totals = totals.setdefault(span.kind, {'count': 0, 'duration': 0.0})
+            kind_totals['count'] += 1
+            kind_totals['duration'] = round(kind_totals['duration'] + span.duration, 4)
+            for key, value in span.attributes.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    kind_totals[key] = round(kind_totals.get(key, 0) + value, 6)
+        return {
+            'wall_time': round(max((span.end for span in spans), default=0.0), 4),
+            'totals': totals,
+            'counters': counters,
+            'spans': [{**asdict(span), 'duration': round(span.duration, 4)} for span in spans],
+        }
+
+    def save(self, output_dir: str, file_name: str = 'metrics.json') -> str:
+        path = os.path.join(output_dir, file_name)
+        with open(path, 'w+', encoding='utf-8') as f:
+            json.dump(self.to_dict(), f, indent=4, ensure_ascii=False)
+        return path
+
+
+def llm_cost(model: str, prompt_tokens: int, completion_tokens: int) -> float | None:
+    """Cost in USD of an LLM call according to the litellm price map, None if the model is unknown"""
+    try:
+        from litellm import cost_per_token
+        prompt_cost, completion_cost = cost_per_token(model=model, prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+        return prompt_cost + completion_cost
+    except Exception:
+        return None
+
+
+def span_durations(metrics: dict[str, Any]) -> Iterator[tuple[str, str, float]]:
+    """
+    (kind, stage, duration) of every span of a `metrics.json`, the spans of every page and language
+    grouped per stage so that the stage label keeps a small, fixed set of values.
+    """
+    for span in metrics['spans']:
+        yield span['kind'], stage_label(span['name']), span['duration']
+
+
+def stage_label(span_name: str) -> str:
+    """Stage of a span without its language and numbers, e.g. 'spanish/page_3' -> 'page_N', 'image_3_variants' -> 'image_N_variants'"""
+    return _NUMBER_RE.sub('N', posixpath.basename(span_name))
+
+
+def quantile(sorted_values: list[float], q: float) -> float:
+    index = min(len(sorted_values) - 1, max(0, round(q * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+@dataclass
+class _StageSummary:
+    count: int = 0
+    total: float = 0.0
+    samples: list[float] = field(default_factory=list)
+
+
+class StageDurations:
+    """
+    Count, sum and quantiles of the stage durations of a batch of any size.
+
+    The quantiles are computed over a uniform random sample of at most `max_samples` durations
+    per stage (reservoir sampling), so memory and the work per update stay bounded however many
+    books the batch has. Count and sum are exact.
+    """
+
+    def __init__(self, max_samples: int = 1024, seed: int | None = None):
+        """
+        Args:
+            max_samples: Durations kept per stage for the quantiles
+            seed: Seed of the sampling, for reproducible quantiles
+        """
+        self.max_samples = max_samples
+        self._random = random.Random(seed)
+        self.stages: dict[tuple[str, str], _StageSummary] = {}
+
+    def add(self, durations: Iterable[tuple[str, str, float]]) -> None:
+        """
+        Args:
+            durations: (kind, stage, duration in seconds) of spans, see `span_durations`
+        """
+        for kind, stage, duration in durations:
+            summary = self.stages.setdefault((kind, stage), _StageSummary())
+            summary.count += 1
+            summary.total += duration
+            if len(summary.samples) < self.max_samples:
+                summary.samples.append(duration)
+            else:
+                # every duration seen so far stays in the sample with the same probability
+                index = self._random.randrange(summary.count)
+                if index < self.max_samples:
+                    summary.samples[index] = duration
+
+
+def write_prometheus_textfile(durations: StageDurations, path: str, prefix: str = 'baby_book') -> None:
+    """
+    Write p50/p95 of the stage durations of a batch as a Prometheus summary in the text format.
+
+    Args:
+        durations: Durations of the spans of the batch
+        path: The `.prom` file read by the node-exporter textfile collector
+        prefix: Metric name prefix
+    """
+    name = f'{prefix}_stage_duration_seconds'
+    lines = [
+        f'# HELP {name} Duration of the book generation stages',
+        f'# TYPE {name} summary',
+    ]
+    for (kind, stage), summary in sorted(durations.stages.items()):
+        values = sorted(summary.samples)
+        labels = f'kind="{kind}",stage="{stage}"'
+        for q in (0.5, 0.95):
+            lines.append(f'{name}{{{labels},quantile="{q}"}} {quantile(values, q):.4f}')
+        lines.append(f'{name}_sum{{{labels}}} {summary.total:.4f}')
+        lines.append(f'{name}_count{{{labels}}} {summary.count}')
+
+    # write then rename, so the collector never reads a partial file
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.replace(tmp_path, path)
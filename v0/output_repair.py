@@ -0,0 +1,161 @@
+"""
+Local repair of the structured outputs of the LLM.
+
+The usual ways a Final Answer fails to parse are a markdown code fence around it, text before or
+after the JSON, unescaped double quotes or raw newlines inside strings, trailing commas and an
+answer cut off in the middle of an array. All of these can be fixed here, without paying for a
+re-prompt of the LLM. The same code fence stripping is used for the HTML template.
+"""
+import json
+import re
+from typing import Iterator, Type, TypeVar
+
+from pydantic import BaseModel, ValidationError
+
+
+ModelT = TypeVar('ModelT', bound=BaseModel)
+
+_FENCE_RE = re.compile(r'```[\w-]*[ \t]*\n?(.*?)(?:\n?```|$)', re.DOTALL)
+_CLOSERS = {'{': '}', '[': ']'}
+# characters that can follow the closing quote of a string in valid JSON
+_AFTER_STRING = ',:}]'
+# characters that can start the next element after a comma
+_AFTER_COMMA = '"{[}]-0123456789tfn'
+
+
+def strip_code_fences(text: str) -> str:
+    """The content of the first markdown code block of `text` (e.g. ```html ... ```), or `text` itself"""
+    match = _FENCE_RE.search(text)
+    if match:
+        return match.group(1).strip()
+    return text.strip()
+
+
+def _next_char(text: str, index: int) -> str:
+    """First non-whitespace character at or after `index`, '' at the end of the text"""
+    while index < len(text) and text[index].isspace():
+        index += 1
+    return text[index] if index < len(text) else ''
+
+
+def closes_string(text: str, index: int) -> bool:
+    """Whether the double quote at `index` ends the current string or is an unescaped quote inside it"""
+    following = _next_char(text, index + 1)
+    if following == ',':
+        after_comma = _next_char(text, text.index(',', index + 1) + 1)
+        return after_comma == '' or after_comma in _AFTER_COMMA
+    return following == '' or following in _AFTER_STRING
+
+
+def repair_candidates(text: str) -> Iterator[str]:
+    """
+    Yield repaired versions of a JSON answer, most faithful first.
+
+    The first candidate is the JSON value found in `text` with its strings and commas fixed. If the
+    answer was cut off, the following candidates drop the incomplete trailing elements one by one,
+    so no half-written page is kept.
+    """
+    text = strip_code_fences(text)
+    starts = [index for index in (text.find('{'), text.find('[')) if index != -1]
+    if not starts:
+        return
+    out: list[str] = []
+    stack: list[str] = []
+    # (length of `out`, open containers) before every comma, where a truncated answer can be cut
+    cut_points: list[tuple[int, list[str]]] = []
+    in_string = False
+    escaped = False
+
+    index = min(starts)
+    while index < len(text):
+        char = text[index]
+        if in_string:
+            if escaped:
+                escaped = False
+                out.append(char)
+            elif char == '\\':
+                escaped = True
+                out.append(char)
+            elif char == '"':
+                if closes_string(text, index):
+                    in_string = False
+                    out.append(char)
+                else:
+                    out.append('\\"')
+            elif char == '\n':
+                out.append('\\n')
+            elif char == '\r':
+                out.append('\\r')
+            elif char == '\t':
+                out.append('\\t')
+            else:
+                out.append(char)
+        elif char == '"':
+            in_string = True
+            out.append(char)
+        elif char in _CLOSERS:
+            stack.append(char)
+            out.append(char)
+        elif char in '}]':
+            _drop_trailing_comma(out)
+            if stack:
+                out.append(_CLOSERS[stack.pop()])
+            if not stack:
+                # end of the top-level value, the text after it is dropped
+                yield ''.join(out)
+                return
+        elif char == ',':
+            cut_points.append((len(out), list(stack)))
+            out.append(char)
+        else:
+            out.append(char)
+        index += 1
+
+    # truncated answer: closed where it stopped if it stopped between two values, otherwise
+    # without its incomplete trailing elements, and only as a last resort with a half-written string
+    if escaped:
+        out.pop()
+    if in_string:
+        out.append('"')
+    _drop_trailing_comma(out)
+    closed = ''.join(out) + ''.join(_CLOSERS[container] for container in reversed(stack))
+    if not in_string:
+        yield closed
+    for length, open_containers in reversed(cut_points):
+        kept = out[:length]
+        _drop_trailing_comma(kept)
+        yield ''.join(kept) + ''.join(_CLOSERS[container] for container in reversed(open_containers))
+    if in_string:
+        yield closed
+
+
+def _drop_trailing_comma(out: list[str]) -> None:
+    index = len(out) - 1
+    while index >= 0 and out[index].isspace():
+        index -= 1
+    if index >= 0 and out[index] == ',':
+        del out[index:]
+
+
+def _fit_to_model(value, model: Type[BaseModel]):
+    """Wrap a bare list into the single list field of the model, e.g. [...] -> {"pages": [...]}"""
+    if isinstance(value, list):
+        list_fields = [name for name, field in model.model_fields.items() if getattr(field.annotation, '__origin__', None) is list]
+        if len(list_fields) == 1:
+            return {list_fields[0]: value}
+    return value
+
+
+def parse_model(text: str, model: Type[ModelT]) -> ModelT | None:
+    """
+    Parse and validate an LLM answer into `model`, repairing it if needed.
+
+    Returns:
+        The validated model, or None if no repair of the answer is valid
+    """
+    for candidate in repair_candidates(text):
+        try:
+            return model.model_validate(_fit_to_model(json.loads(candidate, strict=False), model))
+        except (ValueError, ValidationError):
+            continue
+    return None
@@ -0,0 +1,345 @@
+"""
+Post-processing that starts as soon as its inputs exist instead of after `crew.kickoff()`.
+
+`BookPostProcessor.on_task_complete` is the stage-completion hook: it is called with every
+task output as the crew produces it and starts the downstream work that became possible,
+e.g. the narration as soon as the English text is final, minutes before the images are done.
+
+A book can have several translations: the English text, the narration, the images and the
+template are shared, and only the pages are rendered once per translation, each into its own
+directory.
+
+Once the book is done, what every page is made of and which outputs and artifacts derive from
+each of its inputs are written to `page_dependencies.json`, so that a single page can be
+regenerated later (see `v0.regenerate`).
+"""
+import hashlib
+import json
+import os
+import posixpath
+import re
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from typing import TYPE_CHECKING, Any, Callable
+
+from jinja2 import Template
+
+from v0.audio import generate_book_audio
+from v0.image_store import ImageStore
+from v0.image_variants import ImageVariantMaker, srcset
+from v0.metrics import RENDER, MetricsRecorder
+from v0.render import clean_template, compile_template, page_data, render_page, save_template, write_merged_book
+from v0.run_control import AUDIO_READY, PAGE_IMAGE, PAGE_RENDERED, RunControl
+
+if TYPE_CHECKING:
+    from crewai.tasks.task_output import TaskOutput
+    from elevenlabs.client import ElevenLabs
+
+    from v0.checkpoint import CheckpointStore
+
+
+WRITE_STORY_CONTENT_TASK = 'write_story_content_task'
+CREATE_ILLUSTRATIONS_TASK = 'create_illustrations_task'
+GENERATE_ILLUSTRATIONS_TASK = 'generate_illustrations_task'
+TRANSLATE_CONTENT_TASK = 'translate_content_task'
+GENERATE_HTML_PAGES_TASK = 'generate_html_pages_task'
+
+AUDIO_FILE_NAME = 'audio.mp3'
+PAGE_DEPENDENCIES_FILE = 'page_dependencies.json'
+
+
+def language_directory(language: str) -> str:
+    """Directory of the pages of one language of a multi-language book, e.g. 'Simplified Chinese' -> 'simplified_chinese'"""
+    return re.sub(r'\W+', '_', language.strip().lower()).strip('_')
+
+
+def translation_task_name(language: str) -> str:
+    """Name of the copy of translate_content_task for an additional target language, e.g. 'translate_content_spanish_task'"""
+    return f'translate_content_{language_directory(language)}_task'
+
+
+def page_inputs(outputs: dict[str, 'TaskOutput'], translations: dict[str, str], page_index: int) -> dict[str, str]:
+    """Task name -> key of the part of its output that belongs to one page, for the tasks a page is made of"""
+    parts = {
+        WRITE_STORY_CONTENT_TASK: outputs[WRITE_STORY_CONTENT_TASK].json_dict['pages'][page_index],
+        GENERATE_ILLUSTRATIONS_TASK: outputs[GENERATE_ILLUSTRATIONS_TASK].json_dict['illustration_paths'][page_index],
+    }
+    if CREATE_ILLUSTRATIONS_TASK in outputs:
+        parts[CREATE_ILLUSTRATIONS_TASK] = outputs[CREATE_ILLUSTRATIONS_TASK].json_dict['illustration_prompts'][page_index]
+    for translation in translations:
+        parts[translation] = outputs[translation].json_dict['pages'][page_index]
+    return {name: _key(part) for name, part in parts.items()}
+
+
+class BookPostProcessor:
+    """
+    Turns task outputs into the files of the book: audio, images, template, pages, merged book.
+
+    Stages and what they wait for:
+        - audio: write_story_content_task
+        - template: generate_html_pages_task
+        - image i: generate_illustrations_task, or `on_page_image` as soon as image i exists
+          (copied/downloaded into output_dir/images, then transcoded into responsive variants).
+          A page given another image (e.g. its streamed prompt was discarded) is prepared and
+          rendered again, once the work on its previous image is over
+        - page i of a translation: template, image i, write_story_content_task and the
+          translation task (pages render concurrently from the template compiled once)
+
+    With a checkpoint store, every artifact is recorded as it completes and skipped by a resumed
+    run if it was made from the same inputs.
+    """
+
+    def __init__(self, output_dir: str, eleven_labs_client: 'ElevenLabs', image_store: ImageStore, max_workers: int = 8, checkpoint: 'CheckpointStore | None' = None, metrics: MetricsRecorder | None = None, tts_concurrency: int = 4, translations: dict[str, str] | None = None, image_variants: ImageVariantMaker | None = None, image_format: str = 'webp', run_control: RunControl | None = None):
+        """
+        Args:
+            output_dir: Directory to save the book into
+            eleven_labs_client: Client used to narrate the pages
+            image_store: Store used to put the illustrations next to the pages
+            max_workers: Maximum number of post-processing jobs running at the same time
+            checkpoint: If given, artifacts are checkpointed into it and reused when unchanged
+            metrics: Recorder receiving a span per stage, a new one if not given
+            tts_concurrency: Maximum number of pages narrated at the same time
+            translations: Translation task name -> directory of its pages and merged book, relative
+                to output_dir ('' for output_dir itself). By default the pages of
+                translate_content_task go into output_dir
+            image_variants: If given, every illustration is transcoded in this pool into print,
+                screen and thumbnail variants, the pages use the print one and list all of them in
+                a `srcset`. Otherwise the pages use the original images
+            image_format: Format of the variants, 'webp' or 'avif'
+            run_control: If given, the audio, every image and every page are reported to it as they
+                are done, and no stage starts once the book is cancelled
+        """
+        self.output_dir = output_dir
+        self.eleven_labs_client = eleven_labs_client
+        self.image_store = image_store
+        self.checkpoint = checkpoint
+        self.metrics = metrics or MetricsRecorder()
+        self.tts_concurrency = tts_concurrency
+        self.translations = translations or {TRANSLATE_CONTENT_TASK: ''}
+        self.image_variants = image_variants
+        self.run_control = run_control
+        self.image_format = None
+        if image_variants is not None:
+            self.image_format = ImageVariantMaker.supported_format(image_format)
+            image_variants.start()
+        for directory in self.translations.values():
+            os.makedirs(os.path.join(output_dir, directory), exist_ok=True)
+        self.outputs: dict[str, 'TaskOutput'] = {}
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='post-process')
+        self._lock = threading.RLock()
+        self._audio: Future | None = None
+        self._template: Future | None = None
+        self._images: dict[int, Future] = {}
+        # page index -> path of its current image
+        self._image_paths: dict[int, str] = {}
+        # (translation task name, page index) -> rendered page
+        self._pages: dict[tuple[str, int], Future] = {}
+        # renders of pages whose image was replaced, still running: the page renders again once they are done
+        self._replaced_pages: dict[tuple[str, int], Future] = {}
+
+    def on_task_complete(self, output: 'TaskOutput') -> None:
+        """Stage-completion hook, register it as `on_task_complete` of the scheduler or `task_callback` of the crew"""
+        with self._lock:
+            self.outputs[output.name] = output
+
+            if output.name == WRITE_STORY_CONTENT_TASK and self._audio is None:
+                texts = [page['content'] for page in output.json_dict['pages']]
+                self._audio = self._executor.submit(
+                    self._run_stage, 'audio', _key(texts),
+                    lambda: generate_book_audio(self.eleven_labs_client, texts, self.output_dir, AUDIO_FILE_NAME, self.tts_concurrency, metrics=self.metrics, run_control=self.run_control),
+                    lambda manifest: [AUDIO_FILE_NAME, 'audio_manifest.json'],
+                )
+                self._audio.add_done_callback(lambda done: done.exception() is None and self._emit(AUDIO_READY, file=AUDIO_FILE_NAME))
+
+            elif output.name == GENERATE_HTML_PAGES_TASK and self._template is None:
+                self._template = self._executor.submit(self._prepare_template, output.raw)
+                self._template.add_done_callback(lambda _: self._start_ready_pages())
+
+            elif output.name == GENERATE_ILLUSTRATIONS_TASK:
+                for i, path in enumerate(output.json_dict['illustration_paths']):
+                    self._start_image(i, path)
+
+            self._start_ready_pages()
+
+    def on_page_image(self, page_index: int, path: str) -> None:
+        """Page-completion hook of the streaming mode, called with every image before generate_illustrations_task completes"""
+        with self._lock:
+            self._start_image(page_index, path)
+
+    def _start_image(self, page_index: int, path: str) -> None:
+        previous = self._images.get(page_index)
+        if previous is not None and self._image_paths[page_index] == path:
+            return
+        future = self._executor.submit(self._prepare_image, path, page_index, previous)
+        future.add_done_callback(lambda _: self._start_ready_pages())
+        self._images[page_index] = future
+        self._image_paths[page_index] = path
+        if previous is not None:
+            # another image for the page: the previous one and the pages rendered with it are dropped
+            previous.cancel()
+            for key in [key for key in self._pages if key[1] == page_index]:
+                page = self._pages.pop(key)
+                if not page.cancel():
+                    self._replaced_pages[key] = page
+                    page.add_done_callback(lambda _: self._start_ready_pages())
+
+    def _prepare_image(self, path: str, page_index: int, previous: Future | None = None) -> dict:
+        """
+        The image of a page next to the pages, and its variants: {'src': ..., 'variants': ... or None}.
+        Waits for the preparation of the `previous` image of the page, which writes the same files.
+        """
+        if previous is not None:
+            wait([previous])
+        name = f'page_{page_index+1}'
+        relative_path = self._run_stage(
+            f'image_{page_index+1}', _key(path),
+            lambda: self.image_store.localize(path, self.output_dir, name),
+            lambda relative_path: [relative_path],
+        )
+        if self.image_variants is None:
+            illustration = {'src': relative_path, 'variants': None}
+        else:
+            variants = self._run_stage(
+                f'image_{page_index+1}_variants', _key(relative_path, self.image_format),
+                lambda: self.image_variants.make(relative_path, self.output_dir, name, self.image_format),
+                lambda variants: [variant['path'] for variant in variants.values()],
+            )
+            illustration = {'src': variants['print']['path'], 'variants': variants}
+        self._emit(PAGE_IMAGE, page=page_index + 1, src=illustration['src'])
+        return illustration
+
+    def finish(self) -> None:
+        """Wait for every stage, raise the first error if any, then write the merged book"""
+        for name in (WRITE_STORY_CONTENT_TASK, *self.translations, GENERATE_ILLUSTRATIONS_TASK, GENERATE_HTML_PAGES_TASK):
+            if name not in self.outputs:
+                raise ValueError(f'Cannot finish the book, {name} did not complete')
+        try:
+            self._audio.result()
+            self._template.result()
+            for image in self._images.values():
+                image.result()
+            with self._lock:
+                replaced_pages = list(self._replaced_pages.values())
+            wait(replaced_pages)
+            self._start_ready_pages()
+            for page in self._pages.values():
+                page.result()
+            for translation, directory in self.translations.items():
+                page_htmls = [self._pages[key].result() for key in sorted(key for key in self._pages if key[0] == translation)]
+                with self.metrics.span(RENDER, _artifact_name(directory, 'merged_book')):
+                    write_merged_book(page_htmls, os.path.join(self.output_dir, directory), _relative(AUDIO_FILE_NAME, directory))
+            self._write_page_dependencies()
+        finally:
+            self._executor.shutdown(wait=True)
+
+    def page_dependencies(self) -> dict:
+        """
+        What every page of the book is made of: the key of its part of every task output, and the
+        task outputs and artifacts (checkpoint names) derived from each of them.
+        """
+        merged_books = [_artifact_name(directory, 'merged_book') for directory in self.translations.values()]
+        pages = []
+        for i in range(len(self.outputs[WRITE_STORY_CONTENT_TASK].json_dict['pages'])):
+            rendered = [_artifact_name(directory, f'page_{i+1}') for directory in self.translations.values()]
+            derived = {
+                WRITE_STORY_CONTENT_TASK: [*self.translations, 'audio', *rendered, *merged_books],
+                CREATE_ILLUSTRATIONS_TASK: [GENERATE_ILLUSTRATIONS_TASK],
+                GENERATE_ILLUSTRATIONS_TASK: [f'image_{i+1}', f'image_{i+1}_variants', *rendered, *merged_books],
+            }
+            for translation, directory in self.translations.items():
+                derived[translation] = [_artifact_name(directory, f'page_{i+1}'), _artifact_name(directory, 'merged_book')]
+            pages.append({'page': i + 1, 'inputs': page_inputs(self.outputs, self.translations, i), 'derived': derived})
+        return {'translations': self.translations, 'image_format': self.image_format, 'pages': pages}
+
+    def _write_page_dependencies(self) -> None:
+        path = os.path.join(self.output_dir, PAGE_DEPENDENCIES_FILE)
+        tmp_path = f'{path}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w+', encoding='utf-8') as f:
+            json.dump(self.page_dependencies(), f, indent=4, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def _prepare_template(self, raw: str) -> Template:
+        with self.metrics.span(RENDER, 'template'):
+            html_template = clean_template(raw)
+            save_template(html_template, self.output_dir)
+            return compile_template(html_template)
+
+    def _run_stage(self, name: str, key: str, stage: Callable[[], Any], files: Callable[[Any], list[str]], load: Callable[[], Any] | None = None) -> Any:
+        """
+        Run a stage, or skip it if the checkpoint says it was already made from the same inputs.
+
+        Args:
+            name: Artifact name in the checkpoint
+            key: Key of the inputs of the stage
+            stage: Produces the artifact and returns its value
+            files: Files of the artifact (relative to output_dir) given the value
+            load: Loads the value of a checkpointed artifact, by default the value saved with it
+        """
+        if self.run_control is not None:
+            self.run_control.raise_if_cancelled()
+        with self.metrics.span(RENDER, name, cached=False) as attributes:
+            if self.checkpoint is not None and self.checkpoint.artifact_done(name, key):
+                attributes['cached'] = True
+                return load() if load else self.checkpoint.artifact_value(name)
+            value = stage()
+            if self.checkpoint is not None:
+                self.checkpoint.mark_artifact(name, key, files(value), None if load else value)
+            return value
+
+    def _render_page(self, raw_template: str, data: dict, image_srcset: str | None, directory: str, page_index: int) -> str:
+        file_name = _artifact_name(directory, f'page_{page_index+1}.html')
+
+        def load() -> str:
+            with open(os.path.join(self.output_dir, file_name), 'r', encoding='utf-8') as f:
+                return f.read()
+
+        page_html = self._run_stage(
+            file_name.replace('.html', ''), _key(raw_template, data, image_srcset),
+            lambda: render_page(self._template.result(), data, os.path.join(self.output_dir, directory), page_index, image_srcset),
+            lambda _: [file_name],
+            load,
+        )
+        self._emit(PAGE_RENDERED, page=page_index + 1, file=file_name)
+        return page_html
+
+    def _emit(self, event_type: str, **data) -> None:
+        if self.run_control is not None:
+            self.run_control.emit(event_type, **data)
+
+    def _start_ready_pages(self) -> None:
+        with self._lock:
+            if self._template is None or not self._template.done() or self._template.exception() is not None:
+                return
+            if WRITE_STORY_CONTENT_TASK not in self.outputs:
+                return
+            english_pages = self.outputs[WRITE_STORY_CONTENT_TASK].json_dict['pages']
+            for translation, directory in self.translations.items():
+                if translation not in self.outputs:
+                    continue
+                translated_pages = self.outputs[translation].json_dict['pages']
+                for i, image in self._images.items():
+                    if (translation, i) in self._pages or not image.done() or image.exception() is not None:
+                        continue
+                    replaced = self._replaced_pages.get((translation, i))
+                    if replaced is not None:
+                        # it writes the same file, the page renders again once it is done
+                        if not replaced.done():
+                            continue
+                        del self._replaced_pages[translation, i]
+                    illustration = image.result()
+                    data = page_data(_relative(illustration['src'], directory), english_pages[i], translated_pages[i])
+                    image_srcset = srcset(illustration['variants'], directory) if illustration['variants'] else None
+                    self._pages[translation, i] = self._executor.submit(self._render_page, self.outputs[GENERATE_HTML_PAGES_TASK].raw, data, image_srcset, directory, i)
+
+
+def _artifact_name(directory: str, name: str) -> str:
+    return posixpath.join(directory, name) if directory else name
+
+
+def _relative(path: str, directory: str) -> str:
+    """`path` (relative to output_dir) as seen from the pages in `directory`"""
+    return posixpath.relpath(path, directory) if directory else path
+
+
+def _key(*parts) -> str:
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
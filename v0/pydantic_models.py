@@ -61,6 +61,7 @@ class Illustrations(BaseModel):
     """Illustration paths model"""
     image_size: str = Field(..., description="The consistent size of the illustration")
     illustration_paths: List[str] = Field(..., description="The paths to the generated illustrations for each page")
+    backends: List[str] = Field(default_factory=list, description="The image backend that produced each illustration, 'cache' if it was reused")
 
 
 
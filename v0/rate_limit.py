@@ -0,0 +1,276 @@
+"""
+Per-provider rate limits and retries of throttled requests.
+
+Every request to Bedrock, fal, Hugging Face or ElevenLabs goes through the `RateLimiter` of its
+provider, shared by every book of the process (see `v0.clients.rate_limiter`):
+
+    limiter = clients.rate_limiter('fal')
+    result = limiter.call(fal_client.subscribe, model_name, arguments=arguments)
+
+A limiter paces requests (requests per second), spends a token budget (tokens per minute, for
+the LLMs) and caps the jobs in flight. A throttled request (HTTP 429, `RateLimitError`,
+`ThrottlingException`...) blocks the provider until its `Retry-After`, or for an exponential
+backoff, halves the rates (they grow back by small steps with every success), and is retried.
+
+With `RATE_LIMIT_STATE_DIR` set, the state of the limiters is kept in lock-protected files in
+that directory, so that the worker processes of one host share the same budgets.
+"""
+import json
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, replace
+from email.utils import parsedate_to_datetime
+from typing import Any, Callable, Iterator
+
+
+@dataclass(frozen=True)
+class RateLimit:
+    """Limits of one provider, None = unlimited"""
+    requests_per_second: float | None = None
+    tokens_per_minute: int | None = None
+    max_concurrency: int | None = None
+
+
+# provider -> limits, overridden with e.g. RATE_LIMIT_FAL="requests_per_second=5,max_concurrency=8"
+DEFAULT_RATE_LIMITS = {
+    'bedrock': RateLimit(requests_per_second=1.0, tokens_per_minute=200_000, max_concurrency=8),
+    'deepseek': RateLimit(max_concurrency=8),
+    'fal': RateLimit(requests_per_second=10.0, max_concurrency=10),
+    'hf': RateLimit(requests_per_second=1.0, max_concurrency=2),
+    'elevenlabs': RateLimit(max_concurrency=5),
+}
+
+_THROTTLING_STATUS_CODES = (429, 529)
+_THROTTLING_MESSAGES = ('throttl', 'too many requests', 'rate limit', 'rate_limit')
+
+
+def rate_limit_for(provider: str) -> RateLimit:
+    """Limits of a provider: the default ones updated with its `RATE_LIMIT_<PROVIDER>` environment variable"""
+    limit = DEFAULT_RATE_LIMITS.get(provider, RateLimit())
+    overrides = os.getenv(f'RATE_LIMIT_{provider.upper()}')
+    if not overrides:
+        return limit
+    values: dict[str, Any] = {}
+    for item in overrides.split(','):
+        key, value = (part.strip() for part in item.split('='))
+        values[key] = None if value.lower() == 'none' else (float(value) if key == 'requests_per_second' else int(value))
+    return replace(limit, **values)
+
+
+def provider_of(model: str) -> str:
+    """Provider of a litellm model name, e.g. 'bedrock/us.anthropic...' -> 'bedrock'"""
+    return model.split('/', 1)[0] if '/' in model else model
+
+
+def estimate_tokens(messages: list[dict[str, str]], completion_tokens: int = 1000) -> int:
+    """Rough token count of a call before it is made, about 4 characters per token"""
+    return sum(len(message.get('content') or '') for message in messages) // 4 + completion_tokens
+
+
+def is_throttling(error: Exception) -> bool:
+    """Whether `error` means the provider is throttling us, rather than a failure of the request"""
+    status_code = getattr(error, 'status_code', None) or getattr(getattr(error, 'response', None), 'status_code', None)
+    if status_code in _THROTTLING_STATUS_CODES:
+        return True
+    text = f'{type(error).__name__} {error}'.lower()
+    return any(message in text for message in _THROTTLING_MESSAGES)
+
+
+def retry_after(error: Exception) -> float | None:
+    """Seconds to wait according to the `Retry-After` header of the error, None if it has none"""
+    headers = getattr(error, 'headers', None) or getattr(getattr(error, 'response', None), 'headers', None) or {}
+    try:
+        value = headers.get('retry-after') or headers.get('Retry-After')
+    except AttributeError:
+        return None
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def _initial_state() -> dict[str, float]:
+    # requests_tat / tokens_tat: theoretical arrival time of the next request / token
+    # factor: share of the configured rates currently allowed, halved when throttled
+    return {'requests_tat': 0.0, 'tokens_tat': 0.0, 'blocked_until': 0.0, 'factor': 1.0, 'throttled_in_a_row': 0}
+
+
+class _MemoryState:
+    """State of a limiter shared by the threads of the process"""
+
+    def __init__(self, max_concurrency: int | None):
+        self._state = _initial_state()
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_concurrency) if max_concurrency else None
+
+    @contextmanager
+    def update(self) -> Iterator[dict[str, float]]:
+        with self._lock:
+            yield self._state
+
+    @contextmanager
+    def slot(self) -> Iterator[None]:
+        if self._slots is None:
+            yield
+            return
+        with self._slots:
+            yield
+
+
+class _FileState:
+    """State of a limiter shared by the processes of the host, in `state_dir/<name>.json`"""
+
+    def __init__(self, state_dir: str, name: str, max_concurrency: int | None):
+        os.makedirs(state_dir, exist_ok=True)
+        self.path = os.path.join(state_dir, f'{name}.json')
+        self.lock_path = os.path.join(state_dir, f'{name}.lock')
+        # one lock file per concurrent job, held while the job runs
+        self.slot_paths = [os.path.join(state_dir, f'{name}.slot{i}.lock') for i in range(max_concurrency or 0)]
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def update(self) -> Iterator[dict[str, float]]:
+        import fcntl
+
+        with self._lock, open(self.lock_path, 'a+') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                try:
+                    with open(self.path, 'r', encoding='utf-8') as f:
+                        state = {**_initial_state(), **json.load(f)}
+                except (FileNotFoundError, ValueError):
+                    state = _initial_state()
+                yield state
+                tmp_path = f'{self.path}.{os.getpid()}.tmp'
+                with open(tmp_path, 'w+', encoding='utf-8') as f:
+                    json.dump(state, f)
+                os.replace(tmp_path, self.path)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @contextmanager
+    def slot(self) -> Iterator[None]:
+        import fcntl
+
+        if not self.slot_paths:
+            yield
+            return
+        while True:
+            for slot_path in self.slot_paths:
+                slot_file = open(slot_path, 'a+')
+                try:
+                    fcntl.flock(slot_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    slot_file.close()
+                    continue
+                try:
+                    yield
+                    return
+                finally:
+                    fcntl.flock(slot_file, fcntl.LOCK_UN)
+                    slot_file.close()
+            time.sleep(0.05)
+
+
+class RateLimiter:
+    """Rate limit, concurrency cap and adaptive backoff of one provider"""
+
+    def __init__(self, name: str, limit: RateLimit, state_dir: str | None = None, max_retries: int = 5, base_delay: float = 1.0, max_delay: float = 60.0):
+        """
+        Args:
+            name: Provider, e.g. 'bedrock'
+            limit: Limits of the provider
+            state_dir: If given, the state is shared through files with the other processes
+                using the same directory. Otherwise it is shared by the threads of this process
+            max_retries: Retries of a throttled request before its error is raised
+            base_delay: Backoff after the first throttled request without `Retry-After`, doubled
+                for every further one in a row
+            max_delay: Maximum backoff
+        """
+        self.name = name
+        self.limit = limit
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._state = _FileState(state_dir, name, limit.max_concurrency) if state_dir else _MemoryState(limit.max_concurrency)
+
+    def call(self, fn: Callable[..., Any], *args, tokens: int = 0, **kwargs) -> Any:
+        """
+        `fn(*args, **kwargs)` within the limits, retried while the provider throttles it.
+
+        Args:
+            tokens: Estimated tokens of the call, spent from the tokens per minute
+        """
+        for attempt in range(self.max_retries + 1):
+            try:
+                with self.acquire(tokens):
+                    return fn(*args, **kwargs)
+            except Exception as e:
+                # the backoff is already set by `acquire`, the next attempt waits for it
+                if attempt == self.max_retries or not is_throttling(e):
+                    raise
+
+    @contextmanager
+    def acquire(self, tokens: int = 0) -> Iterator[None]:
+        """
+        Wait for a free job slot and for the request and token budgets, then run the body.
+        A throttling error raised by the body slows the provider down before it propagates.
+        """
+        with self._state.slot():
+            delay = self._reserve(tokens)
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                yield
+            except Exception as e:
+                if is_throttling(e):
+                    self._throttled(retry_after(e))
+                raise
+            self._succeeded()
+
+    def record_tokens(self, tokens: int) -> None:
+        """Correct the token budget once the actual usage of a call is known, `tokens` = actual - estimated"""
+        if not self.limit.tokens_per_minute or not tokens:
+            return
+        with self._state.update() as state:
+            state['tokens_tat'] += tokens * 60 / (self.limit.tokens_per_minute * state['factor'])
+
+    def _reserve(self, tokens: int) -> float:
+        """Reserve the start of the next request, returns the seconds to wait for it"""
+        now = time.time()
+        with self._state.update() as state:
+            start = max(now, state['blocked_until'])
+            if self.limit.tokens_per_minute and tokens:
+                # bucket of one minute of tokens
+                tat = max(state['tokens_tat'], start) + tokens * 60 / (self.limit.tokens_per_minute * state['factor'])
+                start = max(start, tat - 60)
+                state['tokens_tat'] = tat
+            if self.limit.requests_per_second:
+                start = max(start, state['requests_tat'])
+                state['requests_tat'] = start + 1 / (self.limit.requests_per_second * state['factor'])
+        return start - now
+
+    def _throttled(self, retry_after_seconds: float | None) -> None:
+        with self._state.update() as state:
+            state['throttled_in_a_row'] += 1
+            state['factor'] = max(0.05, state['factor'] / 2)
+            if retry_after_seconds is None:
+                delay = min(self.max_delay, self.base_delay * 2 ** (state['throttled_in_a_row'] - 1))
+                retry_after_seconds = delay * random.uniform(0.5, 1.0)
+            state['blocked_until'] = max(state['blocked_until'], time.time() + retry_after_seconds)
+        print(f'{self.name} is throttling, requests paused for {retry_after_seconds:.1f}s')
+
+    def _succeeded(self) -> None:
+        with self._state.update() as state:
+            if state['factor'] < 1.0 or state['throttled_in_a_row']:
+                state['factor'] = min(1.0, state['factor'] + 0.05)
+                state['throttled_in_a_row'] = 0
@@ -0,0 +1,218 @@
+"""
+Regeneration of a single page of a finished book.
+
+When an editor rejects the text or the illustration of one page, `regenerate_page` applies the
+override to the task outputs of the book (its checkpoints) and follows `page_dependencies.json`
+(written next to `result.json`) to redo only what derives from the changed parts of that page:
+its translations, its image, its narration segment, its pages and the merged books. Everything
+else is reused from the checkpoints.
+
+    regenerate_page('books/firefighter', 2, content='James climbs the ladder to the window.')
+    regenerate_page('books/firefighter', 4, illustration_prompt='James waves from the fire truck')
+
+Usage:
+    python -m v0.regenerate books/firefighter 3 --content "James climbs the ladder to the window."
+"""
+import argparse
+import json
+import os
+from typing import TYPE_CHECKING
+
+from crewai.agents.agent_builder.utilities.base_token_process import TokenProcess
+
+from v0 import clients
+from v0.checkpoint import CheckpointStore
+from v0.image_batch import CACHED_BACKEND, build_prompt
+from v0.metrics import TASK, MetricsRecorder, llm_cost
+from v0.pipeline import (
+    CREATE_ILLUSTRATIONS_TASK, GENERATE_ILLUSTRATIONS_TASK, PAGE_DEPENDENCIES_FILE, TRANSLATE_CONTENT_TASK,
+    WRITE_STORY_CONTENT_TASK, BookPostProcessor, page_inputs, translation_task_name,
+)
+from v0.pydantic_models import ArtDirection, IllustrationPrompt, PageContent
+
+if TYPE_CHECKING:
+    from crewai.tasks.task_output import TaskOutput
+
+    from v0.crew import StoryBookCrew
+
+
+# backend of an illustration given by the editor
+OVERRIDE_BACKEND = 'override'
+
+
+def regenerate_page(
+    output_dir: str,
+    page_index: int,
+    content: str | None = None,
+    core_vocabulary_word: str | None = None,
+    illustration_prompt: str | None = None,
+    illustration_path: str | None = None,
+    translations: dict[str, dict[str, str]] | None = None,
+    max_concurrency: int = 4,
+) -> dict[str, list[str]]:
+    """
+    Change one page of a book made by `generate_story_book` and redo only what depends on it.
+
+    Args:
+        output_dir: Output directory of the book
+        page_index: Index of the page, from 0
+        content: New English text of the page, translated again into every language
+        core_vocabulary_word: New core vocabulary word of the page
+        illustration_prompt: New scene of the illustration, drawn with the characters and art
+            direction of the book
+        illustration_path: Image (local path or URL) to use as the illustration instead of
+            generating one
+        translations: Language -> {'content': ..., 'core_vocabulary_word': ...} replacing the
+            translation of the page instead of asking the translator
+        max_concurrency: Maximum number of TTS requests in flight
+
+    Returns:
+        dict: The task outputs ('tasks') and artifacts ('artifacts') that were made again
+
+    Raises:
+        ValueError: If the book has no page dependencies (it was made before they were recorded or
+            did not finish), or no such page
+    """
+    dependencies_file = os.path.join(output_dir, PAGE_DEPENDENCIES_FILE)
+    if not os.path.exists(dependencies_file):
+        raise ValueError(f'{output_dir} has no {PAGE_DEPENDENCIES_FILE}, generate (or resume) the whole book first')
+    with open(dependencies_file, 'r', encoding='utf-8') as f:
+        dependencies = json.load(f)
+    if not 0 <= page_index < len(dependencies['pages']):
+        raise ValueError(f"The book has {len(dependencies['pages'])} pages, there is no page index {page_index}")
+    page = dependencies['pages'][page_index]
+
+    checkpoint = CheckpointStore(output_dir)
+    inputs = checkpoint.load_inputs()
+    outputs = checkpoint.load_task_outputs()
+    languages = [inputs['target_language']] if isinstance(inputs['target_language'], str) else list(dict.fromkeys(inputs['target_language']))
+    translation_tasks = {language: TRANSLATE_CONTENT_TASK if i == 0 else translation_task_name(language) for i, language in enumerate(languages)}
+    metrics = MetricsRecorder()
+
+    # the overrides
+    if content is not None or core_vocabulary_word is not None:
+        english_page = outputs[WRITE_STORY_CONTENT_TASK].json_dict['pages'][page_index]
+        english_page.update({key: value for key, value in (('content', content), ('core_vocabulary_word', core_vocabulary_word)) if value is not None})
+    if illustration_prompt is not None:
+        outputs[CREATE_ILLUSTRATIONS_TASK].json_dict['illustration_prompts'][page_index]['prompt'] = illustration_prompt
+    if illustration_path is not None:
+        illustrations = outputs[GENERATE_ILLUSTRATIONS_TASK].json_dict
+        illustrations['illustration_paths'][page_index] = illustration_path
+        if illustrations.get('backends'):
+            illustrations['backends'][page_index] = OVERRIDE_BACKEND
+    for language, translated_page in (translations or {}).items():
+        if language not in translation_tasks:
+            raise ValueError(f'The book has no {language} translation, its languages are {languages}')
+        outputs[translation_tasks[language]].json_dict['pages'][page_index] = PageContent.model_validate(translated_page).model_dump()
+
+    # everything derived from the parts of the page that changed, in dependency order
+    current_inputs = page_inputs(outputs, dependencies['translations'], page_index)
+    changed = [name for name, key in page['inputs'].items() if current_inputs.get(name) != key]
+    if not changed:
+        print(f'Page {page_index+1} did not change')
+        return {'tasks': [], 'artifacts': []}
+    stale = list(changed)
+    for name in stale:
+        stale += [derived for derived in page['derived'].get(name, []) if derived not in stale]
+    stale_tasks = [name for name in stale if name in outputs]
+    stale_artifacts = [name for name in stale if name not in outputs]
+
+    # the outputs that changed are kept as they are, the ones derived from them are made again
+    redo_tasks = [name for name in stale_tasks if name not in changed]
+    if redo_tasks:
+        from v0.crew import StoryBookCrew
+
+        story_book_crew = StoryBookCrew(metrics=metrics, target_languages=languages)
+        story_book_crew.crew()._interpolate_inputs({'story_theme': inputs['story_theme'], 'age_range': inputs['age_range'], 'target_language': languages[0]})
+        for name in redo_tasks:
+            if name == GENERATE_ILLUSTRATIONS_TASK:
+                _draw_page(story_book_crew, outputs, page_index)
+            else:
+                _translate_page(story_book_crew, name, outputs, page_index, metrics)
+
+    for name in stale_tasks:
+        outputs[name].raw = json.dumps(outputs[name].json_dict, ensure_ascii=False)
+        checkpoint.save_task_output(outputs[name])
+    _update_result(output_dir, [outputs[name] for name in stale_tasks])
+    checkpoint.invalidate_artifacts(stale_artifacts)
+
+    # the post-processing reuses every checkpointed artifact that is still valid
+    post_processor = BookPostProcessor(
+        output_dir, clients.eleven_labs(), clients.image_store(), checkpoint=checkpoint, metrics=metrics,
+        tts_concurrency=max_concurrency, translations=dependencies['translations'],
+        image_variants=clients.image_variants() if dependencies['image_format'] else None, image_format=dependencies['image_format'] or 'webp',
+    )
+    try:
+        for output in outputs.values():
+            post_processor.on_task_complete(output)
+        post_processor.finish()
+    finally:
+        metrics.save(output_dir, f'metrics_page_{page_index+1}.json')
+    print(f"Page {page_index+1} regenerated: {', '.join(stale)}")
+    return {'tasks': stale_tasks, 'artifacts': stale_artifacts}
+
+
+def _translate_page(story_book_crew: 'StoryBookCrew', task_name: str, outputs: dict[str, 'TaskOutput'], page_index: int, metrics: MetricsRecorder) -> None:
+    """Translate the English text of the page again with the translator of `task_name`"""
+    task = story_book_crew.translation_tasks[task_name]
+    english_pages = [PageContent.model_validate(english_page) for english_page in outputs[WRITE_STORY_CONTENT_TASK].json_dict['pages']]
+    usage = story_book_crew._translation_usage.setdefault(task_name, TokenProcess())
+    with metrics.span(TASK, task_name, page=page_index + 1) as attributes:
+        translated_page = story_book_crew.translate_page(task, page_index, english_pages[page_index], english_pages[:page_index])
+        model = task.agent.llm.model
+        attributes.update(
+            model=model, prompt_tokens=usage.prompt_tokens, completion_tokens=usage.completion_tokens,
+            total_tokens=usage.total_tokens, llm_requests=usage.successful_requests,
+            cost_usd=llm_cost(model, usage.prompt_tokens, usage.completion_tokens),
+        )
+    outputs[task_name].json_dict['pages'][page_index] = translated_page.model_dump()
+
+
+def _draw_page(story_book_crew: 'StoryBookCrew', outputs: dict[str, 'TaskOutput'], page_index: int) -> None:
+    """Generate the illustration of the page from its (new) prompt and the art direction of the book"""
+    art_direction = ArtDirection.model_validate(outputs['design_art_direction_task'].json_dict)
+    illustration_prompt = IllustrationPrompt.model_validate(outputs[CREATE_ILLUSTRATIONS_TASK].json_dict['illustration_prompts'][page_index])
+    character_designs = [character_design.model_dump() for character_design in art_direction.character_designs]
+    prompt = build_prompt(illustration_prompt.model_dump(), character_designs, art_direction.color_palette, art_direction.art_style)
+    generator = story_book_crew.image_generator()
+    illustrations = outputs[GENERATE_ILLUSTRATIONS_TASK].json_dict
+    illustrations['illustration_paths'][page_index] = generator.generate_page(prompt, page_index)
+    if illustrations.get('backends'):
+        illustrations['backends'][page_index] = generator.backends.get(prompt, CACHED_BACKEND)
+
+
+def _update_result(output_dir: str, changed_outputs: list['TaskOutput']) -> None:
+    """Replace the outputs of the changed tasks in `result.json`"""
+    result_json_path = os.path.join(output_dir, 'result.json')
+    if not changed_outputs or not os.path.exists(result_json_path):
+        return
+    with open(result_json_path, 'r', encoding='utf-8') as f:
+        result_dict = json.load(f)
+    changed = {output.name: output.model_dump() for output in changed_outputs}
+    result_dict['tasks_output'] = [changed.get(task_output['name'], task_output) for task_output in result_dict['tasks_output']]
+    tmp_path = f'{result_json_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w+', encoding='utf-8') as f:
+        json.dump(result_dict, f, indent=4, ensure_ascii=False)
+    os.replace(tmp_path, result_json_path)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Regenerate one page of a book and what derives from it')
+    parser.add_argument('output_dir', help='Output directory of the book')
+    parser.add_argument('page', type=int, help='Page number, from 1')
+    parser.add_argument('--content', help='New English text of the page')
+    parser.add_argument('--core-vocabulary-word', help='New core vocabulary word of the page')
+    parser.add_argument('--illustration-prompt', help='New scene of the illustration')
+    parser.add_argument('--illustration-path', help='Image to use as the illustration')
+    parser.add_argument('--translations', help='JSON object, language -> {"content": ..., "core_vocabulary_word": ...}')
+    args = parser.parse_args()
+
+    regenerate_page(
+        args.output_dir, args.page - 1, content=args.content, core_vocabulary_word=args.core_vocabulary_word,
+        illustration_prompt=args.illustration_prompt, illustration_path=args.illustration_path,
+        translations=json.loads(args.translations) if args.translations else None,
+    )
+
+
+if __name__ == '__main__':
+    main()
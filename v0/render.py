@@ -0,0 +1,190 @@
+"""
+HTML rendering of the book pages from the template written by the page_designer agent.
+"""
+import os
+import re
+
+from jinja2 import Environment, Template
+
+from v0.output_repair import strip_code_fences
+
+
+_environment = Environment()
+_STYLE_RE = re.compile(r'<style\b[^>]*>.*?</style>', re.DOTALL | re.IGNORECASE)
+_STYLESHEET_LINK_RE = re.compile(r'<link\b[^>]*rel=["\']?stylesheet[^>]*>', re.IGNORECASE)
+_SCRIPT_RE = re.compile(r'<script\b[^>]*>.*?</script>', re.DOTALL | re.IGNORECASE)
+_BODY_RE = re.compile(r'<body\b([^>]*)>(.*)</body>', re.DOTALL | re.IGNORECASE)
+_HEAD_RE = re.compile(r'<!DOCTYPE[^>]*>|<head\b.*?</head>|</?html\b[^>]*>', re.DOTALL | re.IGNORECASE)
+_CLASS_RE = re.compile(r'class=["\']([^"\']*)["\']', re.IGNORECASE)
+# `html`/`body` as a type selector, i.e. followed by a `{` before any `}`
+_PAGE_SELECTOR_RE = re.compile(r'(?<![\w.#:-])(?:html|body)(?![\w-])(?=[^{}<]*\{)', re.IGNORECASE)
+_IMG_RE = re.compile(r'(<img\b[^>]*?)\s*/?(?=>)', re.IGNORECASE)
+
+
+def clean_template(html_template: str) -> str:
+    """Remove the markdown code block (and any text around it) the LLM may wrap the template in"""
+    return strip_code_fences(html_template)
+
+
+def save_template(html_template: str, output_dir: str) -> str:
+    template_file = os.path.join(output_dir, 'template.html')
+    with open(template_file, 'w+', encoding='utf-8') as f:
+        f.write(html_template)
+    return template_file
+
+
+def page_data(illustration_path: str, english_page: dict, translated_page: dict) -> dict:
+    """Template variables of one page"""
+    return {
+        'illustration_path': illustration_path,
+        'english_text': english_page['content'],
+        'translated_text': translated_page['content'],
+        'english_highlight_vocabulary_word': english_page['core_vocabulary_word'],
+        'translated_highlight_vocabulary_word': translated_page['core_vocabulary_word']
+    }
+
+
+def compile_template(html_template: str) -> Template:
+    """Compile the template once, the compiled template is shared by every page (rendering is thread-safe)"""
+    return _environment.from_string(html_template)
+
+
+def render_page(template: Template, data: dict, output_dir: str, page_index: int, srcset: str | None = None) -> str:
+    """
+    Render one page and save it as `page_{page_index + 1}.html`.
+
+    Args:
+        srcset: Responsive variants of the illustration, added to the <img> tags showing it
+
+    Returns:
+        str: The rendered HTML
+    """
+    page_html = template.render(**data)
+    if srcset:
+        page_html = responsive_images(page_html, data['illustration_path'], srcset)
+
+    # Save to a file
+    output_file = os.path.join(output_dir, f'page_{page_index+1}.html')
+    with open(output_file, 'w+', encoding='utf-8') as f:
+        f.write(page_html)
+    return page_html
+
+
+def responsive_images(page_html: str, src: str, srcset: str, sizes: str = '(max-width: 21cm) 100vw, 21cm') -> str:
+    """Add `srcset` and `sizes` to the <img> tags showing `src`, so the browser downloads the variant that fits the screen"""
+    img_re = re.compile(r'(<img\b[^>]*?\bsrc=(["\'])' + re.escape(src) + r'\2[^>]*?)(\s*/?>)', re.IGNORECASE)
+    return img_re.sub(lambda match: match.group(0) if 'srcset=' in match.group(0) else f'{match.group(1)} srcset="{srcset}" sizes="{sizes}"{match.group(3)}', page_html)
+
+
+def split_page(page_html: str) -> tuple[list[str], list[str], str, str]:
+    """
+    Split a standalone page into the parts that can be shared between pages and its own content.
+
+    Returns:
+        tuple: (style and stylesheet link tags, script tags, body class, body content without styles and scripts)
+    """
+    styles = _STYLE_RE.findall(page_html) + _STYLESHEET_LINK_RE.findall(page_html)
+    scripts = _SCRIPT_RE.findall(page_html)
+    body = _BODY_RE.search(page_html)
+    if body:
+        body_attributes, content = body.group(1), body.group(2)
+    else:
+        body_attributes, content = '', _HEAD_RE.sub('', page_html)
+    body_class = _CLASS_RE.search(body_attributes)
+    for tag in styles + scripts:
+        content = content.replace(tag, '')
+    return styles, scripts, body_class.group(1) if body_class else '', content.strip()
+
+
+def scope_page_css(style_tag: str) -> str:
+    """Point `html`/`body` selectors of a page stylesheet at the page section of the merged book"""
+    return _PAGE_SELECTOR_RE.sub('.book-page', style_tag)
+
+
+def lazy_load_images(content: str) -> str:
+    return _IMG_RE.sub(lambda match: match.group(0) if 'loading=' in match.group(0) else f'{match.group(1)} loading="lazy" decoding="async"', content)
+
+
+def write_merged_book(page_htmls: list[str], output_dir: str, audio_file_name: str = 'audio.mp3') -> str:
+    """
+    Create a single-document book with all pages side by side.
+
+    The CSS of the template is hoisted out of the pages and included once, `html`/`body` rules are
+    applied to each page section instead, and the images below the first page are lazy-loaded, so
+    large books open quickly. A page with scripts is embedded as an iframe of its own file
+    (`page_{i+1}.html` next to the merged book) instead: its scripts expect a document of their
+    own, e.g. look up its elements by id, which repeat from page to page.
+    """
+    shared_styles: list[str] = []
+    sections = []
+    for i, page_html in enumerate(page_htmls):
+        styles, scripts, body_class, content = split_page(page_html)
+        loading = ' loading="lazy"' if i > 0 else ''
+        if scripts:
+            sections.append(f'<section class="book-page" id="page-{i+1}">\n<iframe src="page_{i+1}.html" title="Page {i+1}"{loading}></iframe>\n</section>')
+            continue
+        shared_styles += [scope_page_css(style) for style in styles if scope_page_css(style) not in shared_styles]
+        if i > 0:
+            content = lazy_load_images(content)
+        sections.append(f'<section class="book-page {body_class}" id="page-{i+1}">\n{content}\n</section>')
+
+    merged_html = f"""<!DOCTYPE html>
+<html>
+<head>
+    <meta charset="utf-8">
+    {"".join(shared_styles)}
+    <style>
+        body {{
+            margin: 0;
+            padding: 20px;
+            display: flex;
+            overflow-x: auto;
+            min-height: 100vh;
+        }}
+        .page-container {{
+            display: flex;
+            gap: 20px;
+        }}
+        .book-page {{
+            flex: 0 0 auto;
+            position: relative;
+            overflow: hidden;
+            width: 21cm; /* A4 width */
+            height: 29.7cm; /* A4 height */
+            border: 1px solid #ccc;
+            box-shadow: 0 0 10px rgba(0,0,0,0.1);
+            content-visibility: auto; /* skip layout and paint of the pages out of view */
+            contain-intrinsic-size: 21cm 29.7cm;
+        }}
+        .book-page > iframe {{
+            display: block;
+            width: 100%;
+            height: 100%;
+            border: 0;
+        }}
+        #audio-player {{
+            position: fixed;
+            top: 20px; /* Hide below viewport */
+            right: 20px;
+            z-index: 1000;
+        }}
+    </style>
+</head>
+<body>
+    <audio id="audio-player" controls autoplay preload="none">
+        <source src="{audio_file_name}" type="audio/mpeg">
+        Your browser does not support the audio element.
+    </audio>
+    <div class="page-container">
+        {"".join(sections)}
+    </div>
+</body>
+</html>
+"""
+
+    # Save the merged file
+    merged_file = os.path.join(output_dir, 'merged_book.html')
+    with open(merged_file, 'w+', encoding='utf-8') as f:
+        f.write(merged_html)
+    return merged_file
+
@@ -0,0 +1,107 @@
+"""
+Progress events and cancellation of one book.
+
+A `RunControl` is handed to every part of the pipeline working on a book (scheduler, image
+generation, narration, post-processing). They report progress through `emit`, and check
+`raise_if_cancelled` before starting anything, so that `cancel` stops the book at the next step:
+no new task, page or TTS segment starts, the narration streams in progress are dropped and the
+fal jobs in flight are cancelled on fal's side.
+
+Events are dicts like {'type': 'task_completed', 'task': 'write_story_content_task', 'time': 12.3},
+`time` being the seconds since the control was created.
+
+A part of the book that can be given up alone (e.g. one request of the image router) gets a child
+control: it is cancelled with the book, but cancelling it only cancels its own fal jobs.
+"""
+import threading
+import time
+from typing import Any, Callable
+
+
+# event types
+TASK_STARTED = 'task_started'
+TASK_COMPLETED = 'task_completed'
+PAGE_IMAGE = 'page_image'
+PAGE_RENDERED = 'page_rendered'
+AUDIO_READY = 'audio_ready'
+BOOK_COMPLETED = 'book_completed'
+BOOK_FAILED = 'book_failed'
+BOOK_CANCELLED = 'book_cancelled'
+
+
+class BookCancelled(Exception):
+    """The book was cancelled with `RunControl.cancel`"""
+
+
+class RunControl:
+    """Thread-safe progress reporting and cancellation of one book"""
+
+    def __init__(self, on_event: Callable[[dict[str, Any]], None] | None = None, parent: 'RunControl | None' = None):
+        """
+        Args:
+            on_event: Called with every event, from the thread that produced it
+            parent: Control of the book this control is a part of, its fal jobs are also
+                tracked by the parent and it counts as cancelled once the parent is
+        """
+        self.on_event = on_event
+        self.parent = parent
+        self._start = time.perf_counter()
+        self._cancelled = threading.Event()
+        # fal request id -> application, of the jobs in flight
+        self._fal_jobs: dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set() or (self.parent is not None and self.parent.cancelled)
+
+    def emit(self, event_type: str, **data: Any) -> None:
+        """Report progress, an error of the listener does not stop the book"""
+        if self.on_event is None:
+            return
+        try:
+            self.on_event({'type': event_type, **data, 'time': round(time.perf_counter() - self._start, 4)})
+        except Exception as e:
+            print(f'Progress listener failed on {event_type}: {e}')
+
+    def raise_if_cancelled(self) -> None:
+        """
+        Raises:
+            BookCancelled: If the book was cancelled
+        """
+        if self.cancelled:
+            raise BookCancelled('The book was cancelled')
+
+    def cancel(self) -> None:
+        """Stop the book: nothing new starts and the fal jobs in flight are cancelled"""
+        self._cancelled.set()
+        with self._lock:
+            fal_jobs = dict(self._fal_jobs)
+        for request_id, application in fal_jobs.items():
+            self._cancel_fal_job(application, request_id)
+
+    def track_fal_job(self, application: str, request_id: str) -> None:
+        """Record a fal job in flight, cancelled right away if the book already is"""
+        if self.parent is not None:
+            self.parent.track_fal_job(application, request_id)
+        with self._lock:
+            self._fal_jobs[request_id] = application
+        # a job of a cancelled parent was already cancelled by the parent
+        if self._cancelled.is_set():
+            self._cancel_fal_job(application, request_id)
+
+    def untrack_fal_job(self, request_id: str) -> None:
+        with self._lock:
+            self._fal_jobs.pop(request_id, None)
+        if self.parent is not None:
+            self.parent.untrack_fal_job(request_id)
+
+    @staticmethod
+    def _cancel_fal_job(application: str, request_id: str) -> None:
+        import fal_client
+
+        try:
+            fal_client.cancel(application, request_id)
+        except Exception as e:
+            # already done, or fal is unreachable: the result is dropped anyway
+            print(f'Could not cancel fal job {request_id}: {e}')
@@ -0,0 +1,433 @@
+"""
+Dependency-aware parallel execution for a crewai Crew.
+
+crewai's Process.sequential runs tasks one after another even when a task only needs a
+few of the earlier ones. Here the DAG is built from the `context=` list of every task and
+each task starts as soon as all of its context tasks are done, so independent branches
+(e.g. translation vs. art direction -> prompts -> images) run at the same time.
+
+Tasks whose output can be computed from their context without an LLM can be given a direct
+stage, which the scheduler runs instead of the agent (or before it, if the stage can decline).
+Tasks given a fallback LLM run again with it when their output does not validate.
+Tasks given context fields (see `v0.context_projection`) only see those fields of their context
+outputs in their prompt, and the tokens of their context before and after are logged.
+"""
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from typing import Any, Callable
+
+from crewai import LLM, Agent, Crew, Task
+from crewai.crews.crew_output import CrewOutput
+from crewai.tasks.output_format import OutputFormat
+from crewai.tasks.task_output import TaskOutput
+from crewai.types.usage_metrics import UsageMetrics
+from crewai.utilities.formatter import aggregate_raw_outputs_from_task_outputs
+from crewai.utilities.i18n import I18N
+from pydantic import BaseModel, ValidationError
+
+from v0.cache import TaskOutputCache
+from v0.context_projection import ContextFields, project_context
+from v0.metrics import TASK, MetricsRecorder, llm_cost
+from v0.run_control import TASK_COMPLETED, TASK_STARTED, RunControl
+
+
+# a direct stage computes the output of a task from the outputs of its context tasks,
+# or returns None to let the agent run the task
+DirectStage = Callable[[Task, list[TaskOutput]], TaskOutput | None]
+
+# counter of the tasks run again with their fallback LLM
+MODEL_FALLBACKS = 'model_fallbacks'
+
+
+@dataclass
+class TaskTiming:
+    """Wall-clock timing of one task in a scheduled run, relative to the start of the run"""
+    name: str
+    start: float
+    end: float
+    dependencies: list[str] = field(default_factory=list)
+    cached: bool = False
+
+    @property
+    def duration(self) -> float:
+        return self.end - self.start
+
+
+@dataclass
+class ScheduleReport:
+    """Timings of a scheduled run and its critical path"""
+    timings: dict[str, TaskTiming]
+    critical_path: list[str]
+    wall_time: float
+
+    @property
+    def critical_path_duration(self) -> float:
+        return sum(self.timings[name].duration for name in self.critical_path)
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            'wall_time': round(self.wall_time, 3),
+            'critical_path': self.critical_path,
+            'critical_path_duration': round(self.critical_path_duration, 3),
+            'tasks': {
+                name: {
+                    'start': round(timing.start, 3),
+                    'end': round(timing.end, 3),
+                    'duration': round(timing.duration, 3),
+                    'dependencies': timing.dependencies,
+                    'cached': timing.cached,
+                }
+                for name, timing in self.timings.items()
+            },
+        }
+
+    def summary(self) -> str:
+        path = ' -> '.join(f'{name} ({self.timings[name].duration:.1f}s)' for name in self.critical_path)
+        return f'Wall time {self.wall_time:.1f}s, critical path {self.critical_path_duration:.1f}s: {path}'
+
+
+def build_task_graph(tasks: list[Task]) -> dict[str, list[str]]:
+    """
+    Build the dependency graph of the tasks from their declared context.
+
+    Args:
+        tasks: Tasks of the crew, each with a unique name
+
+    Returns:
+        dict[str, list[str]]: Task name -> names of the tasks it depends on, in declaration order
+    """
+    names = [task.name for task in tasks]
+    if len(set(names)) != len(names) or None in names:
+        raise ValueError(f'Every task needs a unique name to be scheduled, got {names}')
+
+    graph = {}
+    for task in tasks:
+        dependencies = [context_task.name for context_task in (task.context or [])]
+        unknown = [name for name in dependencies if name not in names]
+        if unknown:
+            raise ValueError(f'Task {task.name} depends on {unknown} which are not part of the crew')
+        graph[task.name] = dependencies
+
+    # Kahn's algorithm, only to reject cycles early
+    remaining = {name: set(dependencies) for name, dependencies in graph.items()}
+    while remaining:
+        ready = [name for name, dependencies in remaining.items() if not dependencies]
+        if not ready:
+            raise ValueError(f'Task context contains a cycle between {sorted(remaining)}')
+        for name in ready:
+            del remaining[name]
+        for dependencies in remaining.values():
+            dependencies.difference_update(ready)
+    return graph
+
+
+def find_critical_path(graph: dict[str, list[str]], durations: dict[str, float]) -> list[str]:
+    """
+    Find the chain of dependent tasks with the largest total duration.
+
+    Args:
+        graph: Task name -> names of the tasks it depends on
+        durations: Task name -> duration in seconds
+
+    Returns:
+        list[str]: Task names on the critical path, from first to last
+    """
+    longest: dict[str, tuple[float, list[str]]] = {}
+
+    def visit(name: str) -> tuple[float, list[str]]:
+        if name not in longest:
+            best: tuple[float, list[str]] = (0.0, [])
+            for dependency in graph[name]:
+                candidate = visit(dependency)
+                if candidate[0] > best[0]:
+                    best = candidate
+            longest[name] = (best[0] + durations.get(name, 0.0), best[1] + [name])
+        return longest[name]
+
+    return max((visit(name) for name in graph), key=lambda item: item[0], default=(0.0, []))[1]
+
+
+def build_task_output(task: Task, result: BaseModel | str) -> TaskOutput:
+    """The output of `task` for a result computed without its agent, shaped like an `output_json` task output (or a raw one for text)"""
+    if isinstance(result, str):
+        raw, json_dict, output_format = result, None, OutputFormat.RAW
+    else:
+        raw, json_dict, output_format = result.model_dump_json(), result.model_dump(), OutputFormat.JSON
+    return TaskOutput(
+        name=task.name,
+        description=task.description,
+        expected_output=task.expected_output,
+        raw=raw,
+        json_dict=json_dict,
+        agent=task.agent.role if task.agent else '',
+        output_format=output_format,
+    )
+
+
+def output_is_valid(task: Task, output: TaskOutput) -> bool:
+    """Whether the output of a task with an `output_pydantic`/`output_json` model validates against it"""
+    model = task.output_pydantic or task.output_json
+    if model is None:
+        return True
+    data = output.pydantic.model_dump() if output.pydantic is not None else output.json_dict
+    if data is None:
+        return False
+    try:
+        model.model_validate(data)
+    except ValidationError:
+        return False
+    return True
+
+
+class ParallelTaskScheduler:
+    """
+    Runs the tasks of a crew as a DAG instead of Process.sequential.
+
+    The result has the same shape as `crew.kickoff()`: `tasks_output` keeps the declaration
+    order of the tasks and the raw/json output of the crew is the one of the last task.
+    """
+
+    def __init__(
+        self,
+        crew: Crew,
+        max_workers: int = 4,
+        on_task_complete: Callable[[TaskOutput], None] | None = None,
+        cache: TaskOutputCache | None = None,
+        metrics: MetricsRecorder | None = None,
+        direct_stages: dict[str, DirectStage] | None = None,
+        fallback_llms: dict[str, LLM] | None = None,
+        run_control: RunControl | None = None,
+        context_fields: dict[str, ContextFields] | None = None,
+    ):
+        """
+        Args:
+            crew: The crew whose tasks should be scheduled
+            max_workers: Maximum number of tasks running at the same time
+            on_task_complete: Stage-completion hook, called with the output of each task right after
+                it finishes (or is loaded from the cache), like the `task_callback` of a Crew
+            cache: If given, tasks whose inputs did not change since a previous run are skipped
+                and their cached output is used instead
+            metrics: If given, a span with the duration, token counts and cost of every task is recorded
+            direct_stages: Task name -> function producing the output of the task from the outputs of
+                its context tasks, run instead of the agent loop (the tokens of any LLM call it makes
+                are still recorded). A stage returning None falls back to the agent
+            fallback_llms: Task name -> stronger LLM running the task again when the output of its
+                agent's (faster) LLM does not validate against the output model of the task
+            run_control: If given, the start and end of every task are reported to it, and no task
+                starts once the book is cancelled (the kickoff raises `BookCancelled` when the
+                running ones are done)
+            context_fields: Task name -> fields of the outputs of its context tasks that reach its
+                prompt (and its cache key), the direct stages still get the whole outputs
+        """
+        self.crew = crew
+        self.max_workers = max_workers
+        self.on_task_complete = on_task_complete
+        self.cache = cache
+        self.metrics = metrics
+        self.direct_stages = direct_stages or {}
+        self.fallback_llms = fallback_llms or {}
+        self.run_control = run_control
+        self.context_fields = context_fields or {}
+        self.inputs: dict[str, Any] = {}
+        self._token_usage: dict[str, dict[str, Any]] = {}
+        self.graph = build_task_graph(crew.tasks)
+        for name, fields in self.context_fields.items():
+            unknown = [upstream for upstream in fields if upstream not in self.graph.get(name, [])]
+            if unknown:
+                raise ValueError(f'Context fields of {name} refer to {unknown} which are not part of its context')
+        self.report: ScheduleReport | None = None
+
+    def kickoff(self, inputs: dict[str, Any] | None = None, completed: dict[str, TaskOutput] | None = None) -> CrewOutput:
+        """
+        Interpolate the inputs and run every task once all of its context tasks are done.
+
+        Args:
+            inputs: Kickoff inputs interpolated into the task and agent configs
+            completed: Outputs of tasks that already completed (e.g. loaded from checkpoints),
+                these tasks are not run again
+        """
+        self._prepare(inputs)
+        tasks = {task.name: task for task in self.crew.tasks}
+        outputs: dict[str, TaskOutput] = {}
+        timings: dict[str, TaskTiming] = {}
+        running: dict[Future, str] = {}
+        run_start = time.perf_counter()
+
+        for name, output in (completed or {}).items():
+            if name in tasks:
+                tasks[name].output = output
+                outputs[name] = output
+                timings[name] = TaskTiming(name, 0.0, 0.0, self.graph[name], cached=True)
+                self._emit(TASK_COMPLETED, task=name, cached=True)
+                if self.on_task_complete:
+                    self.on_task_complete(output)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while len(outputs) < len(tasks):
+                if self.run_control is not None:
+                    self.run_control.raise_if_cancelled()
+                for name, dependencies in self.graph.items():
+                    if name in outputs or name in running.values():
+                        continue
+                    if all(dependency in outputs for dependency in dependencies):
+                        future = executor.submit(self._execute, tasks[name], [outputs[d] for d in dependencies])
+                        running[future] = name
+                        self._emit(TASK_STARTED, task=name)
+
+                finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    output, start, end, cached = future.result()
+                    outputs[name] = output
+                    timings[name] = TaskTiming(name, start - run_start, end - run_start, self.graph[name], cached)
+                    self._emit(TASK_COMPLETED, task=name, cached=cached, duration=round(end - start, 4))
+                    if self.metrics is not None:
+                        self.metrics.add_span(TASK, name, start, end, cached=cached, **self._token_usage.pop(name, {}))
+                    if self.on_task_complete:
+                        self.on_task_complete(output)
+
+        durations = {name: timing.duration for name, timing in timings.items()}
+        self.report = ScheduleReport(
+            timings={name: timings[name] for name in self.graph},
+            critical_path=find_critical_path(self.graph, durations),
+            wall_time=time.perf_counter() - run_start,
+        )
+
+        tasks_output = [outputs[task.name] for task in self.crew.tasks]
+        final_output = tasks_output[-1]
+        return CrewOutput(
+            raw=final_output.raw,
+            pydantic=final_output.pydantic,
+            json_dict=final_output.json_dict,
+            tasks_output=tasks_output,
+            token_usage=self.crew.calculate_usage_metrics(),
+        )
+
+    def _prepare(self, inputs: dict[str, Any] | None) -> None:
+        # same preparation as Crew.kickoff() does before running its process
+        self.inputs = inputs or {}
+        if inputs is not None:
+            self.crew._inputs = inputs
+            self.crew._interpolate_inputs(inputs)
+        i18n = I18N(prompt_file=self.crew.prompt_file)
+        for agent in self.crew.agents:
+            self._prepare_agent(agent, i18n)
+
+    def _prepare_agent(self, agent: Agent, i18n: I18N) -> None:
+        agent.i18n = i18n
+        agent.crew = self.crew
+        if not agent.function_calling_llm:
+            agent.function_calling_llm = self.crew.function_calling_llm
+        if not agent.step_callback:
+            agent.step_callback = self.crew.step_callback
+        agent.create_agent_executor()
+
+    def _agent_with_llm(self, agent: Agent, llm: LLM) -> Agent:
+        """A copy of `agent` running on `llm`, with its own token counters"""
+        copied_agent = agent.copy()
+        copied_agent.llm = llm
+        self._prepare_agent(copied_agent, agent.i18n)
+        return copied_agent
+
+    def _emit(self, event_type: str, **data: Any) -> None:
+        if self.run_control is not None:
+            self.run_control.emit(event_type, **data)
+
+    def _execute(self, task: Task, context_outputs: list[TaskOutput]) -> tuple[TaskOutput, float, float, bool]:
+        if self.run_control is not None:
+            self.run_control.raise_if_cancelled()
+        start = time.perf_counter()
+        prompt_context, context_tokens = self._project_context(task, context_outputs)
+        cache_key = None
+        if self.cache is not None and self.cache.is_cacheable(task):
+            cache_key = self.cache.key(task, self.inputs, prompt_context)
+            cached_output = self.cache.get(cache_key, task)
+            if cached_output is not None:
+                print(f'Reusing cached output of {task.name}')
+                task.output = cached_output
+                return cached_output, start, time.perf_counter(), True
+
+        agent = task.agent
+        usage_before = agent._token_process.get_summary()
+        output = None
+        if task.name in self.direct_stages:
+            output = self.direct_stages[task.name](task, context_outputs)
+        direct = output is not None
+        if output is None:
+            output = self._run_agent(task, prompt_context)
+        else:
+            task.output = output
+        # tasks of the same agent depend on each other, so the agent counters only moved for this task
+        # (direct stages calling the LLM, e.g. streaming ones, add their usage to the agent counters too)
+        usage = self._usage(agent.llm, usage_before, agent._token_process.get_summary())
+
+        fallback_llm = self.fallback_llms.get(task.name)
+        if fallback_llm is not None and not output_is_valid(task, output):
+            print(f'{task.name}: the output of {usage["model"]} does not validate, running it again with {fallback_llm.model}')
+            # a copy of the agent runs the task, the agent itself may be running its other tasks meanwhile
+            fallback_agent = self._agent_with_llm(agent, fallback_llm)
+            usage_before = fallback_agent._token_process.get_summary()
+            try:
+                output = self._run_agent(task, prompt_context, fallback_agent)
+            finally:
+                task.agent = agent
+            fallback_usage = self._usage(fallback_llm, usage_before, fallback_agent._token_process.get_summary())
+            usage = {
+                **{key: usage[key] + fallback_usage[key] for key in ('prompt_tokens', 'completion_tokens', 'total_tokens', 'llm_requests')},
+                'model': usage['model'],
+                'fallback_model': fallback_usage['model'],
+                'cost_usd': None if None in (usage['cost_usd'], fallback_usage['cost_usd']) else usage['cost_usd'] + fallback_usage['cost_usd'],
+            }
+            direct = False
+            if self.metrics is not None:
+                self.metrics.increment(MODEL_FALLBACKS)
+        self._token_usage[task.name] = {**usage, **context_tokens}
+        if direct:
+            self._token_usage[task.name]['direct'] = True
+        if cache_key is not None:
+            self.cache.put(cache_key, output)
+        return output, start, time.perf_counter(), False
+
+    def _project_context(self, task: Task, context_outputs: list[TaskOutput]) -> tuple[list[TaskOutput], dict[str, int]]:
+        """
+        The context outputs reduced to the context fields of the task, and the tokens of the
+        context before and after the projection (empty without context fields).
+        """
+        context_fields = self.context_fields.get(task.name)
+        if not context_fields:
+            return context_outputs, {}
+        import litellm
+
+        prompt_context = project_context(context_outputs, context_fields)
+        model = getattr(task.agent.llm, 'model', None) or 'gpt-4'
+        context_tokens = {
+            'context_tokens': litellm.token_counter(model=model, text=aggregate_raw_outputs_from_task_outputs(context_outputs)),
+            'projected_context_tokens': litellm.token_counter(model=model, text=aggregate_raw_outputs_from_task_outputs(prompt_context)),
+        }
+        print(f"{task.name}: context of {context_tokens['context_tokens']} tokens projected to {context_tokens['projected_context_tokens']}")
+        return prompt_context, context_tokens
+
+    def _run_agent(self, task: Task, context_outputs: list[TaskOutput], agent: Agent | None = None) -> TaskOutput:
+        agent = agent or task.agent
+        tools = self.crew._prepare_tools(agent, task, task.tools or agent.tools or [])
+        return task.execute_sync(
+            agent=agent,
+            context=aggregate_raw_outputs_from_task_outputs(context_outputs),
+            tools=tools,
+        )
+
+    @staticmethod
+    def _usage(llm: Any, before: UsageMetrics, after: UsageMetrics) -> dict[str, Any]:
+        """Tokens, requests and cost of `llm` between two summaries of the agent counters"""
+        prompt_tokens = after.prompt_tokens - before.prompt_tokens
+        completion_tokens = after.completion_tokens - before.completion_tokens
+        model = getattr(llm, 'model', str(llm))
+        return {
+            'model': model,
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': completion_tokens,
+            'total_tokens': after.total_tokens - before.total_tokens,
+            'llm_requests': after.successful_requests - before.successful_requests,
+            'cost_usd': llm_cost(model, prompt_tokens, completion_tokens),
+        }
@@ -0,0 +1,238 @@
+"""
+Page-level streaming of the structured outputs of the LLM.
+
+Without streaming, a task that answers with a list of pages only hands over its output once the
+last page is written. Here the answer is streamed and `ArrayItemParser` picks every page out of
+the partial JSON as soon as its closing brace arrives, so the work on page 1 (its translation,
+its image) starts while page 2 is still being written. `PageJobs` runs that per-page work and
+lets the task that needs all of it collect the results, reusing the jobs already started.
+"""
+import json
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import TYPE_CHECKING, Any, Callable, Iterator, Type, TypeVar
+
+from pydantic import BaseModel
+
+from v0 import clients
+from v0.output_repair import closes_string, parse_model
+from v0.rate_limit import estimate_tokens, is_throttling, provider_of
+
+if TYPE_CHECKING:
+    from crewai import LLM, Task
+    from crewai.agents.agent_builder.utilities.base_token_process import TokenProcess
+
+
+ItemT = TypeVar('ItemT', bound=BaseModel)
+
+
+def json_messages(task: 'Task', context: str, model: Type[BaseModel], instructions: str = '') -> list[dict[str, str]]:
+    """
+    Messages asking the agent of `task` for its output as bare JSON, without the ReAct format
+    (Thought / Final Answer) of crewai, so the answer can be parsed while it streams.
+
+    Args:
+        task: Task with its inputs interpolated
+        context: Raw outputs of the context tasks
+        model: Model of the answer, its JSON schema is part of the prompt
+        instructions: Extra instructions appended to the task, e.g. to answer a single page
+    """
+    agent = task.agent
+    i18n = agent.i18n
+    system = i18n.slice('role_playing').format(role=agent.role, backstory=agent.backstory, goal=agent.goal)
+    prompt = task.prompt()
+    if instructions:
+        prompt = f'{prompt}\n\n{instructions}'
+    prompt += '\n\n' + i18n.slice('formatted_task_instructions').format(output_format=json.dumps(model.model_json_schema()))
+    if context:
+        prompt = i18n.slice('task_with_context').format(task=prompt, context=context)
+    return [{'role': 'system', 'content': system}, {'role': 'user', 'content': prompt}]
+
+
+def stream_completion(llm: 'LLM', messages: list[dict[str, str]], token_process: 'TokenProcess | None' = None) -> Iterator[str]:
+    """
+    Stream a completion with the model and settings of a crewai LLM.
+
+    Yields:
+        str: The text of the answer, chunk by chunk
+
+    The token usage of the call is added to `token_process` (e.g. the one of the agent) once the
+    stream is exhausted, like crewai does for the calls of its agents. The call goes through the
+    rate limiter of the provider and is retried if throttled before the first chunk.
+    """
+    import litellm
+
+    params = {
+        'model': llm.model,
+        'messages': messages,
+        'timeout': llm.timeout,
+        'temperature': llm.temperature,
+        'top_p': llm.top_p,
+        'max_tokens': llm.max_tokens or llm.max_completion_tokens,
+        'api_base': llm.base_url,
+        'api_version': llm.api_version,
+        'api_key': llm.api_key,
+        'stream': True,
+        'stream_options': {'include_usage': True},
+        **llm.kwargs,
+    }
+    limiter = clients.rate_limiter(provider_of(llm.model))
+    estimated_tokens = estimate_tokens(messages, params['max_tokens'] or 1000)
+    usage = None
+    answer = []
+    for attempt in range(limiter.max_retries + 1):
+        try:
+            with limiter.acquire(estimated_tokens):
+                for chunk in litellm.completion(**{key: value for key, value in params.items() if value is not None}):
+                    if getattr(chunk, 'usage', None):
+                        usage = chunk.usage
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        answer.append(chunk.choices[0].delta.content)
+                        yield chunk.choices[0].delta.content
+            break
+        except Exception as e:
+            # part of the answer may already be used, only a call throttled before it started is retried
+            if answer or attempt == limiter.max_retries or not is_throttling(e):
+                raise
+
+    if usage is None:
+        # not every provider reports the usage of a stream
+        prompt_tokens = litellm.token_counter(model=llm.model, messages=messages)
+        completion_tokens = litellm.token_counter(model=llm.model, text=''.join(answer))
+    else:
+        prompt_tokens, completion_tokens = usage.prompt_tokens, usage.completion_tokens
+    limiter.record_tokens(prompt_tokens + completion_tokens - estimated_tokens)
+    if token_process is not None:
+        token_process.sum_successful_requests(1)
+        token_process.sum_prompt_tokens(prompt_tokens)
+        token_process.sum_completion_tokens(completion_tokens)
+
+
+class ArrayItemParser:
+    """
+    Incremental parser of the objects of one array of a streamed JSON answer, e.g. the pages of
+    `{"pages": [{...}, {...}]}` (or of a bare `[{...}, {...}]`).
+
+    `feed` returns the objects completed by every chunk, validated into `item_model`. An object
+    is only returned once its closing brace arrived, so it is never a half-written page. Strings
+    are scanned with the same heuristics as `v0.output_repair`, so unescaped double quotes inside
+    them do not end them.
+    """
+
+    def __init__(self, field: str, item_model: Type[ItemT]):
+        """
+        Args:
+            field: Key of the array in the top-level object
+            item_model: Model of the objects of the array
+        """
+        self.field = field
+        self.item_model = item_model
+        self._text = ''
+        self._index = 0
+        self._stack: list[str] = []
+        self._in_string = False
+        self._escaped = False
+        self._string_start = 0
+        self._last_string = None
+        self._array_depth: int | None = None
+        # the objects after the end of the target array (e.g. of a later array) are not items
+        self._array_closed = False
+        self._item_start: int | None = None
+
+    @property
+    def text(self) -> str:
+        """The answer received so far"""
+        return self._text
+
+    def feed(self, chunk: str) -> list[ItemT]:
+        """Add the next chunk of the answer and return the objects it completed"""
+        self._text += chunk
+        text = self._text
+        completed = []
+        while self._index < len(text):
+            char = text[self._index]
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == '\\':
+                    self._escaped = True
+                elif char == '"':
+                    if not _lookahead_available(text, self._index):
+                        # wait for the next chunk to tell an unescaped quote from the end of the string
+                        break
+                    if closes_string(text, self._index):
+                        self._in_string = False
+                        self._last_string = text[self._string_start + 1:self._index]
+            elif char == '"':
+                self._in_string = True
+                self._string_start = self._index
+            elif char in '{[':
+                if char == '[' and self._array_depth is None and not self._array_closed and self._is_target_array():
+                    self._array_depth = len(self._stack) + 1
+                elif char == '{' and self._array_depth is not None and len(self._stack) == self._array_depth:
+                    self._item_start = self._index
+                self._stack.append(char)
+            elif char in '}]':
+                if self._stack:
+                    self._stack.pop()
+                if char == '}' and self._item_start is not None and len(self._stack) == self._array_depth:
+                    item = parse_model(text[self._item_start:self._index + 1], self.item_model)
+                    self._item_start = None
+                    if item is not None:
+                        completed.append(item)
+                elif char == ']' and self._array_depth is not None and len(self._stack) < self._array_depth:
+                    self._array_depth = None
+                    self._array_closed = True
+            self._index += 1
+        return completed
+
+    def _is_target_array(self) -> bool:
+        if not self._stack:
+            return True
+        return self._stack == ['{'] and self._last_string == self.field
+
+
+def _lookahead_available(text: str, index: int) -> bool:
+    """Whether enough of the text after the quote at `index` arrived for `closes_string` to decide"""
+    following = index + 1
+    while following < len(text) and text[following].isspace():
+        following += 1
+    if following == len(text):
+        return False
+    if text[following] != ',':
+        return True
+    following += 1
+    while following < len(text) and text[following].isspace():
+        following += 1
+    return following < len(text)
+
+
+class PageJobs:
+    """
+    Per-page jobs started while a streamed answer is still being written, e.g. the translation of
+    every page, identified by their input so that the task collecting them later reuses the jobs
+    already running and only starts the missing ones.
+    """
+
+    def __init__(self, max_workers: int, thread_name_prefix: str):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=thread_name_prefix)
+        self._jobs: dict[str, Future] = {}
+        self._lock = threading.Lock()
+
+    def submit(self, key: str, job: Callable[..., Any], *args: Any) -> Future:
+        """The job identified by `key`, started now unless it is already running or succeeded"""
+        with self._lock:
+            future = self._jobs.get(key)
+            if future is None or (future.done() and future.exception() is not None):
+                future = self._jobs[key] = self._executor.submit(job, *args)
+            return future
+
+    def cancel(self, key: str) -> None:
+        """Drop the job identified by `key` if it did not start, a running one can still be reused"""
+        with self._lock:
+            future = self._jobs.get(key)
+            if future is not None and future.cancel():
+                del self._jobs[key]
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,171 @@
+"""
+Library of page templates written by the page_designer agent, reused across books.
+
+Templates vary little between books of the same age range and art style, so every template that
+passes validation is saved with its age range and art style, and later books look up a match
+instead of asking the agent for a new one. `reuse_rate` keeps some fresh generations going so
+the library does not freeze on its first templates. The library is shared by the books running at
+the same time, in this process or others: the index is updated under a lock file and replaced
+atomically.
+"""
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator
+
+from jinja2 import Environment, TemplateSyntaxError, meta
+
+
+DEFAULT_TEMPLATE_DIR = os.path.join('.cache', 'templates')
+REQUIRED_PLACEHOLDERS = (
+    'illustration_path',
+    'english_text',
+    'translated_text',
+    'english_highlight_vocabulary_word',
+    'translated_highlight_vocabulary_word',
+)
+
+_environment = Environment()
+_WORD_RE = re.compile(r'[a-z0-9]+')
+
+
+def missing_placeholders(html_template: str) -> list[str]:
+    """Required placeholders the template does not use, every one of them if it does not compile"""
+    try:
+        variables = meta.find_undeclared_variables(_environment.parse(html_template))
+    except TemplateSyntaxError:
+        return list(REQUIRED_PLACEHOLDERS)
+    return [name for name in REQUIRED_PLACEHOLDERS if name not in variables]
+
+
+def style_words(art_style: str) -> set[str]:
+    return set(_WORD_RE.findall(art_style.lower()))
+
+
+def style_similarity(art_style: str, other_art_style: str) -> float:
+    """Jaccard similarity of the words of two art styles, 1.0 for the same words"""
+    words, other_words = style_words(art_style), style_words(other_art_style)
+    if not words or not other_words:
+        return 0.0
+    return len(words & other_words) / len(words | other_words)
+
+
+class TemplateStore:
+    """
+    Validated templates on disk, indexed by age range and art style in `index.json`.
+
+    The reuse decisions and the choice between equally close templates come from a
+    `random.Random` of the store, seeded with `seed`.
+    """
+
+    def __init__(self, root: str = DEFAULT_TEMPLATE_DIR, reuse_rate: float = 0.8, min_style_similarity: float = 0.5, seed: int | None = None):
+        """
+        Args:
+            root: Directory holding the templates and their index
+            reuse_rate: Probability (0-1) of reusing a matching template instead of generating a
+                fresh one. 1.0 always reuses, 0.0 always generates (and keeps saving)
+            min_style_similarity: Minimum word overlap (0-1) between the art style of the book
+                and the one of a stored template for it to match
+            seed: Seed of the reuse decisions, for reproducible runs
+        """
+        self.root = root
+        self.reuse_rate = reuse_rate
+        self.min_style_similarity = min_style_similarity
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._index_file = os.path.join(root, 'index.json')
+        self._lock_file = os.path.join(root, 'index.lock')
+
+    def lookup(self, age_range: str, art_style: str) -> str | None:
+        """
+        The stored template closest to `art_style` for `age_range`, or None if there is no match
+        or if this book should get a fresh template according to `reuse_rate`.
+        """
+        with self._lock:
+            if self._random.random() >= self.reuse_rate:
+                return None
+        if not os.path.exists(self._index_file):
+            return None
+        with self._index() as index:
+            candidates = [
+                (style_similarity(art_style, entry['art_style']), entry)
+                for entry in index.values()
+                if entry['age_range'] == age_range
+            ]
+            candidates = [(similarity, entry) for similarity, entry in candidates if similarity >= self.min_style_similarity]
+            if not candidates:
+                return None
+            best = max(similarity for similarity, _ in candidates)
+            with self._lock:
+                entry = self._random.choice([entry for similarity, entry in candidates if similarity == best])
+            path = os.path.join(self.root, entry['file'])
+            if not os.path.exists(path):
+                return None
+            with open(path, 'r', encoding='utf-8') as f:
+                html_template = f.read()
+            entry['uses'] += 1
+            return html_template
+
+    def save(self, html_template: str, age_range: str, art_style: str) -> str | None:
+        """
+        Save a template if it has every required placeholder.
+
+        Returns:
+            str | None: Id of the stored template, None if it failed validation
+        """
+        missing = missing_placeholders(html_template)
+        if missing:
+            print(f'Not saving the template, it is missing {missing}')
+            return None
+        template_id = hashlib.sha256(html_template.encode('utf-8')).hexdigest()[:16]
+        with self._index() as index:
+            if template_id not in index:
+                file_name = f'{template_id}.html'
+                tmp_path = os.path.join(self.root, f'.{file_name}.{os.getpid()}.{threading.get_ident()}.tmp')
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    f.write(html_template)
+                os.replace(tmp_path, os.path.join(self.root, file_name))
+                index[template_id] = {
+                    'id': template_id,
+                    'file': file_name,
+                    'age_range': age_range,
+                    'art_style': art_style,
+                    'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                    'uses': 0,
+                }
+        return template_id
+
+    @contextmanager
+    def _index(self) -> Iterator[dict[str, dict]]:
+        """
+        The index, locked against the other threads and processes until the `with` block ends,
+        and saved then if the block changed it.
+        """
+        import fcntl
+
+        os.makedirs(self.root, exist_ok=True)
+        with open(self._lock_file, 'a+') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                index = self._load_index()
+                saved = json.dumps(index, sort_keys=True)
+                yield index
+                if json.dumps(index, sort_keys=True) != saved:
+                    tmp_path = f'{self._index_file}.{os.getpid()}.{threading.get_ident()}.tmp'
+                    with open(tmp_path, 'w', encoding='utf-8') as f:
+                        json.dump(index, f, indent=4, ensure_ascii=False)
+                    os.replace(tmp_path, self._index_file)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _load_index(self) -> dict[str, dict]:
+        try:
+            with open(self._index_file, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
@@ -1,26 +1,8 @@
-import os
-from typing import Any, Type
-from pydantic import BaseModel, Field
+from typing import Type
+from pydantic import BaseModel, ConfigDict, Field
 from crewai.tools import BaseTool
-from huggingface_hub import InferenceClient
-from dotenv import load_dotenv
-import fal_client
-
-
-def on_queue_update(update):
-    if isinstance(update, fal_client.InProgress):
-        for log in update.logs:
-           print(log["message"])
-
-
-load_dotenv()
-
-
-client = InferenceClient(
-    "black-forest-labs/FLUX.1-dev",
-    token=os.getenv("HF_TOKEN")
-)
 
+from v0.image_batch import BatchImageGenerationError, BatchImageGenerator, build_prompt
 
 
 class ImageGenerationSchema(BaseModel):
@@ -51,10 +33,13 @@ class ImageGenerationSchema(BaseModel):
     # )
 
 class BatchImageGenerationTool(BaseTool):
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
     name: str = "Batch Image Generation Tool"
     description: str = "Generates images from text descriptions using the FLUX.1 model"
     args_schema: Type[BaseModel] = ImageGenerationSchema
-    model_name: str = "fal-ai/flux/dev" # "fal-ai/flux/schnell"
+    # fal batch engine, keeps the pages that already succeeded so a retried batch only regenerates the failed pages
+    generator: BatchImageGenerator = Field(default_factory=BatchImageGenerator)
 
     def _run(self, illustration_prompts: list[dict[str, str | list[str]]], character_designs: list[dict[str, str]], color_palette: str, art_style: str) -> list[str]:
         """
@@ -71,30 +56,11 @@ class BatchImageGenerationTool(BaseTool):
         Returns:
             list[str]: List of URLs to the generated image files
         """
-        results = []
-        for ill_prompt in illustration_prompts:
-            needed_character_designs = [
-                f'{character_design["name"]}: {character_design["design"]}' for character_design in character_designs 
-                if character_design["name"] in ill_prompt['character_names']
-                ]
-            prompt = f'{ill_prompt["prompt"]}\ncolor palette: {color_palette}, art style: {art_style}\n' + "\n".join(needed_character_designs)
-            
-            result = fal_client.subscribe(
-                self.model_name,
-                arguments={
-                    "prompt": prompt,
-                    "image_size": {
-                        "width": 720,  # FIXME fixed for now
-                        "height": 1280
-                    }
-                },
-                with_logs=True,
-                on_queue_update=on_queue_update,
-            )
-            results.append(result['images'][0]['url'])
-        return results
-
-
+        prompts = [
+            build_prompt(ill_prompt, character_designs, color_palette, art_style)
+            for ill_prompt in illustration_prompts
+        ]
+        return self.generator.generate_batch(prompts)
 
 
 if __name__ == "__main__":